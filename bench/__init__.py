@@ -0,0 +1,4 @@
+"""Performance benchmarks of the dotfiles tooling.
+
+Each module is runnable on its own, e.g. `python3 -m bench.walker`.
+"""
@@ -0,0 +1,77 @@
+"""Time of the batch apply against the former serial shutil.copy2() moves.
+
+Installs a number of files into an empty home like on a fresh machine.
+
+    python3 -m bench.apply [--files N] [--size BYTES] [--jobs N]
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from lib import apply
+
+
+class _Config:
+
+    def __init__(self, root, jobs):
+        self.cache_dir = os.path.join(root, 'cache')
+        self.state_dir = os.path.join(root, 'state')
+        self.jobs = jobs
+
+
+def legacy_move(source, destination):
+    """The regular file case of the former DotFile.move()."""
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.copy2(source, destination, follow_symlinks=False)
+
+
+def make_files(root, files, size):
+    names = []
+    for i in range(files):
+        name = os.path.join(f'.config/app{i % 50}', f'file{i}')
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        names.append(name)
+    return names
+
+
+def timed(label, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f'  {label:<22} {elapsed * 1000:9.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=16384)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        repo = os.path.join(root, 'repo')
+        names = make_files(repo, args.files, args.size)
+        print(f'{args.files} files of {args.size} bytes')
+
+        home = os.path.join(root, 'legacy')
+        timed('copy2 (legacy)', lambda: [
+            legacy_move(os.path.join(repo, name), os.path.join(home, name))
+            for name in names])
+
+        for jobs in sorted({1, args.jobs}):
+            home = os.path.join(root, f'batch{jobs}')
+            config = _Config(root, jobs)
+            timed(f'batch, {jobs} jobs', lambda: apply.apply(config, [
+                apply.Operation.copy(os.path.join(repo, name),
+                                     os.path.join(home, name))
+                for name in names]))
+
+
+if __name__ == '__main__':
+    main()
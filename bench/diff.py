@@ -0,0 +1,109 @@
+"""Time of the patience diff against the former difflib based one.
+
+Inputs are shaped like the worst offenders in practice: plist XML with lots of
+repeated <true/> and <integer> lines, and pretty printed JSON, with a number of
+scattered edits.
+
+    python3 -m bench.diff [--entries N] [--edits N] [--skip-difflib]
+"""
+
+import argparse
+import difflib
+import json
+import random
+import time
+
+from lib.diff import diff
+
+
+def legacy_diff(source_content, destination_content):
+    """The diff as it was implemented on top of difflib."""
+    lines = []
+    source_content = [line + '\n' for line in source_content.splitlines()]
+    destination_content = [
+            line + '\n' for line in destination_content.splitlines()]
+
+    for line in difflib.unified_diff(
+            destination_content, source_content,
+            fromfile='source', tofile='destination'):
+        if line.startswith('+'):
+            line = f'\033[38;5;64m{line}\033[0m'
+        elif line.startswith('-'):
+            line = f'\033[38;5;124m{line}\033[0m'
+        elif line.startswith('@@ '):
+            line = f'\033[38;5;33m{line}\033[0m'
+        lines.append(line)
+
+    return ''.join(lines)
+
+
+def make_plist(entries, rng):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<plist version="1.0">',
+             '<dict>']
+    for i in range(entries):
+        lines.append(f'\t<key>Setting {i}</key>')
+        lines.append('\t<dict>')
+        for key in ('Enabled', 'Visible', 'Blur'):
+            lines.append(f'\t\t<key>{key}</key>')
+            lines.append(rng.choice(['\t\t<true/>', '\t\t<false/>']))
+        lines.append('\t\t<key>Size</key>')
+        lines.append(f'\t\t<integer>{rng.randrange(4)}</integer>')
+        lines.append('\t</dict>')
+    lines += ['</dict>', '</plist>']
+    return '\n'.join(lines) + '\n'
+
+
+def make_json(entries, rng):
+    data = [{'id': rng.randrange(10), 'enabled': rng.random() < 0.5,
+             'tags': ['a', 'b'][:rng.randrange(3)]}
+            for _ in range(entries)]
+    return json.dumps(data, indent=2) + '\n'
+
+
+def edit(content, edits, rng):
+    lines = content.splitlines()
+    for _ in range(edits):
+        i = rng.randrange(len(lines))
+        action = rng.random()
+        if action < 0.4:
+            lines[i] = lines[i] + ' changed'
+        elif action < 0.7:
+            del lines[i]
+        else:
+            lines.insert(i, lines[rng.randrange(len(lines))])
+    return '\n'.join(lines) + '\n'
+
+
+def timed(label, function):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print(f'  {label:<22} {elapsed * 1000:9.1f} ms  '
+          f'{result.count(chr(10)):7d} output lines')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--edits', type=int, default=200)
+    parser.add_argument('--skip-difflib', action='store_true',
+                        help="don't run the difflib based diff, it's slow")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for name, make in (('plist', make_plist), ('json', make_json)):
+        old = make(args.entries, rng)
+        new = edit(old, args.edits, rng)
+        print(f'{name}: {len(old) / 2**20:.1f} MiB, '
+              f'{old.count(chr(10))} lines')
+
+        timed('patience', lambda: diff('source', 'destination', new, old))
+        timed(f'patience, {args.edits // 10} hunks', lambda: diff(
+            'source', 'destination', new, old, max_hunks=args.edits // 10))
+        if not args.skip_difflib:
+            timed('difflib (legacy)', lambda: legacy_diff(new, old))
+
+
+if __name__ == '__main__':
+    main()
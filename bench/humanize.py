@@ -0,0 +1,83 @@
+"""Throughput of the annotation of streams by dotfiles/.bin/humanize.
+
+Sparse logs have numbers worth annotating on every tenth line, dense ones
+on every line. Times the annotation of the whole log in process and the
+script reading it from stdin.
+
+    python3 -m bench.humanize [--lines N]
+"""
+
+import argparse
+import importlib.machinery
+import importlib.util
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                      'dotfiles', '.bin', 'humanize')
+
+_WORDS = ['GET', '/index.html', 'HTTP/1.1', 'status', 'ok', 'user', 'agent',
+          'Mozilla/5.0', '200', 'ms', '12:03:44', 'v1.2.3', 'host:8080']
+
+
+def load_humanize():
+    loader = importlib.machinery.SourceFileLoader('humanize', SCRIPT)
+    spec = importlib.util.spec_from_loader('humanize', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def make_log(lines, dense, rng):
+    log = []
+    for i in range(lines):
+        words = [rng.choice(_WORDS) for _ in range(12)]
+        if dense or i % 10 == 0:
+            # Lines of a log mostly share the second
+            words.append(str(1700000000 + i // 100))
+            words.append(f'size={rng.randrange(10**9)}')
+            words.append(f'pid {rng.randrange(1000, 99999)}')
+        log.append(' '.join(words) + '\n')
+    return log
+
+
+def timed(label, lines, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f'  {label:<22} {elapsed * 1000:9.1f} ms  '
+          f'{lines / elapsed:10.0f} lines/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=200000)
+    args = parser.parse_args()
+
+    humanize = load_humanize()
+    annotator = humanize.Annotator(
+            humanize._UTC, (1024, humanize._BINARY_SCALE))
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as root:
+        for name, dense in (('sparse', False), ('dense', True)):
+            log = make_log(args.lines, dense, rng)
+            path = os.path.join(root, f'{name}.log')
+            with open(path, 'w') as f:
+                f.writelines(log)
+            print(f'{name}: {args.lines} lines, '
+                  f'{os.path.getsize(path) / 2**20:.1f} MiB')
+
+            text = ''.join(log)
+            timed('annotate', args.lines, lambda: annotator.annotate(text))
+            with open(path, 'rb') as stdin:
+                timed('humanize --stdin', args.lines, lambda: subprocess.run(
+                    [sys.executable, SCRIPT, '--stdin'], stdin=stdin,
+                    stdout=subprocess.DEVNULL, check=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Throughput and size of the exclusion matcher against the TrieNode.
+
+Uses the exclusions of config.yaml and a mix of excluded and kept paths.
+
+    python3 -m bench.matcher [--paths N]
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import yaml
+
+from bench import synthetic
+from lib.matcher import ExclusionMatcher
+from lib.trie import TrieNode
+
+
+def deep_size(obj, seen=None):
+    """Approximate memory used by the object graph."""
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen)
+                    for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(vars(obj), seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        size += deep_size(getattr(obj, slot), seen)
+    return size
+
+
+def make_paths(rules, count, rng):
+    """Paths shaped like the walk of a home: excluded and kept ones."""
+    dirs = ['.config/', '.local/share/', '.cache/', '.vim/', 'Library/', '']
+    paths = []
+    for _ in range(count):
+        if rng.random() < 0.3:
+            paths.append(rng.choice(rules) + f'file{rng.randrange(100)}')
+        else:
+            paths.append(
+                    rng.choice(dirs) + f'app{rng.randrange(50)}/'
+                    f'file{rng.randrange(100)}')
+    return paths
+
+
+def timed(label, function, count):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<26} {elapsed * 1000:8.1f} ms  '
+          f'{count / elapsed / 1e6:6.2f} M paths/s')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--paths', type=int, default=200000)
+    args = parser.parse_args()
+
+    with open(synthetic.REPO_CONFIG) as f:
+        rules = yaml.load(f, Loader=yaml.FullLoader)['exclusions']
+
+    trie = TrieNode()
+    for rule in rules:
+        trie.insert(rule)
+    matcher = ExclusionMatcher(rules)
+
+    print(f'{len(rules)} rules, {len(matcher)} after dropping redundant ones')
+    print(f'TrieNode size: {deep_size(trie) / 1024:8.1f} KiB')
+    print(f'Matcher size:  {deep_size(matcher) / 1024:8.1f} KiB')
+
+    rng = random.Random(0)
+    paths = make_paths(rules, args.paths, rng)
+
+    expected = timed('TrieNode.query', lambda: [
+        trie.query(path) for path in paths], len(paths))
+    actual = timed('ExclusionMatcher.query', lambda: [
+        matcher.query(path) for path in paths], len(paths))
+    assert expected == actual
+
+    # Batch: group the paths by directory as the walker does
+    listings = dict()
+    for path in paths:
+        dirname, _, name = path.rpartition('/')
+        listings.setdefault(dirname + '/' if dirname else '', []).append(name)
+    timed('ExclusionMatcher.classify', lambda: [
+        matcher.classify(prefix, names)
+        for prefix, names in listings.items()], len(paths))
+
+
+if __name__ == '__main__':
+    main()
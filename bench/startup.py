@@ -0,0 +1,113 @@
+"""Startup cost of the short-lived commands fzf spawns.
+
+Runs management.py against a synthetic tree and reports the wall clock time of
+each subcommand with a cold and a warm config cache, compared to importing
+everything eagerly as the script used to. `--imports` prints the heaviest
+modules of a subcommand as reported by `python3 -X importtime`.
+
+    python3 -m bench.startup [--runs N] [--imports 'diff .rc0']
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import synthetic
+
+MANAGEMENT = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'management.py')
+
+COMMANDS = [
+    'help',
+    'diff .rc0',
+    'diff .rc0 home',
+    'install list',
+    'collect list',
+]
+
+# What every invocation imported before the imports were made lazy
+EAGER_IMPORTS = (
+        'import yaml, plistlib, shutil, subprocess, difflib, '
+        'lib.compare, lib.config, lib.dotfile, lib.index, lib.server')
+
+
+def run(argv, env):
+    start = time.perf_counter()
+    subprocess.run(argv, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def timed(label, argv, env, runs, before=None):
+    times = []
+    for _ in range(runs):
+        if before is not None:
+            before()
+        times.append(run(argv, env))
+    print(f'{label:<28} {statistics.median(times) * 1000:8.1f} ms  '
+          f'(min {min(times) * 1000:.1f} ms)')
+
+
+def import_report(argv, env, top=15):
+    result = subprocess.run(
+            [sys.executable, '-X', 'importtime'] + argv, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((int(self_us), int(cumulative_us), name.rstrip()))
+
+    total = sum(self_us for self_us, _, _ in modules)
+    print(f'{len(modules)} modules imported in {total / 1000:.1f} ms, '
+          f'heaviest by self time:')
+    for self_us, cumulative_us, name in sorted(modules, reverse=True)[:top]:
+        print(f'  {self_us / 1000:7.1f} ms  {cumulative_us / 1000:7.1f} ms  '
+              f'{name.strip()}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--imports', metavar='COMMAND',
+                        help='print the import time report of the command')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        base_dir, home_dir = synthetic.make_tree(
+                root, apps=20, cache_files=100)
+        script = os.path.join(base_dir, 'management.py')
+        os.symlink(MANAGEMENT, script)
+
+        env = dict(os.environ, HOME=home_dir,
+                   XDG_CACHE_HOME=os.path.join(root, 'cache'),
+                   XDG_RUNTIME_DIR=root)
+
+        def drop_config_cache():
+            for path in glob.glob(os.path.join(root, 'cache', '*', 'config-*')):
+                os.unlink(path)
+
+        timed('python3 -c pass', [sys.executable, '-c', 'pass'],
+              env, args.runs)
+        timed('eager imports', [sys.executable, '-c', EAGER_IMPORTS],
+              dict(env, PYTHONPATH=os.path.dirname(MANAGEMENT)), args.runs)
+        for command in COMMANDS:
+            argv = [sys.executable, script] + command.split()
+            timed(f'{command} (cold config)', argv, env, args.runs,
+                  before=drop_config_cache)
+            timed(f'{command}', argv, env, args.runs)
+
+        if args.imports:
+            print()
+            import_report([script] + args.imports.split(), env)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""Reproducible benchmark suite over a synthetic home.
+
+Times the main operations against the home and multi-layer checkout of
+synthetic.make_home() and writes the results as JSON, so that the runs of
+different commits can be compared. The tree is generated from a fixed seed,
+every case runs against its own cache dir.
+
+    python3 -m bench.suite [--scale F] [--repeat N] [--only NAME ...]
+                           [--output FILE] [--compare BASELINE.json]
+
+The summary is printed to stderr, the JSON to stdout unless --output is given.
+With --compare, cases slower than the baseline by more than --threshold are
+reported and the exit status is 1.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import lib
+from bench import synthetic
+from lib import plist
+from lib.trie import TrieNode
+
+VERSION = 1
+
+_CASES = []
+
+
+def case(name):
+    """Registers the decorated benchmark.
+
+    The function gets the Tree and returns the function to time, optionally
+    with a setup function run untimed before every run.
+    """
+    def register(function):
+        _CASES.append((name, function))
+        return function
+    return register
+
+
+class Tree:
+    """The synthetic home and the state shared by the cases."""
+
+    def __init__(self, root, scale, seed):
+        self.root = root
+        self.base_dir, self.home_dir = synthetic.make_home(
+                root, scale=scale, seed=seed)
+        self._cache_count = 0
+        self.new_cache()
+        self.config = self.new_config()
+
+        self.candidates = list(lib.discover_home_dotfiles(self.config))
+        self.modified = [dotfile for dotfile in self.candidates
+                         if dotfile.is_modified()]
+        self.home_paths = []
+        for dirpath, dirnames, filenames in os.walk(self.home_dir):
+            prefix = os.path.relpath(dirpath, self.home_dir)
+            prefix = '' if prefix == '.' else prefix + '/'
+            self.home_paths += [prefix + name + '/' for name in dirnames]
+            self.home_paths += [prefix + name for name in filenames]
+
+    def new_cache(self):
+        """Switches to an empty cache dir."""
+        self._cache_count += 1
+        os.environ['XDG_CACHE_HOME'] = os.path.join(
+                self.root, f'cache{self._cache_count}')
+        plist._caches.clear()
+
+    def new_config(self):
+        return lib.Config(base_dir=self.base_dir, home_dir=self.home_dir)
+
+    def describe(self):
+        return {
+            'home_files': len(self.home_paths),
+            'layers': len(self.config.dotfiles),
+            'candidates': len(self.candidates),
+            'modified': len(self.modified),
+        }
+
+
+@case('config.cold')
+def config_cold(tree):
+    return tree.new_config, tree.new_cache
+
+
+@case('config.warm')
+def config_warm(tree):
+    tree.new_config()
+    return tree.new_config, None
+
+
+@case('discover_home_dotfiles')
+def discover_home(tree):
+    return lambda: list(lib.discover_home_dotfiles(tree.config)), None
+
+
+@case('discover_home_dotfiles.indexed')
+def discover_home_indexed(tree):
+    index = lib.ScanIndex(tree.config)
+    list(lib.discover_home_dotfiles(tree.config, index))
+    index.save()
+
+    def run():
+        return list(lib.discover_home_dotfiles(
+            tree.config, lib.ScanIndex(tree.config)))
+    return run, None
+
+
+@case('discover_dotfiles')
+def discover_dotfiles(tree):
+    def run():
+        # Silence the skipped macOS files outside macOS
+        with contextlib.redirect_stderr(io.StringIO()):
+            return list(lib.discover_dotfiles(tree.config))
+    return run, None
+
+
+@case('is_modified.cold')
+def is_modified_cold(tree):
+    def run():
+        return [dotfile.is_modified() for dotfile in tree.candidates]
+    return run, tree.new_cache
+
+
+@case('is_modified.warm')
+def is_modified_warm(tree):
+    def run():
+        return [dotfile.is_modified() for dotfile in tree.candidates]
+    run()
+    return run, None
+
+
+@case('Comparator.modified.cold')
+def comparator_cold(tree):
+    def run():
+        index = lib.ScanIndex(tree.config)
+        with lib.Comparator(tree.config, index) as comparator:
+            return list(comparator.modified(tree.candidates))
+    return run, tree.new_cache
+
+
+@case('DotFile.diff')
+def dotfile_diff(tree):
+    def run():
+        return [dotfile.diff('dotfiles') for dotfile in tree.modified]
+    return run, None
+
+
+@case('move')
+def move(tree):
+    """Collects all the modified files, the checkout is restored after."""
+    backup_dir = os.path.join(tree.root, 'base.backup')
+    shutil.copytree(tree.base_dir, backup_dir, symlinks=True)
+
+    def restore():
+        shutil.rmtree(tree.base_dir)
+        shutil.copytree(backup_dir, tree.base_dir, symlinks=True)
+
+    names = [dotfile.name for dotfile in tree.modified]
+    return lambda: lib.move_all(tree.config, names, 'dotfiles'), restore
+
+
+@case('TrieNode.query')
+def trie_query(tree):
+    trie = TrieNode()
+    for rule in tree.config.exclusions.rules:
+        trie.insert(rule)
+    return lambda: [trie.query(path) for path in tree.home_paths], None
+
+
+@case('ExclusionMatcher.query')
+def matcher_query(tree):
+    matcher = tree.config.exclusions
+    return lambda: [matcher.query(path) for path in tree.home_paths], None
+
+
+def measure(function, setup, repeat):
+    """Returns the times of the runs and the size of the result."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    ops = len(result) if isinstance(result, list) else 1
+    return times, ops
+
+
+def git_commit():
+    """Returns (commit, is dirty) of the checkout, (None, None) outside git."""
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=cwd, text=True,
+                stderr=subprocess.DEVNULL).strip()
+        status = subprocess.check_output(
+                ['git', 'status', '--porcelain', '--untracked-files=no'],
+                cwd=cwd, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status)
+
+
+def run_suite(args):
+    names = [name for name, _ in _CASES]
+    for name in args.only or ():
+        if name not in names:
+            raise Exception(f'Unknown case {name}, expected one of {names}')
+
+    commit, dirty = git_commit()
+    report = {
+        'version': VERSION,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': args.scale,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': dict(),
+    }
+
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        tree = Tree(root, args.scale, args.seed)
+        report['tree'] = tree.describe()
+        print(f'Generated {report["tree"]} in '
+              f'{time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+        for name, prepare in _CASES:
+            if args.only and name not in args.only:
+                continue
+            tree.new_cache()
+            function, setup = prepare(tree)
+            times, ops = measure(function, setup, args.repeat)
+            median = statistics.median(times)
+            report['results'][name] = {
+                'times': times,
+                'min': min(times),
+                'median': median,
+                'ops': ops,
+                'ops_per_s': ops / median if median else None,
+            }
+            print(f'  {name:<32} {median * 1000:9.1f} ms  '
+                  f'(min {min(times) * 1000:.1f} ms, {ops} ops)',
+                  file=sys.stderr)
+
+    return report
+
+
+def compare(report, baseline, threshold):
+    """Prints the change of every case, returns names of the regressions."""
+    print(f'Against {baseline.get("commit")} ({baseline.get("created")}):',
+          file=sys.stderr)
+    regressions = []
+    for name, result in report['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            print(f'  {name:<32} new', file=sys.stderr)
+            continue
+        ratio = result['median'] / old['median'] if old['median'] else 1
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'  {name:<32} {old["median"] * 1000:9.1f} -> '
+              f'{result["median"] * 1000:9.1f} ms  {ratio:5.2f}x{flag}',
+              file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='size of the synthetic home, 1 is ~36k files')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', metavar='NAME',
+                        help='run only these cases')
+    parser.add_argument('--output', help='write the JSON to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown reported as regression (0.2 is 20%%)')
+    args = parser.parse_args()
+
+    report = run_suite(args)
+
+    content = json.dumps(report, indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content)
+    else:
+        sys.stdout.write(content)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('version') != VERSION:
+            raise Exception(f'Unknown report version in {args.compare}')
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
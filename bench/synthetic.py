@@ -0,0 +1,198 @@
+"""Generator of synthetic home directories and dotfiles repos."""
+
+import os
+import random
+import shutil
+
+# Exclusions of the real config so the exclusion checks cost the same
+REPO_CONFIG = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'config.yaml')
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def make_tree(root, apps=50, files_per_app=40, cache_files=2000,
+              tracked=200, seed=0):
+    """Create root/home and root/base (a dotfiles checkout).
+
+    Returns (base_dir, home_dir).
+    """
+    rng = random.Random(seed)
+    base_dir = os.path.join(root, 'base')
+    home_dir = os.path.join(root, 'home')
+    os.makedirs(os.path.join(base_dir, 'dotfiles'), exist_ok=True)
+    shutil.copy(REPO_CONFIG, os.path.join(base_dir, 'config.yaml'))
+
+    names = []
+    for i in range(apps):
+        for j in range(files_per_app):
+            depth = '/'.join(f'd{k}' for k in range(j % 4))
+            names.append(os.path.join(f'.config/app{i}', depth, f'file{j}'))
+    for i in range(tracked // 4):
+        names.append(f'.rc{i}')
+
+    for name in names:
+        _write(os.path.join(home_dir, name), f'{name}\n' * rng.randint(1, 50))
+
+    # Tracked files: most are same, some are modified
+    for name in rng.sample(names, min(tracked, len(names))):
+        with open(os.path.join(home_dir, name)) as f:
+            content = f.read()
+        if rng.random() < 0.1:
+            content += 'changed\n'
+        _write(os.path.join(base_dir, 'dotfiles', name), content)
+
+    # Noise which should be pruned: excluded and non-dot directories
+    for i in range(cache_files):
+        _write(os.path.join(home_dir, f'.cache/c{i % 20}/{i}'), 'x')
+        _write(os.path.join(home_dir, f'Documents/d{i % 20}/{i}'), 'x')
+
+    os.symlink('.config/app0', os.path.join(home_dir, '.app0'))
+    os.symlink('missing', os.path.join(home_dir, '.broken'))
+    return base_dir, home_dir
+
+
+def _write_bytes(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _make_plist(rng, keys):
+    """Preferences shaped like the big ones, e.g. of iTerm2."""
+    return {
+        f'Setting {i}': rng.choice([
+            True, False, rng.randrange(1000), rng.random(),
+            f'value {rng.randrange(100)}',
+            {'Enabled': rng.random() < 0.5, 'Size': rng.randrange(4),
+             'Color': [rng.random() for _ in range(3)]},
+            rng.randbytes(32)])
+        for i in range(keys)}
+
+
+# Extra layers of a checkout and the config they add to the base one
+_LAYERS = {
+    'work': (
+        'exclusions:\n'
+        '  - .config/work-vpn/\n'
+        '  - .config/app1/d0/d1/\n'
+        'plist_exclusions:\n'
+        '  com.example.app0:\n'
+        '    - Setting 0\n'
+        '    - Setting 1\n'),
+    'private': (
+        'exclusions:\n'
+        '  - .gnupg/\n'
+        '  - .config/app2/d0/\n'
+        'jobs: 8\n'),
+}
+
+
+def make_home(root, scale=1.0, seed=0):
+    """Create a realistic home with a multi-layer dotfiles checkout.
+
+    At scale 1 home has about 36000 files: deep .config/ and .local/ trees,
+    excluded caches, Library/ with binary plists (a few big ones), binary
+    blobs, non-dotfile folders, file and directory symlinks. The checkout at
+    root/base has the work/ and private/ layers, each with its config.yaml,
+    tracking about 600 of the files of which a tenth are modified.
+
+    Returns (base_dir, home_dir).
+    """
+    rng = random.Random(seed)
+    base_dir = os.path.join(root, 'base')
+    home_dir = os.path.join(root, 'home')
+
+    def count(n):
+        return max(1, int(n * scale))
+
+    os.makedirs(base_dir, exist_ok=True)
+    shutil.copy(REPO_CONFIG, os.path.join(base_dir, 'config.yaml'))
+    layers = ['dotfiles']
+    for layer, config in _LAYERS.items():
+        _write(os.path.join(base_dir, layer, 'config.yaml'), config)
+        layers.append(os.path.join(layer, 'dotfiles'))
+
+    # Candidate dotfiles
+    texts = []
+    for i in range(count(120)):
+        for j in range(40):
+            depth = '/'.join(f'd{k}' for k in range(j % 7))
+            texts.append(os.path.join(f'.config/app{i}', depth, f'file{j}.conf'))
+    for i in range(count(40)):
+        for j in range(25):
+            texts.append(f'.local/share/tool{i}/data/{j}.json')
+    for i in range(count(60)):
+        texts.append(f'.rc{i}')
+    alfred = 'Library/Application Support/Alfred/Alfred.alfredpreferences'
+    for i in range(count(200)):
+        texts.append(f'{alfred}/workflows/w{i % 20}/prefs{i}.json')
+    for name in texts:
+        _write(os.path.join(home_dir, name),
+               ''.join(f'{name} option{k} = {rng.randrange(10**6)}\n'
+                       for k in range(rng.randint(1, 80))))
+
+    blobs = [f'.config/app{i}/state.bin' for i in range(0, count(120), 6)]
+    for name in blobs:
+        _write_bytes(os.path.join(home_dir, name),
+                     rng.randbytes(rng.choice([4096, 65536, 2**20])))
+
+    import plistlib
+
+    plists = []
+    for i in range(count(60)):
+        name = f'Library/Preferences/com.example.app{i}.plist'
+        keys = 20000 if i < 3 else rng.randint(10, 500)
+        _write_bytes(os.path.join(home_dir, name), plistlib.dumps(
+            _make_plist(rng, keys), fmt=plistlib.FMT_BINARY))
+        plists.append(name)
+
+    # Noise which should be pruned: excluded and non-dotfile directories
+    for i in range(count(8000)):
+        _write(os.path.join(home_dir, f'.cache/c{i % 50}/x{i % 7}/{i}'), 'x')
+        _write(os.path.join(home_dir, f'Library/Caches/c{i % 30}/{i}'), 'x')
+        _write(os.path.join(home_dir, f'Documents/d{i % 40}/e{i % 3}/{i}'),
+               'x')
+    for i in range(count(3000)):
+        _write(os.path.join(home_dir, f'.local/lib/python/pkg{i % 60}/{i}.py'),
+               'pass\n')
+        _write(os.path.join(
+            home_dir, f'Library/Application Support/App{i % 25}/{i}'), 'x')
+
+    os.symlink('.config/app0', os.path.join(home_dir, '.app0'))
+    os.symlink('.rc0', os.path.join(home_dir, '.rclink'))
+    os.symlink('missing', os.path.join(home_dir, '.broken'))
+    os.symlink('../Documents', os.path.join(home_dir, '.config/docs'))
+
+    # Tracked files, spread over the layers, some are in several of them
+    tracked = rng.sample(texts, min(count(500), len(texts)))
+    tracked += rng.sample(blobs, len(blobs) // 2) + ['.rclink', '.broken']
+    for name in tracked:
+        home_path = os.path.join(home_dir, name)
+        for layer in rng.sample(layers, 1 if rng.random() < 0.9 else 2):
+            dotfile_path = os.path.join(base_dir, layer, name)
+            if os.path.islink(home_path):
+                os.makedirs(os.path.dirname(dotfile_path), exist_ok=True)
+                os.symlink(os.readlink(home_path), dotfile_path)
+                continue
+            with open(home_path, 'rb') as f:
+                content = f.read()
+            if rng.random() < 0.1:
+                content += b'changed\n'
+            _write_bytes(dotfile_path, content)
+
+    # The repo keeps plists as XML
+    for name in rng.sample(plists, len(plists) // 2):
+        with open(os.path.join(home_dir, name), 'rb') as f:
+            settings = plistlib.load(f)
+        if rng.random() < 0.2:
+            settings['Setting 5'] = 'changed'
+        _write_bytes(os.path.join(base_dir, 'dotfiles', name),
+                     plistlib.dumps(settings, fmt=plistlib.FMT_XML))
+
+    return base_dir, home_dir
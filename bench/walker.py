@@ -0,0 +1,195 @@
+"""Syscall and time cost of home discovery.
+
+Compares the os.walk() based discovery (kept here for reference) with the
+scandir walker, with and without the scan index. Filesystem calls are counted
+by an instrumented `os` shim which also counts the lazy DirEntry.stat() calls.
+
+    python3 -m bench.walker [--apps N] [--cache-files N]
+"""
+
+import argparse
+import collections
+import contextlib
+import os
+import tempfile
+import time
+
+import lib
+from bench import synthetic
+
+
+def legacy_discover_home_dotfiles(config):
+    """Discovery as it was implemented on top of os.walk()."""
+    dotfiles = dict()
+    home_dir = config.home_dir
+
+    for dotfiles_dir in config.dotfiles:
+        for dirpath, dirnames, filenames in os.walk(dotfiles_dir):
+            for filename in filenames + dirnames:
+                dotfile_path = os.path.join(dirpath, filename)
+                if os.path.isfile(dotfile_path) or os.path.islink(dotfile_path):
+                    name = os.path.relpath(dotfile_path, dotfiles_dir)
+                    if os.path.exists(os.path.join(home_dir, name)):
+                        dotfiles[name] = dotfile_path
+
+    for extra_folder in config.get_inclusions():
+        extra_folder = os.path.join(home_dir, extra_folder)
+        for dirpath, _, filenames in os.walk(extra_folder):
+            for filename in filenames:
+                name = os.path.relpath(
+                        os.path.join(dirpath, filename), home_dir)
+                if not config.is_excluded(name):
+                    dotfiles.setdefault(name, None)
+
+    for dirpath, dirnames, filenames in os.walk(home_dir, topdown=True):
+        is_home_folder = os.path.samefile(home_dir, dirpath)
+        dirnames[:] = [name for name in dirnames if
+                       (name.startswith('.') or not is_home_folder) and
+                       name != '.git' and
+                       not config.is_excluded(
+                           os.path.relpath(
+                               os.path.join(dirpath, name), home_dir) + '/')]
+
+        for dirname in dirnames:
+            home_path = os.path.join(dirpath, dirname)
+            name = os.path.relpath(home_path, home_dir)
+            if not config.is_excluded(name) and os.path.islink(home_path):
+                dotfiles.setdefault(name, None)
+
+        for filename in filenames:
+            name = os.path.relpath(os.path.join(dirpath, filename), home_dir)
+            if config.is_excluded(name):
+                continue
+            if is_home_folder and not filename.startswith('.'):
+                continue
+            dotfiles.setdefault(name, None)
+
+    return set(dotfiles)
+
+
+class _CountingDirEntry:
+
+    def __init__(self, dir_entry, counts):
+        self._dir_entry = dir_entry
+        self._counts = counts
+
+    def __getattr__(self, name):
+        return getattr(self._dir_entry, name)
+
+    def stat(self, *, follow_symlinks=True):
+        self._counts['DirEntry.stat'] += 1
+        return self._dir_entry.stat(follow_symlinks=follow_symlinks)
+
+
+class _CountingScandir:
+
+    def __init__(self, iterator, counts):
+        self._iterator = iterator
+        self._counts = counts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._iterator.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return _CountingDirEntry(next(self._iterator), self._counts)
+
+    def close(self):
+        self._iterator.close()
+
+
+@contextlib.contextmanager
+def count_calls():
+    """Count filesystem calls and path string operations."""
+    counts = collections.Counter()
+    originals = dict()
+
+    def counting(module, name):
+        original = getattr(module, name)
+        originals[(module, name)] = original
+
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return original(*args, **kwargs)
+        setattr(module, name, wrapper)
+
+    for name in ('stat', 'lstat', 'readlink', 'listdir'):
+        counting(os, name)
+    for name in ('relpath', 'samefile'):
+        counting(os.path, name)
+
+    original_scandir = os.scandir
+
+    def scandir(*args):
+        counts['scandir'] += 1
+        return _CountingScandir(original_scandir(*args), counts)
+    os.scandir = scandir
+
+    try:
+        yield counts
+    finally:
+        os.scandir = original_scandir
+        for (module, name), original in originals.items():
+            setattr(module, name, original)
+
+
+def measure(label, function):
+    with count_calls() as counts:
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+    # samefile() is counted through its two stat() calls
+    syscalls = sum(value for key, value in counts.items()
+                   if key not in ('relpath', 'samefile'))
+    details = ', '.join(f'{key}={value}' for key, value in sorted(counts.items()))
+    print(f'{label:<22} {elapsed * 1000:8.1f} ms  {syscalls:7d} calls  '
+          f'({details})')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--apps', type=int, default=100)
+    parser.add_argument('--cache-files', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        base_dir, home_dir = synthetic.make_tree(
+                root, apps=args.apps, cache_files=args.cache_files)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(root, 'cache')
+        config = lib.Config(base_dir=base_dir, home_dir=home_dir)
+
+        # Make everything old enough to be trusted by the index
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                os.utime(os.path.join(dirpath, name), (1, 1),
+                         follow_symlinks=False)
+
+        def walker(index=None):
+            names = {dotfile.name for dotfile in
+                     lib.discover_home_dotfiles(config, index)}
+            if index is not None:
+                index.save()
+            return names
+
+        expected = measure('os.walk (legacy)',
+                           lambda: legacy_discover_home_dotfiles(config))
+        results = [
+            measure('scandir walker', walker),
+            measure('walker + cold index',
+                    lambda: walker(lib.ScanIndex(config))),
+            measure('walker + warm index',
+                    lambda: walker(lib.ScanIndex(config))),
+        ]
+        for result in results:
+            assert result == expected, result ^ expected
+        print(f'{len(expected)} dotfiles discovered')
+
+
+if __name__ == '__main__':
+    main()
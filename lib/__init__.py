@@ -1,4 +1,46 @@
+"""Dotfiles management library.
 
-from .config import Config
+Submodules are imported on first use: fzf spawns the script for every preview
+and reload, and most of those runs need only a small part of the library.
+"""
+
+import importlib
+
+# Importing the submodule would replace the function with the module, diff is
+# light enough to be imported right away
 from .diff import diff
-from .dotfile import DotFile, discover_home_dotfiles, discover_dotfiles
+
+_EXPORTS = {
+    'move_all': 'apply',
+    'recover': 'apply',
+    'Comparator': 'compare',
+    'Config': 'config',
+    'DiffCache': 'diffcache',
+    'Prerenderer': 'diffcache',
+    'DotFile': 'dotfile',
+    'discover_home_dotfiles': 'dotfile',
+    'discover_dotfiles': 'dotfile',
+    'ScanIndex': 'index',
+    'ScanReport': 'scanreport',
+}
+
+_SUBMODULES = (
+    'audit', 'client', 'overlay', 'runner', 'server', 'status', 'tracing')
+
+__all__ = ['diff'] + list(_EXPORTS) + list(_SUBMODULES)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        module = importlib.import_module(f'.{_EXPORTS[name]}', __name__)
+        value = getattr(module, name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module(f'.{name}', __name__)
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
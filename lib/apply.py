@@ -0,0 +1,364 @@
+"""Transactional batch apply of the selected dotfiles.
+
+Copying the selected files one by one in place leaves torn files and a half
+updated home when interrupted. Instead, a batch goes through these phases:
+
+ 1. stage: every new content is written to a temporary file next to its
+    destination, in parallel, using reflink or in-kernel copies where the
+    filesystem allows, and fsynced
+ 2. journal: the list of operations is written and fsynced to the state dir
+ 3. commit: the original destinations are hard linked (or copied where the
+    filesystem has no hard links) to backups, then the staged files
+    atomically replace them with os.replace()
+ 4. cleanup: the directories are fsynced, backups and the journal removed
+
+Whether an operation of an interrupted batch was committed can be told from
+the filesystem (its staged file is gone), so the journal is written only once.
+recover() then either finishes the batch or restores the backups. Staged files
+of a process killed before the journal was written are never discovered as
+dotfiles, see fsutil.is_staged().
+"""
+
+import concurrent.futures
+import errno
+import json
+import os
+import stat
+import sys
+
+try:
+    from . import tracing
+    from .fsutil import atomic_write, fsync_dir, staged_path
+except ImportError:
+    # Imported as a top-level module by the tests
+    import tracing
+    from fsutil import atomic_write, fsync_dir, staged_path
+
+JOURNAL_VERSION = 1
+
+# ioctl to share the data blocks of the source (btrfs, XFS, ...)
+_FICLONE = 0x40049409
+
+_COPY_CHUNK = 1 << 24
+
+
+class Operation:
+    """Replace the destination with a copy of the source file, a symlink,
+    the given content, or delete it.
+    """
+
+    __slots__ = ('kind', 'destination', 'source', 'payload', 'tmp', 'backup',
+                 'existed')
+
+    def __init__(self, kind, destination, source=None, payload=None):
+        self.kind = kind
+        self.destination = destination
+        self.source = source
+        self.payload = payload
+        self.tmp = staged_path(destination, 'tmp')
+        self.backup = staged_path(destination, 'bak')
+        self.existed = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.kind} {self.destination})'
+
+    @classmethod
+    def copy(cls, source, destination):
+        return cls('copy', destination, source=source)
+
+    @classmethod
+    def symlink(cls, target, destination):
+        return cls('symlink', destination, payload=target)
+
+    @classmethod
+    def write(cls, content, destination):
+        return cls('write', destination, payload=content)
+
+    @classmethod
+    def delete(cls, destination):
+        return cls('delete', destination)
+
+    def to_json(self):
+        return {'kind': self.kind, 'destination': self.destination,
+                'tmp': self.tmp, 'backup': self.backup,
+                'existed': self.existed}
+
+    @classmethod
+    def from_json(cls, data):
+        operation = cls(data['kind'], data['destination'])
+        operation.tmp = data['tmp']
+        operation.backup = data['backup']
+        operation.existed = data['existed']
+        return operation
+
+
+def _clone(source_fd, destination_fd):
+    """Reflink the whole file, returns False if not supported."""
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+
+    try:
+        fcntl.ioctl(destination_fd, _FICLONE, source_fd)
+    except OSError:
+        return False
+    return True
+
+
+def _copy_data(source_fd, destination_fd, size):
+    """Copies the content in the kernel if possible."""
+    if _clone(source_fd, destination_fd):
+        return
+
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(
+                        source_fd, destination_fd, min(size - offset,
+                                                       _COPY_CHUNK),
+                        offset, offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError as e:
+            # Cross-device on old kernels or an unsupported filesystem
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.EPERM):
+                raise
+
+    os.lseek(destination_fd, offset, os.SEEK_SET)
+    while True:
+        chunk = os.pread(source_fd, _COPY_CHUNK, offset)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(destination_fd, view):]
+        offset += len(chunk)
+
+
+def _stage(operation):
+    """Writes the new content next to the destination."""
+    if operation.kind == 'delete':
+        return
+
+    os.makedirs(os.path.dirname(operation.destination), exist_ok=True)
+    if os.path.lexists(operation.tmp):
+        os.unlink(operation.tmp)
+
+    if operation.kind == 'symlink':
+        os.symlink(operation.payload, operation.tmp)
+        return
+
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_CLOEXEC', 0)
+    if operation.kind == 'write':
+        fd = os.open(operation.tmp, flags, 0o644)
+        try:
+            view = memoryview(operation.payload)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return
+
+    import shutil
+
+    source_fd = os.open(operation.source, os.O_RDONLY)
+    try:
+        source_stat = os.fstat(source_fd)
+        fd = os.open(operation.tmp, flags, stat.S_IMODE(source_stat.st_mode))
+        try:
+            _copy_data(source_fd, fd, source_stat.st_size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    finally:
+        os.close(source_fd)
+    # Same as shutil.copy2()
+    shutil.copystat(operation.source, operation.tmp, follow_symlinks=False)
+
+
+def _is_committed(operation):
+    if operation.kind == 'delete':
+        return not os.path.lexists(operation.destination)
+    return not os.path.lexists(operation.tmp)
+
+
+def _commit(operation):
+    if operation.existed:
+        # Hard link keeps the original in place until it's atomically replaced
+        if os.path.lexists(operation.backup):
+            os.unlink(operation.backup)
+        if operation.kind == 'delete':
+            os.rename(operation.destination, operation.backup)
+            return
+        try:
+            os.link(operation.destination, operation.backup,
+                    follow_symlinks=False)
+        except OSError:
+            # No hard links on SMB, exFAT, some NFS setups, ...
+            _copy_backup(operation)
+    if operation.kind != 'delete':
+        os.replace(operation.tmp, operation.destination)
+
+
+def _copy_backup(operation):
+    import shutil
+
+    shutil.copy2(operation.destination, operation.backup,
+                 follow_symlinks=False)
+    if not os.path.islink(operation.backup):
+        fd = os.open(operation.backup, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _rollback(operation):
+    if _is_committed(operation):
+        if operation.existed:
+            os.replace(operation.backup, operation.destination)
+        elif os.path.lexists(operation.destination):
+            os.unlink(operation.destination)
+    elif os.path.lexists(operation.tmp):
+        os.unlink(operation.tmp)
+    _remove(operation.backup)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class Journal:
+    """Operations of the batch in flight, kept in the state dir.
+
+    Not in the cache dir, deleting that one to force a rescan must not lose
+    what recover() needs.
+    """
+
+    def __init__(self, config):
+        self.path = os.path.join(config.state_dir, 'apply-journal.json')
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def write(self, operations):
+        atomic_write(self.path, json.dumps({
+            'version': JOURNAL_VERSION,
+            'operations': [operation.to_json() for operation in operations],
+        }).encode(), durable=True)
+
+    def read(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        if data.get('version') != JOURNAL_VERSION:
+            raise Exception(f'Unknown apply journal version in {self.path}')
+        return [Operation.from_json(item) for item in data['operations']]
+
+    def remove(self):
+        os.unlink(self.path)
+        fsync_dir(os.path.dirname(self.path))
+
+
+def _finish(journal, operations):
+    for directory in {os.path.dirname(operation.destination)
+                      for operation in operations}:
+        fsync_dir(directory)
+    for operation in operations:
+        _remove(operation.backup)
+    journal.remove()
+
+
+def apply(config, operations, jobs=None):
+    """Applies all the operations or, on failure, none of them."""
+    journal = Journal(config)
+    if journal.exists():
+        raise Exception(
+                'An interrupted batch was found, run `management.py recover` '
+                'to finish it or `management.py recover rollback`')
+
+    operations = [operation for operation in operations
+                  if not _is_noop(operation)]
+    if not operations:
+        return
+
+    tracing.count('apply.operations', len(operations))
+    jobs = jobs if jobs is not None else config.jobs
+    try:
+        with tracing.span('apply.stage'), \
+             concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            for _ in pool.map(_stage, operations):
+                pass
+    except BaseException:
+        for operation in operations:
+            if operation.kind != 'delete':
+                _remove(operation.tmp)
+        raise
+
+    for operation in operations:
+        operation.existed = os.path.lexists(operation.destination)
+    journal.write(operations)
+
+    try:
+        with tracing.span('apply.commit'):
+            for operation in operations:
+                _commit(operation)
+    except BaseException:
+        for operation in operations:
+            _rollback(operation)
+        journal.remove()
+        raise
+
+    _finish(journal, operations)
+
+
+def move_all(config, names, direction, jobs=None):
+    """Moves the named dotfiles in the direction as one batch."""
+    from .dotfile import DotFile
+
+    apply(config, [DotFile.discover(config, name).operation(direction)
+                   for name in names], jobs)
+
+
+def _is_noop(operation):
+    """Returns True if the destination is already as requested."""
+    if operation.kind == 'delete':
+        return not os.path.lexists(operation.destination)
+    if operation.kind == 'symlink':
+        return (os.path.islink(operation.destination) and
+                os.readlink(operation.destination) == operation.payload)
+    return False
+
+
+def recover(config, rollback=False):
+    """Finishes or rolls back an interrupted batch.
+
+    Returns the number of operations of the batch, 0 if there wasn't any.
+    """
+    journal = Journal(config)
+    if not journal.exists():
+        return 0
+
+    operations = journal.read()
+    if rollback:
+        for operation in operations:
+            _rollback(operation)
+        journal.remove()
+        return len(operations)
+
+    for operation in operations:
+        if not _is_committed(operation):
+            if operation.kind != 'delete' and not os.path.lexists(
+                    operation.tmp):
+                raise Exception(
+                        f'Staged file {operation.tmp} is missing, '
+                        'the batch can only be rolled back')
+            _commit(operation)
+    _finish(journal, operations)
+    return len(operations)
@@ -0,0 +1,145 @@
+"""Drift of many homes against the dotfiles repo.
+
+`management.py audit HOME...` checks homes of other users or mounted
+container images against the dotfiles of this checkout. The repo side is
+scanned once: the layers are merged, and every file is hashed through the
+scan index so its digest usually comes from the cache. The config, the
+exclusion matcher and the repo-side digests go to each worker of a process
+pool once, so every home costs only stats and reading its own copies.
+
+Every home produces one JSON line with the state of every dotfile: same,
+modified or missing; untracked for dotfiles found only in the home with
+--untracked. Links are the same when they point to the same target and
+both resolve, broken links are always modified as in DotFile.is_modified.
+Nothing is written to the audited homes, not even caches.
+"""
+
+import concurrent.futures
+import json
+import os
+import stat
+import sys
+
+from .dotfile import CandidateTable, DotFile, discover_home_dotfiles
+from .index import ScanIndex, file_digest, mode_differs, stat_signature
+from .overlay import get_overlay
+
+SAME, MODIFIED, MISSING, UNTRACKED = 'same', 'modified', 'missing', 'untracked'
+
+_LINK, _FILE, _PLIST = 'link', 'file', 'plist'
+
+
+def repo_side(config):
+    """Returns {name: (layer, kind, facts)} of the repo dotfiles.
+
+    Facts are (target, resolves) of links and (mode, size, digest) of files.
+    """
+    index = ScanIndex(config)
+    table = CandidateTable(config)
+    tracked = dict()
+    for name, layer in get_overlay(config, index).layer_items():
+        dotfile = table.add(name, layer)
+        if dotfile.is_macos_only and sys.platform != 'darwin':
+            continue
+        st = dotfile.dotfile_stat()
+        if st is None:
+            continue
+        dotfile_path = dotfile.dotfile_path
+        if stat.S_ISLNK(st.st_mode):
+            tracked[name] = (layer, _LINK, (os.readlink(dotfile_path),
+                                            os.path.exists(dotfile_path)))
+        elif dotfile.is_plist:
+            # Filtered by the plist exclusions, compared as usual
+            tracked[name] = (layer, _PLIST, None)
+        elif stat.S_ISREG(st.st_mode):
+            digest = index.digest(dotfile_path, stat_signature(st))
+            tracked[name] = (layer, _FILE, (st.st_mode, st.st_size, digest))
+    index.save()
+    return tracked
+
+
+def _state(config, name, layer, kind, facts):
+    home_path = os.path.join(config.home_dir, name)
+    try:
+        st = os.lstat(home_path)
+    except OSError:
+        return MISSING
+
+    if kind == _LINK:
+        target, resolves = facts
+        if not stat.S_ISLNK(st.st_mode):
+            return MODIFIED
+        # Links which don't resolve are always listed
+        if not resolves or not os.path.exists(home_path):
+            return MODIFIED
+        return SAME if os.readlink(home_path) == target else MODIFIED
+    elif kind == _PLIST:
+        dotfile = DotFile.create(config, name, layer)
+        return MODIFIED if dotfile.is_modified() else SAME
+
+    mode, size, digest = facts
+    if (not stat.S_ISREG(st.st_mode) or st.st_size != size or
+        mode_differs(st.st_mode, mode)):
+        return MODIFIED
+    return SAME if file_digest(home_path) == digest else MODIFIED
+
+
+_worker_state = None
+
+
+def _init_worker(config, tracked, untracked):
+    global _worker_state
+    _worker_state = (config, tracked, untracked)
+
+
+def audit_home(home_dir):
+    """Returns the JSON serializable drift of the home, run in a worker."""
+    config, tracked, untracked = _worker_state
+    if not os.path.isdir(home_dir):
+        return {'home': home_dir, 'error': 'not a directory'}
+
+    home_config = config.for_home(home_dir)
+    dotfiles = dict()
+    counts = {SAME: 0, MODIFIED: 0, MISSING: 0}
+    try:
+        for name, (layer, kind, facts) in tracked.items():
+            state = _state(home_config, name, layer, kind, facts)
+            dotfiles[name] = state
+            counts[state] += 1
+
+        if untracked:
+            counts[UNTRACKED] = 0
+            for dotfile in discover_home_dotfiles(home_config):
+                if dotfile.is_macos_only and sys.platform != 'darwin':
+                    continue
+                if dotfile.name not in tracked:
+                    dotfiles[dotfile.name] = UNTRACKED
+                    counts[UNTRACKED] += 1
+    except OSError as e:
+        return {'home': home_dir, 'error': str(e)}
+    return {'home': home_dir, 'counts': counts, 'dotfiles': dotfiles}
+
+
+def audit(config, homes, untracked=False, jobs=None, out=None):
+    """Writes one JSON line per home, in the given order.
+
+    Returns the number of homes which drifted or failed.
+    """
+    out = out or sys.stdout
+    tracked = repo_side(config)
+    jobs = jobs if jobs is not None else config.jobs
+    jobs = max(1, min(jobs, os.cpu_count() or 1, len(homes)))
+
+    drifted = 0
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=(config, tracked, untracked)) as pool:
+        for result in pool.map(audit_home, [os.path.abspath(home)
+                                            for home in homes]):
+            counts = result.get('counts')
+            if (counts is None or counts[MODIFIED] or counts[MISSING] or
+                counts.get(UNTRACKED)):
+                drifted += 1
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+    return drifted
@@ -0,0 +1,98 @@
+"""Client side of the resident server, see server.py.
+
+Kept apart so that asking the server doesn't import anything the server needs
+to do the actual work.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+
+FRAME = struct.Struct('!BI')
+EXIT, STDOUT, STDERR = 0, 1, 2
+
+
+def socket_path(base_dir, home_dir):
+    """Socket of the server for the given dotfiles checkout and home.
+
+    Without XDG_RUNTIME_DIR it's in a directory of the user in the shared
+    temporary directory, which the server creates.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        import tempfile
+        runtime_dir = os.path.join(
+                tempfile.gettempdir(), f'dotfiles-{os.getuid()}')
+    key = hashlib.sha1(
+            f'{os.path.abspath(base_dir)}\0{home_dir}'.encode()).hexdigest()
+    return os.path.join(runtime_dir, f'dotfiles-{os.getuid()}-{key[:16]}.sock')
+
+
+def is_private_dir(path):
+    """Returns True if nobody but the user can create files in the directory.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+            not st.st_mode & 0o022)
+
+
+def is_trusted(path):
+    """Returns True if the socket was bound by the user, not anyone else."""
+    if not is_private_dir(os.path.dirname(path)):
+        return False
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Server closed the connection')
+        data += chunk
+    return bytes(data)
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def request(path, argv):
+    """Run the command on the server and relay its output.
+
+    Returns the exit code or None when there is no server to ask. A socket
+    of another user is never asked, it could answer anything.
+    """
+    if not is_trusted(path):
+        return None
+    sock = connect(path)
+    if sock is None:
+        return None
+
+    with sock:
+        sock.sendall(json.dumps({'argv': argv}).encode() + b'\n')
+        while True:
+            kind, size = FRAME.unpack(_recv_exactly(sock, FRAME.size))
+            payload = _recv_exactly(sock, size)
+            if kind == EXIT:
+                return None if payload == b'fallback' else int(payload)
+            stream = sys.stdout if kind == STDOUT else sys.stderr
+            stream.buffer.write(payload)
+            stream.flush()
@@ -0,0 +1,138 @@
+"""Concurrent is_modified() checks.
+
+Plain files are compared on a thread pool as the work is dominated by I/O.
+Plists have to be parsed and filtered which holds the GIL, so they go to a
+process pool. Results are produced in the same order as the input.
+"""
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import stat
+
+from . import plist
+from . import tracing
+
+
+def _plist_is_modified(cache_dir, home_path, dotfile_path, excluded_keys):
+    return plist.get_cache(cache_dir).is_modified(
+            home_path, dotfile_path, excluded_keys)
+
+
+class Comparator:
+    """Finds modified dotfiles using a pool of workers.
+
+    With jobs=1 everything is checked serially in the calling thread.
+    """
+
+    def __init__(self, config, index=None, jobs=None):
+        self.config = config
+        self.index = index
+        self.jobs = jobs if jobs is not None else config.jobs
+        self._threads = None
+        self._processes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for pool in (self._threads, self._processes):
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+        self._threads = self._processes = None
+
+    def is_modified(self, dotfile):
+        if self.index is not None:
+            return self.index.is_modified(dotfile)
+        return dotfile.is_modified()
+
+    def _thread_pool(self):
+        if self._threads is None:
+            self._threads = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.jobs,
+                    thread_name_prefix='dotfiles-compare')
+        return self._threads
+
+    def _process_pool(self):
+        if self._processes is None:
+            # Started lazily while the thread pool and fzf are running,
+            # forking a threaded process could deadlock the children
+            self._processes = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=min(self.jobs, os.cpu_count() or 1),
+                    mp_context=multiprocessing.get_context('forkserver'))
+        return self._processes
+
+    def _submit_plist(self, dotfile):
+        key, modified = None, None
+        if self.index is not None:
+            key, modified = self.index.lookup(dotfile)
+
+        if modified is not None:
+            future = concurrent.futures.Future()
+            future.set_result(modified)
+            return future
+
+        # Counted in the worker process, i.e. not at all
+        tracing.count('compare.plists_offloaded')
+        future = self._process_pool().submit(
+                _plist_is_modified,
+                self.config.cache_dir,
+                dotfile.home_path,
+                dotfile.dotfile_path,
+                self.config.get_plist_exclusions(dotfile.app_name))
+        if self.index is not None:
+            def record(future):
+                if future.exception() is None:
+                    self.index.record(dotfile, key, future.result())
+            future.add_done_callback(record)
+        return future
+
+    def _submit(self, dotfile):
+        tracing.count('compare.candidates')
+        if dotfile.is_plist:
+            home_stat = dotfile.home_stat()
+            dotfile_stat = dotfile.dotfile_stat()
+            if (home_stat is not None and stat.S_ISREG(home_stat.st_mode) and
+                dotfile_stat is not None and
+                stat.S_ISREG(dotfile_stat.st_mode)):
+                return self._submit_plist(dotfile)
+        return self._thread_pool().submit(self.is_modified, dotfile)
+
+    def modified(self, dotfiles, stop=None):
+        """Yield modified dotfiles in the order of the input.
+
+        Only a bounded number of checks is in flight, so the input can be a
+        lazy generator and the first results come out before the input is
+        exhausted. Setting the stop event abandons the remaining work.
+        """
+        if self.jobs <= 1:
+            for dotfile in dotfiles:
+                if stop is not None and stop.is_set():
+                    return
+                tracing.count('compare.candidates')
+                if self.is_modified(dotfile):
+                    yield dotfile
+            return
+
+        window = self.jobs * 4
+        pending = collections.deque()
+        for dotfile in dotfiles:
+            if stop is not None and stop.is_set():
+                return
+            pending.append((dotfile, self._submit(dotfile)))
+
+            while pending and (len(pending) >= window or pending[0][1].done()):
+                dotfile, future = pending.popleft()
+                if future.result():
+                    yield dotfile
+
+        while pending:
+            if stop is not None and stop.is_set():
+                return
+            dotfile, future = pending.popleft()
+            if future.result():
+                yield dotfile
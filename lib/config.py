@@ -1,8 +1,68 @@
+import copy
+import hashlib
+import marshal
 import os
+import stat
 import sys
-import yaml
+import time
 
-from .trie import TrieNode
+from . import tracing
+from .fsutil import RACY_WINDOW_NS, atomic_write
+from .matcher import ExclusionMatcher
+from .walker import Budget
+
+# Bump whenever the layout of the merged config changes
+_CACHE_VERSION = 2
+
+_SIZE_UNITS = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+
+def _merge(configs):
+    """Merges the parsed configs, later ones win."""
+    inclusions = []
+    exclusions = []
+    plist_exclusions = dict()
+    jobs = None
+    watch_budget = None
+    budgets = dict()
+    for config in configs:
+        for path in config.get('inclusions', []):
+            if path not in inclusions:
+                inclusions.append(path)
+
+        exclusions.extend(config.get('exclusions', []))
+
+        plist_exclusions.update({
+            key: set(values)
+            for key, values in config.get('plist_exclusions', {}).items()})
+
+        jobs = config.get('jobs', jobs)
+        watch_budget = config.get('watch_budget', watch_budget)
+        budgets.update(config.get('budgets') or {})
+
+    return {
+        'inclusions': inclusions,
+        'exclusions': exclusions,
+        'plist_exclusions': plist_exclusions,
+        'jobs': jobs,
+        'watch_budget': watch_budget,
+        'budgets': budgets,
+    }
+
+
+def _parse_size(value):
+    """Returns number of bytes of e.g. 1024, '512K' or '1.5G'."""
+    if value is None or isinstance(value, int):
+        return value
+    text = str(value).strip().upper().removesuffix('B')
+    multiplier = 1
+    if text[-1:] in _SIZE_UNITS:
+        multiplier = _SIZE_UNITS[text[-1]]
+        text = text[:-1]
+    try:
+        return int(float(text) * multiplier)
+    except ValueError:
+        raise Exception(f'Invalid size {value!r} in budgets') from None
 
 
 class Config:
@@ -12,25 +72,34 @@ class Config:
      - what .plist keys should be excluded
      - which paths should be forced for the inclusion although they aren't a
        typical dotfile
-    """
 
-    def __init__(self):
-        self._find_configs()
+    Parsing YAML dominates the startup of the short-lived commands fzf spawns,
+    so the merged result is cached in the cache dir. The cache is keyed on the
+    stat of every config.yaml and, when that changed, on their content.
+    """
 
-        self._inclusions = []
-        self._exclusions = TrieNode()
-        self._plist_exclusions = dict()
-        for config in self._configs:
-            for path in config.get('inclusions', []):
-                if path not in self._inclusions:
-                    self._inclusions.append(path)
+    def __init__(self, base_dir=None, home_dir=None):
+        self._base_dir = base_dir
+        self._home_dir = home_dir
+        self._cache_dir = None
+        with tracing.span('config'):
+            self._find_configs()
 
-            for path in config.get('exclusions', []):
-                self._exclusions.insert(path)
+            merged = self._load_cache()
+            if merged is None:
+                tracing.count('config.cache_misses')
+                with tracing.span('config.parse'):
+                    merged = self._parse()
+            else:
+                tracing.count('config.cache_hits')
 
-            self._plist_exclusions.update({
-                key: set(values)
-                for key, values in config.get('plist_exclusions', {}).items()})
+        self._inclusions = merged['inclusions']
+        self._exclusion_rules = merged['exclusions']
+        self._exclusions = ExclusionMatcher(self._exclusion_rules)
+        self._plist_exclusions = merged['plist_exclusions']
+        self._jobs = merged['jobs']
+        self._watch_budget = merged['watch_budget']
+        self._budgets = merged['budgets']
 
     def _find_configs(self):
         base_folder = self.base_dir
@@ -42,14 +111,10 @@ class Config:
             if os.path.isdir(subfolder):
                 folders.append(subfolder)
 
-        self.dotfiles = [os.path.join(folder, 'dotfiles')
-                         for folder in folders if os.path.exists(folder)]
-        self.scripts = [os.path.join(folder, 'scripts')
-                         for folder in folders if os.path.exists(folder)]
-
         self.dotfiles = []
         self.scripts = []
-        self._configs = []
+        self.config_paths = []
+        self._config_stamps = []
         for folder in folders:
             dotfile_folder = os.path.join(folder, 'dotfiles')
             if os.path.exists(dotfile_folder):
@@ -60,19 +125,153 @@ class Config:
                 self.scripts.append(scripts_folder)
 
             config_path = os.path.join(folder, 'config.yaml')
-            if os.path.isfile(config_path):
-                with open(config_path) as config_file:
-                    config = yaml.load(config_file, Loader=yaml.FullLoader)
-                    self._configs.append(config)
+            try:
+                st = os.stat(config_path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                self.config_paths.append(config_path)
+                self._config_stamps.append(
+                        (config_path, st.st_ino, st.st_size, st.st_mtime_ns))
+
+    @property
+    def _cache_path(self):
+        paths = '\0'.join(os.path.abspath(path) for path in self.config_paths)
+        key = hashlib.sha1(paths.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f'config-{key}.marshal')
+
+    def _read_configs(self):
+        """Returns [(path, content)] of the config files."""
+        contents = []
+        for path in self.config_paths:
+            with open(path, 'rb') as f:
+                contents.append((path, f.read()))
+        return contents
+
+    @staticmethod
+    def _digests(contents):
+        return [(path, hashlib.sha1(content).hexdigest())
+                for path, content in contents]
+
+    def _load_cache(self):
+        """Returns the merged config if still valid, None otherwise."""
+        try:
+            with open(self._cache_path, 'rb') as f:
+                data = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(data, dict) or data.get('version') != _CACHE_VERSION:
+            return None
+
+        stamps = self._config_stamps
+        # Changed this close to the cache write, the content is checked
+        racy = any(mtime_ns >= data['written_ns'] - RACY_WINDOW_NS
+                   for _, _, _, mtime_ns in stamps)
+        if data['stamps'] == stamps and not racy:
+            return data['merged']
+
+        # Touched or checked out again, still fine if the content is the same
+        try:
+            contents = self._read_configs()
+        except OSError:
+            return None
+        if data['digests'] != self._digests(contents):
+            return None
+        if data['stamps'] != stamps:
+            self._save_cache(contents, data['merged'])
+        return data['merged']
+
+    def _save_cache(self, contents, merged):
+        data = {
+            'version': _CACHE_VERSION,
+            'written_ns': time.time_ns(),
+            'stamps': self._config_stamps,
+            'digests': self._digests(contents),
+            'merged': merged,
+        }
+        try:
+            atomic_write(self._cache_path, marshal.dumps(data))
+        except OSError:
+            # Not being able to cache is no reason to fail
+            pass
+
+    def _parse(self):
+        # Imported here, the cache makes yaml unnecessary most of the time
+        import yaml
+
+        # The libyaml based loader is an order of magnitude faster
+        loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+        contents = self._read_configs()
+        merged = _merge(yaml.load(content, Loader=loader)
+                        for _, content in contents)
+        self._save_cache(contents, merged)
+        return merged
 
     @property
     def home_dir(self):
+        if self._home_dir is not None:
+            return self._home_dir
         return os.path.expanduser('~')
 
     @property
     def base_dir(self):
+        if self._base_dir is not None:
+            return self._base_dir
         return os.path.dirname(sys.argv[0])
 
+    def for_home(self, home_dir):
+        """Returns the same configuration applied to another home.
+
+        The cache dir stays the one of this config.
+        """
+        config = copy.copy(self)
+        config._cache_dir = self.cache_dir
+        config._home_dir = home_dir
+        return config
+
+    @property
+    def cache_dir(self):
+        if self._cache_dir is not None:
+            return self._cache_dir
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+                self.home_dir, '.cache')
+        return os.path.join(cache_home, 'dotfiles')
+
+    @property
+    def state_dir(self):
+        """Where the data which must survive clearing the cache is kept."""
+        state_home = os.environ.get('XDG_STATE_HOME') or os.path.join(
+                self.home_dir, '.local', 'state')
+        return os.path.join(state_home, 'dotfiles')
+
+    @property
+    def jobs(self):
+        """Number of concurrent workers.
+
+        Set by `jobs` in config.yaml, DOTFILES_JOBS environment variable wins.
+        """
+        jobs = os.environ.get('DOTFILES_JOBS') or self._jobs
+        if jobs:
+            return max(1, int(jobs))
+        return min(32, (os.cpu_count() or 1) + 4)
+
+    @property
+    def watch_budget(self):
+        """Maximum number of inotify watches, None for the default."""
+        return self._watch_budget
+
+    def budget(self):
+        """Returns a new walker.Budget of the home discovery.
+
+        Set by `budgets` in config.yaml: `max_file_size`, `max_dir_entries`
+        and `max_dir_size`, sizes may have a K, M or G suffix.
+        """
+        budgets = self._budgets
+        return Budget(
+                max_file_size=_parse_size(budgets.get('max_file_size')),
+                max_dir_entries=budgets.get('max_dir_entries'),
+                max_dir_size=_parse_size(budgets.get('max_dir_size')))
+
     def is_excluded(self, path):
         """Returns True if the path should be excluded.
 
@@ -81,10 +280,24 @@ class Config:
         """
         return self._exclusions.query(path)
 
+    @property
+    def exclusions(self):
+        """ExclusionMatcher of all the exclusions."""
+        return self._exclusions
+
+    @property
+    def exclusion_rules(self):
+        """Exclusions as listed in the configs, redundant ones included."""
+        return self._exclusion_rules
+
     def is_plist_excluded(self, app_name, key):
         """Returns True if the app excludes the given setting."""
         return key in self._plist_exclusions.get(app_name, set())
 
+    def get_plist_exclusions(self, app_name):
+        """Returns the set of settings the app excludes."""
+        return self._plist_exclusions.get(app_name, frozenset())
+
     def get_inclusions(self):
         """Returns the list of extra retained files"""
         return self._inclusions
@@ -1,7 +1,38 @@
-import difflib
+"""Coloured unified diff of two files.
+
+difflib.SequenceMatcher goes quadratic on large files with many repeated
+lines, such as plist XML or generated JSON. Lines are interned to integers
+instead and aligned with the patience algorithm: lines which occur exactly once
+on both sides are matched first (longest increasing subsequence) and the gaps
+in between are aligned recursively. Gaps without unique lines are anchored on
+unique runs of consecutive lines instead, and only small gaps without those
+fall back to difflib.
+
+Previews limited to a number of hunks align large ranges a window of lines at
+a time from their start, so the work is bounded by the lines up to the last
+shown hunk rather than by the size of the files. Their alignment is local to
+the windows, it can differ from the full diff on large files.
+"""
+
+import bisect
 import os
 import stat
 
+# Lines of context around the changes
+CONTEXT = 3
+
+# Hunks shown in the fzf preview, nobody scrolls further anyway
+PREVIEW_HUNKS = 100
+
+# Lines of both files searched for anchors at a time by the previews
+_PREVIEW_WINDOW = 1 << 10
+
+# Longest runs of lines tried as anchors in gaps without unique lines
+_MAX_WIDTH = 64
+
+# Largest gap, as a product of its sizes, given to difflib
+_MAX_FALLBACK_WORK = 1 << 18
+
 
 def _read_content(path):
     if os.path.exists(path):
@@ -27,8 +58,280 @@ def _read_content(path):
         return ''
 
 
-def diff(source_path, destination_path,
-         source_content=None, destination_content=None):
+def _mode_change(source_path, destination_path):
+    """Returns git style mode lines if only one of the files is executable."""
+    try:
+        source_mode = os.lstat(source_path).st_mode
+        destination_mode = os.lstat(destination_path).st_mode
+    except OSError:
+        return ''
+    if not stat.S_ISREG(source_mode) or not stat.S_ISREG(destination_mode):
+        return ''
+
+    old_mode, new_mode = (
+            '100755' if mode & stat.S_IXUSR else '100644'
+            for mode in (destination_mode, source_mode))
+    if old_mode == new_mode:
+        return ''
+    return f'old mode {old_mode}\nnew mode {new_mode}\n'
+
+
+def _intern(a_lines, b_lines):
+    """Replaces lines with integers, equal lines get equal numbers."""
+    ids = dict()
+    a = [ids.setdefault(line, len(ids)) for line in a_lines]
+    b = [ids.setdefault(line, len(ids)) for line in b_lines]
+    return a, b
+
+
+def _unique_lcs(a, b, alo, ahi, blo, bhi, width=1):
+    """Longest common subsequence of lines unique in both ranges.
+
+    With a width over 1, runs of that many lines are considered instead of
+    single lines. Returns the list of matching (i, j) pairs, the first lines
+    of the runs.
+    """
+    if width == 1:
+        a_keys = ((i, a[i]) for i in range(alo, ahi))
+        b_keys = ((j, b[j]) for j in range(blo, bhi))
+    else:
+        a_keys = ((i, tuple(a[i:i + width]))
+                  for i in range(alo, ahi - width + 1))
+        b_keys = ((j, tuple(b[j:j + width]))
+                  for j in range(blo, bhi - width + 1))
+
+    # Position of the line, None if it's there more than once
+    a_unique = dict()
+    for i, key in a_keys:
+        a_unique[key] = None if key in a_unique else i
+    b_unique = dict()
+    for j, key in b_keys:
+        b_unique[key] = None if key in b_unique else j
+
+    pairs = [(a_unique[key], j) for key, j in b_unique.items()
+             if j is not None and a_unique.get(key) is not None]
+    if not pairs:
+        return []
+    pairs.sort(key=lambda pair: pair[1])
+
+    # Patience sorting: top of every pile and the back pointers
+    tops = []
+    top_pairs = []
+    back = []
+    for pair in pairs:
+        pile = bisect.bisect_left(tops, pair[0])
+        if pile == len(tops):
+            tops.append(pair[0])
+            top_pairs.append(len(back))
+        else:
+            tops[pile] = pair[0]
+            top_pairs[pile] = len(back)
+        back.append((pair, top_pairs[pile - 1] if pile else None))
+
+    result = []
+    k = top_pairs[-1]
+    while k is not None:
+        pair, k = back[k]
+        result.append(pair)
+    result.reverse()
+    return result
+
+
+def _fallback(a, b, alo, ahi, blo, bhi):
+    """Matching (i, j) pairs of a gap where only frequent lines are common."""
+    if (ahi - alo) * (bhi - blo) > _MAX_FALLBACK_WORK:
+        # Show it all as replaced rather than spend quadratic time
+        return []
+
+    import difflib
+
+    matcher = difflib.SequenceMatcher(
+            None, a[alo:ahi], b[blo:bhi], autojunk=False)
+    return [(alo + i + k, blo + j + k)
+            for i, j, size in matcher.get_matching_blocks()
+            for k in range(size)]
+
+
+def _anchors(a, b, alo, ahi, blo, bhi):
+    """Matching (i, j) pairs to split the range at, empty if none."""
+    anchors = _unique_lcs(a, b, alo, ahi, blo, bhi)
+    width = 1
+    while not anchors and width < _MAX_WIDTH:
+        # Only frequent lines, runs of them may still be unique
+        width *= 4
+        if width > min(ahi - alo, bhi - blo):
+            break
+        anchors = _unique_lcs(a, b, alo, ahi, blo, bhi, width)
+    return anchors
+
+
+def _matches(a, b, window=None):
+    """Yields matching (i, j) line pairs in increasing order.
+
+    With a window, ranges larger than that are anchored within their leading
+    window of lines only, doubled until it has some anchors.
+    """
+    # Ranges to align (alo, ahi, blo, bhi) and pairs (i, j) found meanwhile,
+    # the top of the stack is always the next one in order
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        item = stack.pop()
+        if len(item) == 2:
+            yield item
+            continue
+
+        alo, ahi, blo, bhi = item
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            yield alo, blo
+            alo += 1
+            blo += 1
+
+        anchors = None
+        size = window
+        while size is not None and max(ahi - alo, bhi - blo) > size:
+            # The rest of the range is aligned after the last anchor
+            anchors = _anchors(a, b, alo, min(ahi, alo + size),
+                               blo, min(bhi, blo + size))
+            if anchors:
+                break
+            size *= 2
+        if not anchors:
+            while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+                ahi -= 1
+                bhi -= 1
+                stack.append((ahi, bhi))
+            if alo == ahi or blo == bhi:
+                continue
+            anchors = _anchors(a, b, alo, ahi, blo, bhi)
+        if not anchors:
+            stack.extend(reversed(_fallback(a, b, alo, ahi, blo, bhi)))
+            continue
+
+        for i, j in reversed(anchors):
+            stack.append((i + 1, ahi, j + 1, bhi))
+            stack.append((i, j))
+            ahi, bhi = i, j
+        stack.append((alo, ahi, blo, bhi))
+
+
+def _opcodes(a, b, window=None):
+    """Yields (tag, i1, i2, j1, j2) like SequenceMatcher.get_opcodes()."""
+    i = j = 0
+    equal_from = None
+    for mi, mj in _matches(a, b, window):
+        if mi == i and mj == j:
+            if equal_from is None:
+                equal_from = (i, j)
+        else:
+            if equal_from is not None:
+                yield 'equal', equal_from[0], i, equal_from[1], j
+                equal_from = None
+            if mi > i and mj > j:
+                yield 'replace', i, mi, j, mj
+            elif mi > i:
+                yield 'delete', i, mi, j, mj
+            else:
+                yield 'insert', i, mi, j, mj
+            equal_from = (mi, mj)
+        i, j = mi + 1, mj + 1
+
+    if equal_from is not None:
+        yield 'equal', equal_from[0], i, equal_from[1], j
+    if i < len(a) or j < len(b):
+        tag = ('replace' if i < len(a) and j < len(b) else
+               'delete' if i < len(a) else 'insert')
+        yield tag, i, len(a), j, len(b)
+
+
+def _grouped_opcodes(opcodes, n=CONTEXT):
+    """Yields hunks with up to n lines of context.
+
+    Same as SequenceMatcher.get_grouped_opcodes() but consumes the opcodes
+    lazily.
+    """
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            if group and i2 - i1 <= 2 * n:
+                group.append((tag, i1, i2, j1, j2))
+                continue
+            if group:
+                group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+                yield group
+            # Leading context of the next hunk
+            group = [(tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2)]
+        else:
+            group.append((tag, i1, i2, j1, j2))
+
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        tag, i1, i2, j1, j2 = group[-1]
+        if tag == 'equal':
+            group[-1] = (tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n))
+        yield group
+
+
+def _format_range(start, stop):
+    """Range of a hunk header, same as difflib."""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f'{beginning}'
+    if not length:
+        beginning -= 1
+    return f'{beginning},{length}'
+
+
+def _colored(line):
+    if line.startswith('+'):
+        return f'\033[38;5;64m{line}\033[0m'
+    elif line.startswith('-'):
+        return f'\033[38;5;124m{line}\033[0m'
+    elif line.startswith('@@ '):
+        return f'\033[38;5;33m{line}\033[0m'
+    return line
+
+
+def _unified_hunks(a_lines, b_lines, fromfile, tofile, max_hunks=None):
+    """Yields coloured unified diff of the lines, hunk by hunk."""
+    if max_hunks is None:
+        a, b = _intern(a_lines, b_lines)
+        hunks = _grouped_opcodes(_opcodes(a, b))
+    else:
+        # Interning would go through all the lines, compare them as they are
+        hunks = _grouped_opcodes(_opcodes(a_lines, b_lines, _PREVIEW_WINDOW))
+
+    shown = 0
+    for group in hunks:
+        if max_hunks is not None and shown >= max_hunks:
+            # Not counted, that would align the rest of the files
+            yield '... more hunks\n'
+            return
+
+        lines = []
+        if not shown:
+            lines.append(_colored(f'--- {fromfile}\n'))
+            lines.append(_colored(f'+++ {tofile}\n'))
+
+        first, last = group[0], group[-1]
+        lines.append(_colored(
+            f'@@ -{_format_range(first[1], last[2])} '
+            f'+{_format_range(first[3], last[4])} @@\n'))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines.extend(f' {line}\n' for line in a_lines[i1:i2])
+                continue
+            lines.extend(_colored(f'-{line}\n') for line in a_lines[i1:i2])
+            lines.extend(_colored(f'+{line}\n') for line in b_lines[j1:j2])
+        yield ''.join(lines)
+        shown += 1
+
+
+def iter_diff(source_path, destination_path,
+              source_content=None, destination_content=None, max_hunks=None):
+    """Yields the diff hunk by hunk, see diff()."""
+    mode_change = _mode_change(source_path, destination_path)
+    if mode_change:
+        yield mode_change
 
     if source_content is None:
         source_content = _read_content(source_path)
@@ -43,22 +346,18 @@ def diff(source_path, destination_path,
       if isinstance(destination_content, bytes):
         destination_content = destination_content.decode()
     except UnicodeDecodeError:
-      return 'Binary files'
-
-    lines = []
-    source_content = [line + '\n' for line in source_content.splitlines()]
-    destination_content = [
-            line + '\n' for line in destination_content.splitlines()]
-
-    for line in difflib.unified_diff(
-            destination_content, source_content,
-            fromfile=source_path, tofile=destination_path):
-        if line.startswith('+'):
-            line = f'\033[38;5;64m{line}\033[0m'
-        elif line.startswith('-'):
-            line = f'\033[38;5;124m{line}\033[0m'
-        elif line.startswith('@@ '):
-            line = f'\033[38;5;33m{line}\033[0m'
-        lines.append(line)
-
-    return ''.join(lines)
+      yield 'Binary files'
+      return
+
+    yield from _unified_hunks(
+            destination_content.splitlines(), source_content.splitlines(),
+            fromfile=source_path, tofile=destination_path,
+            max_hunks=max_hunks)
+
+
+def diff(source_path, destination_path,
+         source_content=None, destination_content=None, max_hunks=None):
+    """Returns the coloured diff, at most max_hunks hunks of it."""
+    return ''.join(iter_diff(
+            source_path, destination_path,
+            source_content, destination_content, max_hunks))
@@ -0,0 +1,165 @@
+"""Rendered diffs for the fzf previews.
+
+Every highlighted entry in fzf runs `management.py diff`. While fzf is open,
+the diffs of the listed entries are rendered ahead of time on a process pool,
+in the order fzf shows them, into an on-disk cache. The preview then only
+copies the cached bytes and renders on its own only on a miss.
+
+Entries are keyed on the stat of both copies, so a changed file never hits a
+stale diff. The cache is bounded by size, least recently used entries go
+first.
+"""
+
+import hashlib
+import os
+import time
+
+from . import tracing
+from .diff import PREVIEW_HUNKS
+from .dotfile import DotFile
+from .fsutil import RACY_WINDOW_NS, atomic_write
+from .index import signature
+
+VERSION = 4
+
+# Total size of the cached diffs
+MAX_SIZE = 64 * 2**20
+
+
+class DiffCache:
+
+    def __init__(self, config, max_size=MAX_SIZE):
+        self.config = config
+        self.max_size = max_size
+        self.path = os.path.join(config.cache_dir, 'diffs')
+
+    def _key(self, dotfile, direction):
+        """Returns the cache file name or None if the diff can't be cached."""
+        home_sig = signature(dotfile.home_path)
+        dotfile_sig = signature(dotfile.dotfile_path)
+        # Files changed this recently may change again unnoticed
+        racy_ns = time.time_ns() - RACY_WINDOW_NS
+        for sig in (home_sig, dotfile_sig):
+            if sig is not None and sig[2] >= racy_ns:
+                return None
+
+        excluded_keys = None
+        if dotfile.is_plist:
+            excluded_keys = sorted(
+                    self.config.get_plist_exclusions(dotfile.app_name))
+
+        key = repr((VERSION, PREVIEW_HUNKS, direction,
+                    dotfile.home_path, home_sig,
+                    dotfile.dotfile_path, dotfile_sig, excluded_keys))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, dotfile, direction):
+        """Returns the cached diff or None."""
+        key = self._key(dotfile, direction)
+        if key is None:
+            return None
+        return self._get(key)
+
+    def _get(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            # The mtime is the last use for the eviction
+            os.utime(path)
+        except OSError:
+            return None
+        return content
+
+    def render(self, dotfile, direction):
+        """Returns the diff, from the cache if possible."""
+        key = self._key(dotfile, direction)
+        if key is not None:
+            content = self._get(key)
+            if content is not None:
+                tracing.count('diffcache.hits')
+                return content
+        tracing.count('diffcache.misses')
+
+        content = (dotfile.diff(direction, PREVIEW_HUNKS) + '\n').encode()
+        if key is not None:
+            self._store(key, content)
+        return content
+
+    def _store(self, key, content):
+        try:
+            atomic_write(os.path.join(self.path, key), content)
+        except OSError:
+            # Not being able to cache is no reason to fail the preview
+            pass
+
+    def trim(self):
+        """Evicts least recently used diffs over the size limit."""
+        try:
+            with os.scandir(self.path) as it:
+                entries = [(entry.stat().st_mtime_ns, entry.stat().st_size,
+                            entry.path) for entry in it]
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+_worker_cache = None
+
+
+def _init_worker(config):
+    global _worker_cache
+    _worker_cache = DiffCache(config)
+
+
+def _prerender(name, direction):
+    dotfile = DotFile.discover(_worker_cache.config, name)
+    _worker_cache.render(dotfile, direction)
+
+
+class Prerenderer:
+    """Renders diffs into the cache in the background, in submission order."""
+
+    def __init__(self, config, direction, jobs=None):
+        # Not needed by the previews which only read the cache
+        import concurrent.futures
+        import multiprocessing
+
+        self.cache = DiffCache(config)
+        self.direction = direction
+        if jobs is None:
+            # Leave the rest for the scan which runs at the same time
+            jobs = max(1, min(config.jobs, (os.cpu_count() or 1) // 2))
+        # Created while the scan threads run, forking them could deadlock
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs,
+                mp_context=multiprocessing.get_context('forkserver'),
+                initializer=_init_worker, initargs=(config,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, name):
+        self._pool.submit(_prerender, name, self.direction)
+
+    def prerendered(self, names):
+        """Passes the names through, rendering their diffs meanwhile."""
+        for name in names:
+            self.submit(name)
+            yield name
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self.cache.trim()
@@ -1,31 +1,115 @@
+import array
 import os
-import plistlib
-import shutil
+import stat
 import sys
 
+from . import tracing
+from . import walker
 from .diff import diff
+from .fsutil import is_staged
+from .index import content_differs, mode_differs
+from .overlay import get_overlay
+
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+class CandidateTable:
+    """Dotfiles discovered in one home, one row per name.
+
+    Rows are columns of interned relative names and layer indexes, the paths
+    are put together only when asked for. For names which aren't in the
+    repo, the layer is the one they would be added to.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.home_prefix = os.path.join(config.home_dir, '')
+        self.layer_prefixes = [os.path.join(dotfiles_dir, '')
+                               for dotfiles_dir in config.dotfiles]
+        self.names = []
+        self.layers = array.array('B')
+        # Name: row
+        self._rows = dict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def add(self, name, layer=0):
+        """Adds the row, returns its DotFile."""
+        name = sys.intern(name)
+        row = self._rows[name] = len(self.names)
+        self.names.append(name)
+        self.layers.append(layer)
+        return DotFile(self, row)
+
 
 class DotFile:
+    """View of a CandidateTable row.
+
+    The lstat() of both copies is done at most once per view, the table
+    doesn't keep them, views of the modified dotfiles are usually the only
+    ones which live on.
+    """
+
+    __slots__ = ('_table', '_row', '_home_stat', '_dotfile_stat')
 
     MAC_PREFERENCES_SUFFIX = '.plist'
 
-    def __init__(self, name, home_path, dotfile_path, config):
-        self.name = name
-        self.home_path = home_path
-        self.dotfile_path = dotfile_path
-        self.config = config
+    # Not looked up yet, None means missing
+    _UNKNOWN = object()
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+        self._home_stat = self._UNKNOWN
+        self._dotfile_stat = self._UNKNOWN
+
+    @classmethod
+    def create(cls, config, name, layer=0):
+        """Returns a dotfile of its own table, for single name lookups."""
+        return CandidateTable(config).add(name, layer)
 
     @classmethod
     def discover(cls, config, name):
         """Find the matching dotfile."""
-        home_path = os.path.join(config.home_dir, name)
-        for dotfiles_dir in reversed(config.dotfiles):
-            dotfile_path = os.path.join(dotfiles_dir, name)
-            if os.path.exists(dotfile_path):
-                return cls(name, home_path, dotfile_path, config)
+        return cls.create(config, name, get_overlay(config).layer(name))
+
+    @property
+    def name(self):
+        return self._table.names[self._row]
 
-        default_dotfile_path = os.path.join(config.dotfiles[0], name)
-        return cls(name, home_path, default_dotfile_path, config)
+    @property
+    def config(self):
+        return self._table.config
+
+    @property
+    def home_path(self):
+        return self._table.home_prefix + self.name
+
+    @property
+    def dotfile_path(self):
+        table = self._table
+        return table.layer_prefixes[table.layers[self._row]] + self.name
+
+    def home_stat(self):
+        """Returns lstat() of the home copy or None if it's missing."""
+        if self._home_stat is self._UNKNOWN:
+            self._home_stat = _lstat(self.home_path)
+        return self._home_stat
+
+    def dotfile_stat(self):
+        """Returns lstat() of the repo copy or None if it's missing."""
+        if self._dotfile_stat is self._UNKNOWN:
+            self._dotfile_stat = _lstat(self.dotfile_path)
+        return self._dotfile_stat
 
     def __repr__(self):
         return f'<{self.__class__.__name__}({self.name})>'
@@ -48,64 +132,67 @@ class DotFile:
         return self.is_macos_only and self.name.endswith(
                 self.MAC_PREFERENCES_SUFFIX)
 
-    @classmethod
-    def _create_folders(cls, path):
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-
-    def _filtered_source_plist(self):
-        """Filter out settings that we don't care about."""
-        if not os.path.exists(self.home_path):
-            return ''
-
-        with open(self.home_path, 'rb') as f:
-            settings = plistlib.load(f)
-
+    @property
+    def app_name(self):
         app_name = os.path.basename(self.home_path)
         assert app_name.endswith(self.MAC_PREFERENCES_SUFFIX), (
                 'Invalid app name: %s' % app_name)
-        app_name = app_name[:-len(self.MAC_PREFERENCES_SUFFIX)]
+        return app_name[:-len(self.MAC_PREFERENCES_SUFFIX)]
 
-        for key in list(settings.keys()):
-            if self.config.is_plist_excluded(app_name, key):
-                del settings[key]
+    def _plist_cache(self):
+        from . import plist
 
-        return plistlib.dumps(settings, fmt=plistlib.FMT_XML).decode()
+        return plist.get_cache(self.config.cache_dir)
+
+    def _filtered_source_plist(self):
+        """Filter out settings that we don't care about."""
+        filtered = self._plist_cache().filtered(
+                self.home_path,
+                self.config.get_plist_exclusions(self.app_name))
+        if filtered is None:
+            return ''
+        return filtered[0]
 
     def is_modified(self):
         """Returns True if the file is not logically same."""
-        if (not os.path.exists(self.home_path) or
-            not os.path.exists(self.dotfile_path)):
+        home_stat = self.home_stat()
+        dotfile_stat = self.dotfile_stat()
+        if home_stat is None or dotfile_stat is None:
             return True
 
-        is_home_link = os.path.islink(self.home_path)
-        is_dotfile_link = os.path.islink(self.dotfile_path)
+        is_home_link = stat.S_ISLNK(home_stat.st_mode)
+        is_dotfile_link = stat.S_ISLNK(dotfile_stat.st_mode)
         if is_home_link or is_dotfile_link:
             # One of them is not a link
             if not is_home_link or not is_dotfile_link:
                 return True
+            # Links which don't resolve are always listed
+            if (not os.path.exists(self.home_path) or
+                not os.path.exists(self.dotfile_path)):
+                return True
 
             home_link = os.readlink(self.home_path)
             dotfile_link = os.readlink(self.dotfile_path)
             return home_link != dotfile_link
         elif self.is_plist:
-            with open(self.dotfile_path) as f:
-                dotfile_content = f.read()
-            return self._filtered_source_plist() != dotfile_content
+            return self._plist_cache().is_modified(
+                    self.home_path,
+                    self.dotfile_path,
+                    self.config.get_plist_exclusions(self.app_name))
         else:
-            # TODO: check permissions
-            with open(self.home_path, 'rb') as f:
-                home_content = f.read()
-            with open(self.dotfile_path, 'rb') as f:
-                dotfile_content = f.read()
-            return home_content != dotfile_content
+            # Quick check of the metadata before reading anything
+            if (home_stat.st_size != dotfile_stat.st_size or
+                mode_differs(home_stat.st_mode, dotfile_stat.st_mode)):
+                return True
+            return content_differs(self.home_path, self.dotfile_path)
 
-    def diff(self, direction):
-        """Return diff of the contents."""
+    def diff(self, direction, max_hunks=None):
+        """Return diff of the contents, at most max_hunks hunks of it."""
+        with tracing.span('diff'):
+            return self._diff(direction, max_hunks)
 
+    def _diff(self, direction, max_hunks):
         home_content, dotfile_content = None, None
-
-        home_exists = os.path.exists(self.home_path)
-        dotfile_exists = os.path.exists(self.dotfile_path)
         # TODO: deal with permissions
 
         if self.is_plist:
@@ -116,17 +203,22 @@ class DotFile:
                     source_path=self.home_path,
                     source_content=home_content,
                     destination_path=self.dotfile_path,
-                    destination_content=dotfile_content)
+                    destination_content=dotfile_content,
+                    max_hunks=max_hunks)
         elif direction == 'home':
             return diff(
                     source_path=self.dotfile_path,
                     source_content=dotfile_content,
                     destination_path=self.home_path,
-                    destination_content=home_content)
+                    destination_content=home_content,
+                    max_hunks=max_hunks)
         else:
             raise Exception(f'Unknown diff direction {direction}')
 
-    def move(self, direction):
+    def operation(self, direction):
+        """Returns the apply.Operation moving the file in the direction."""
+        from .apply import Operation
+
         if direction == 'dotfiles':
             source, destination = self.home_path, self.dotfile_path
         elif direction == 'home':
@@ -135,140 +227,178 @@ class DotFile:
             raise Exception(f'Unknown diff direction {direction}')
 
         if not os.path.exists(source):
-            os.unlink(destination)
-            return
+            return Operation.delete(destination)
 
         if os.path.islink(source):
-            content = os.readlink(source)
-            if os.path.exists(destination):
-                if (not os.path.islink(destination) or
-                    content != os.readlink(destination)):
-                    os.unlink(destination)
-                    os.symlink(content, destination)
-            else:
-                self._create_folders(destination)
-                os.symlink(content, destination)
-
-            source_stat = os.lstat(source)
-            destination_stat = os.lstat(destination)
-            if source_stat.st_mode != destination_stat.st_mode:
-                os.chmod(destination, source_stat.st_mode)
+            return Operation.symlink(os.readlink(source), destination)
         elif self.is_plist:
             if direction == 'dotfiles':
-                content = self._filtered_source_plist()
-                self._create_folders(destination)
-                with open(destination, 'w') as f:
-                    f.write(content)
-            elif direction == 'home':
+                content = self._filtered_source_plist().encode()
+            else:
+                import plistlib
+
                 with open(source, 'rb') as f:
                     settings = plistlib.load(f)
-                os.makedirs(os.path.dirname(destination), exist_ok=True)
-                with open(destination, 'wb') as f:
-                    plistlib.dump(settings, f, fmt=plistlib.FMT_BINARY)
+                content = plistlib.dumps(settings, fmt=plistlib.FMT_BINARY)
+            return Operation.write(content, destination)
         else:
-            self._create_folders(destination)
-            shutil.copy2(source, destination, follow_symlinks=False)
+            return Operation.copy(source, destination)
 
+    def move(self, direction):
+        from . import apply
 
-def discover_home_dotfiles(config):
-    """Discover all dotfiles in home directory."""
-    dotfiles = dict()
-    home_dir = config.home_dir
-    default_dotfiles_dir = config.dotfiles[0]
+        apply.apply(self.config, [self.operation(direction)])
 
-    # Files that exist in the repo but might not be considered regular dotfile.
-    for dotfiles_dir in config.dotfiles:
-        for dirpath, dirnames, filenames in os.walk(dotfiles_dir):
-            for filename in filenames + dirnames:
-                dotfile_path = os.path.join(dirpath, filename)
-
-                if os.path.isfile(dotfile_path) or os.path.islink(dotfile_path):
-                    name = os.path.relpath(dotfile_path, dotfiles_dir)
-                    home_path = os.path.join(home_dir, name)
-                    if os.path.exists(home_path):
-                        dotfiles[name] = DotFile(
-                                name, home_path, dotfile_path, config)
 
-    # Explicitly included configs
-    for extra_folder in config.get_inclusions():
-        extra_folder = os.path.join(home_dir, extra_folder)
-        for dirpath, _, filenames in os.walk(extra_folder):
-            for filename in filenames:
-                home_path = os.path.join(dirpath, filename)
-                name = os.path.relpath(home_path, home_dir)
-                dotfile_path = os.path.join(default_dotfiles_dir, name)
-                if config.is_excluded(name):
-                    continue
-
-                if name not in dotfiles:
-                    dotfiles[name] = DotFile(
-                            name, home_path, dotfile_path, config)
-
-    for dirpath, dirnames, filenames in os.walk(home_dir, topdown=True):
-        is_home_folder = os.path.samefile(home_dir, dirpath)
-
-        # Limit which directories os.walk() should go into. This speeds up the
-        # process drastically as we don't have to process potentially large
-        # non-dotfiles directories
-        dirnames[:] = [name for name in dirnames if
-                       # Ignore non dotfiles directories, e.g. ~/Downloads/ but
-                       # go through ~/.config/myapp
-                       (name.startswith('.') or not is_home_folder) and
-                       # Ignore .git modules files
-                       name != '.git' and
-                       # Exclude path prefixes as soon as possible
-                       not config.is_excluded(
-                           os.path.relpath(
-                               os.path.join(dirpath, name), home_dir) + '/')]
-
-        for dirname in dirnames:
-            home_path = os.path.join(dirpath, dirname)
-            name = os.path.relpath(home_path, home_dir)
-            dotfile_path = os.path.join(default_dotfiles_dir, name)
-
-            if config.is_excluded(name):
-                continue
+def _inclusion_prefixes(config):
+    return [os.path.join(os.path.normpath(extra_folder), '')
+            for extra_folder in config.get_inclusions()]
 
-            if os.path.islink(home_path) and name not in dotfiles:
-                dotfiles[name] = DotFile(
-                        name, home_path, dotfile_path, config)
 
-        for filename in filenames:
-            home_path = os.path.join(dirpath, filename)
-            name = os.path.relpath(home_path, home_dir)
-            dotfile_path = os.path.join(default_dotfiles_dir, name)
-            if config.is_excluded(name):
-                continue
-            if is_home_folder and not filename.startswith('.'):
-                continue
-            if name not in dotfiles:
-                dotfiles[name] = DotFile(
-                        name, home_path, dotfile_path, config)
+def is_home_subdir(entry):
+    """Returns True if the home walk should go into the directory.
+
+    Limiting which directories the walk goes into speeds up the process
+    drastically as we don't have to process potentially large non-dotfiles
+    directories. Excluded paths are skipped by the walker itself.
+    """
+    name = entry.name
+    return (
+        # Ignore non dotfiles directories, e.g. ~/Downloads/ but
+        # go through ~/.config/myapp
+        (name.startswith('.') or '/' in name) and
+        # Ignore .git modules files
+        name != '.git' and not name.endswith('/.git'))
 
-    return dotfiles.values()
 
+def discover_home_dotfiles(config, index=None, budget=None):
+    """Discover all dotfiles in home directory.
 
-def discover_dotfiles(config):
-    """Discover already existing dotfiles."""
-    dotfiles = dict()
-    home_dir = config.home_dir
-    default_dotfiles_dir = config.dotfiles[0]
+    This is a generator: every dotfile is yielded once, as soon as it is found,
+    so that the caller can start working before the walk is over. Within a
+    directory, the entries are yielded in alphabetical order.
+
+    When a ScanIndex is given, listings of unchanged directories are reused.
+    Files and directories over the walker.Budget, config.budget() by default,
+    are left out and recorded in it.
+    """
+    if budget is None:
+        budget = config.budget()
+    table = CandidateTable(config)
+    home_dir = table.home_prefix
 
     # Files that exist in the repo but might not be considered regular dotfile.
-    for dotfiles_dir in config.dotfiles:
-        for dirpath, dirnames, filenames in os.walk(dotfiles_dir):
-            for filename in filenames + dirnames:
-                dotfile_path = os.path.join(dirpath, filename)
+    # Later layers have higher priority.
+    for name, layer in get_overlay(config, index).layer_items():
+        if os.path.exists(home_dir + name):
+            yield table.add(name, layer)
+
+    # Explicitly included configs
+    for prefix in _inclusion_prefixes(config):
+        for entry in walker.walk(home_dir + prefix, prefix=prefix,
+                                 index=index, exclude=config.exclusions,
+                                 budget=budget):
+            if not entry.is_dir and entry.name not in table:
+                yield table.add(entry.name)
+
+    for entry in walker.walk(home_dir, descend=is_home_subdir, index=index,
+                             exclude=config.exclusions, budget=budget):
+        name = entry.name
+        if entry.is_dir:
+            # Symlinked directories are dotfiles on their own
+            if not entry.is_link or not is_home_subdir(entry):
+                continue
+        elif '/' not in name and not name.startswith('.'):
+            continue
 
-                if os.path.isfile(dotfile_path) or os.path.islink(dotfile_path):
-                    name = os.path.relpath(dotfile_path, dotfiles_dir)
-                    home_path = os.path.join(home_dir, name)
+        if name not in table:
+            yield table.add(name)
 
-                    dotfile = DotFile(name, home_path, dotfile_path, config)
-                    if dotfile.is_macos_only and sys.platform != 'darwin':
-                        print(f'Skipping {dotfile_path}')
-                        continue
 
-                    dotfiles[name] = dotfile
+def discover_dotfiles(config, index=None):
+    """Discover already existing dotfiles.
 
-    return dotfiles.values()
+    Generator, same as discover_home_dotfiles().
+    """
+    table = CandidateTable(config)
+
+    # Files that exist in the repo but might not be considered regular dotfile.
+    # Later layers have higher priority.
+    for name, layer in get_overlay(config, index).layer_items():
+        dotfile = table.add(name, layer)
+        if dotfile.is_macos_only and sys.platform != 'darwin':
+            # stdout is reserved for the list of files
+            print(f'Skipping {dotfile.dotfile_path}', file=sys.stderr)
+            continue
+        yield dotfile
+
+
+def _has_linked_parent(root, name):
+    path = root
+    for part in name.split('/')[:-1]:
+        path = os.path.join(path, part)
+        if os.path.islink(path):
+            return True
+    return False
+
+
+def find_home_dotfile(config, name):
+    """Returns the DotFile if discover_home_dotfiles() would yield it.
+
+    Single name version of the discovery for incremental updates.
+    """
+    if is_staged(os.path.basename(name)):
+        return None
+    home_path = os.path.join(config.home_dir, name)
+    for layer in reversed(range(len(config.dotfiles))):
+        dotfile_path = os.path.join(config.dotfiles[layer], name)
+        if ((os.path.islink(dotfile_path) or os.path.isfile(dotfile_path))
+            and os.path.exists(home_path)):
+            return DotFile.create(config, name, layer)
+
+    if not os.path.lexists(home_path):
+        return None
+
+    is_dir = os.path.isdir(home_path)
+    is_link = os.path.islink(home_path)
+    if config.is_excluded(name + '/' if is_dir else name):
+        return None
+    max_file_size = config.budget().max_file_size
+    if (max_file_size is not None and not is_dir and not is_link and
+        os.lstat(home_path).st_size > max_file_size):
+        # The entry and size limits of directories are left to the full scan
+        return None
+
+    for prefix in _inclusion_prefixes(config):
+        if (not is_dir and name.startswith(prefix) and
+            not _has_linked_parent(os.path.join(config.home_dir, prefix),
+                                   name[len(prefix):])):
+            return DotFile.create(config, name)
+
+    if is_dir and not is_link:
+        return None
+
+    parts = name.split('/')
+    if not parts[0].startswith('.') or '.git' in parts[:-1]:
+        return None
+    if is_dir and parts[-1] == '.git':
+        return None
+    if _has_linked_parent(config.home_dir, name):
+        # The walk doesn't follow symlinks
+        return None
+
+    return DotFile.create(config, name)
+
+
+def find_dotfile(config, name):
+    """Returns the DotFile if discover_dotfiles() would yield it."""
+    if is_staged(os.path.basename(name)):
+        return None
+    for layer in reversed(range(len(config.dotfiles))):
+        dotfile_path = os.path.join(config.dotfiles[layer], name)
+        if os.path.islink(dotfile_path) or os.path.isfile(dotfile_path):
+            dotfile = DotFile.create(config, name, layer)
+            if dotfile.is_macos_only and sys.platform != 'darwin':
+                return None
+            return dotfile
+    return None
@@ -0,0 +1,61 @@
+"""Stand-ins for Config and DotFile and file helpers shared by the tests."""
+
+import os
+
+
+def write(root, name, content):
+    """Writes the text file root/name, missing directories are created."""
+    path = os.path.join(root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def age(root):
+    """Move all mtimes under root out of the racy window, except of .git."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if '.git' not in path.split(os.sep):
+                os.utime(path, (1, 1), follow_symlinks=False)
+
+
+class FakeConfig:
+    """Config of a checkout in root/repo, or in root itself."""
+
+    def __init__(self, root, repo=''):
+        self.home_dir = os.path.join(root, 'home')
+        self.dotfiles = [os.path.join(root, repo, 'dotfiles')]
+        self.cache_dir = os.path.join(root, 'cache')
+        self.state_dir = os.path.join(root, 'state')
+        self.config_paths = [os.path.join(root, repo, 'config.yaml')]
+        self.jobs = 2
+
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+class FakeDotFile:
+    """Dotfile of the only layer, always modified when really compared."""
+
+    is_plist = False
+
+    def __init__(self, config, name):
+        self.name = name
+        self.home_path = os.path.join(config.home_dir, name)
+        self.dotfile_path = os.path.join(config.dotfiles[0], name)
+        self.calls = 0
+
+    def home_stat(self):
+        return _lstat(self.home_path)
+
+    def dotfile_stat(self):
+        return _lstat(self.dotfile_path)
+
+    def is_modified(self):
+        self.calls += 1
+        return True
@@ -0,0 +1,68 @@
+"""Writing of the cache, state and journal files, and of staged copies.
+
+Kept free of other imports, the config loads it on every start.
+"""
+
+import os
+import re
+
+# Files changed this close to a scan can change again within the timestamp
+# granularity of the filesystem without a visible mtime change. Anything
+# cached about such files is never trusted (same idea as the "racy clean"
+# check of git).
+RACY_WINDOW_NS = 2 * 10**9
+
+# Copies staged next to their destinations by apply.py and the backups of
+# the originals, left behind only if the process was killed
+_STAGED_RE = re.compile(r'\A\..*\.dotfiles-\d+\.(?:tmp|bak)\Z', re.DOTALL)
+
+
+def fsync_dir(path):
+    """Makes the renames in the directory durable, where supported."""
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def staged_path(path, kind):
+    """Returns the path of the staged copy ('tmp') or backup ('bak')."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{name}.dotfiles-{os.getpid()}.{kind}')
+
+
+def is_staged(name):
+    """Returns True for a file name made by staged_path()."""
+    return name.endswith(('.tmp', '.bak')) and bool(_STAGED_RE.match(name))
+
+
+def atomic_write(path, data, durable=False):
+    """Replaces the file with the bytes, readers see either old or new.
+
+    Missing directories are created. With durable, the content and the rename
+    are on disk when it returns.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    if durable:
+        fsync_dir(directory)
@@ -0,0 +1,429 @@
+"""Reader of the git index of the repos holding the dotfiles layers.
+
+Git keeps the object id of every tracked file together with the stat data the
+file had when it was hashed. A repo copy whose lstat still matches its index
+entry has that object id, so comparing it with home only needs the blob hash
+of the home copy, the repo copy isn't read at all.
+
+The index file is parsed directly (versions 2 to 4), no git process is
+started. The entries are loaded once, a stale index only means fewer matching
+entries: a file matching the stat data of an old entry still has its content.
+Entries at least as new as the index file itself are "racily clean" and
+ignored, same as git does. Split indexes aren't supported.
+
+The object id is of the content after the conversions git does when adding a
+file: line endings with core.autocrlf or the text and eol attributes, clean
+filters such as git-crypt. Repos with core.autocrlf and the files with such
+attributes are left out, they're compared byte by byte. The config and
+attributes files are read without evaluating all of their syntax, anything
+unclear counts as converting.
+"""
+
+import fnmatch
+import hashlib
+import os
+import stat
+import struct
+import threading
+
+try:
+    from . import tracing
+except ImportError:
+    # Imported as a top-level module by the tests
+    import tracing
+
+_HEADER = struct.Struct('>4sII')
+# ctime s, ns, mtime s, ns, dev, ino, mode, uid, gid, size
+_STAT = struct.Struct('>10I')
+_FLAGS = struct.Struct('>H')
+_EXTENSION = struct.Struct('>4sI')
+
+# Attributes converting the content when it's added
+_CONVERTING = frozenset(['text', 'eol', 'crlf', 'filter', 'ident',
+                         'working-tree-encoding'])
+
+_FALSE = frozenset(['false', 'no', 'off', '0'])
+
+_EXTENDED_FLAG = 0x4000
+_STAGE_MASK = 0x3000
+_NAME_MASK = 0x0fff
+
+
+class IndexEntry:
+
+    __slots__ = ('mode', 'oid', 'hash_name', 'mtime_s', 'mtime_ns', 'ino',
+                 'size')
+
+    def __init__(self, mode, oid, hash_name, mtime_s, mtime_ns, ino, size):
+        self.mode = mode
+        self.oid = oid
+        self.hash_name = hash_name
+        self.mtime_s = mtime_s
+        self.mtime_ns = mtime_ns
+        self.ino = ino
+        self.size = size
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.mode:o} {self.oid.hex()})'
+
+    def matches(self, sig):
+        """Returns True if the (ino, size, mtime_ns, mode) are the entry's.
+
+        Sizes and inodes are stored truncated to 32 bits. Nanoseconds are only
+        compared when git recorded them.
+        """
+        ino, size, mtime_ns, mode = sig
+        mtime_s, mtime_ns = divmod(mtime_ns, 10**9)
+        return (mtime_s == self.mtime_s and
+                (not self.mtime_ns or mtime_ns == self.mtime_ns) and
+                size & 0xffffffff == self.size and
+                ino & 0xffffffff == self.ino and
+                stat.S_IFMT(mode) == stat.S_IFMT(self.mode) and
+                (stat.S_ISLNK(mode) or
+                 mode & stat.S_IXUSR == self.mode & stat.S_IXUSR))
+
+
+def _read_varint(data, pos):
+    """Returns (value, next position) of the offset encoding of git."""
+    byte = data[pos]
+    pos += 1
+    value = byte & 0x7f
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (byte & 0x7f)
+    return value, pos
+
+
+def parse_index(data, hash_name='sha1'):
+    """Returns {name: IndexEntry} of the merged files, None if unsupported.
+
+    Conflicted paths, which have only higher stage entries, are left out.
+    """
+    oid_size = hashlib.new(hash_name).digest_size
+    signature, version, count = _HEADER.unpack_from(data)
+    if signature != b'DIRC' or version not in (2, 3, 4):
+        return None
+
+    entries = dict()
+    pos = _HEADER.size
+    name = b''
+    for _ in range(count):
+        start = pos
+        (_, _, mtime_s, mtime_ns, _, ino, mode, _, _,
+         size) = _STAT.unpack_from(data, pos)
+        pos += _STAT.size
+        oid = data[pos:pos + oid_size]
+        pos += oid_size
+        flags, = _FLAGS.unpack_from(data, pos)
+        pos += _FLAGS.size
+        if flags & _EXTENDED_FLAG and version >= 3:
+            pos += _FLAGS.size
+
+        if version == 4:
+            strip, pos = _read_varint(data, pos)
+            end = data.index(b'\0', pos)
+            name = name[:len(name) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            length = flags & _NAME_MASK
+            if length == _NAME_MASK:
+                length = data.index(b'\0', pos) - pos
+            name = data[pos:pos + length]
+            # NUL padded to a multiple of 8, at least one NUL
+            pos = start + ((pos - start + length + 8) & ~7)
+
+        if not flags & _STAGE_MASK:
+            entries[os.fsdecode(name)] = IndexEntry(
+                    mode, oid, hash_name, mtime_s, mtime_ns, ino, size)
+
+    while pos + _EXTENSION.size <= len(data) - oid_size:
+        extension, length = _EXTENSION.unpack_from(data, pos)
+        if extension == b'link':
+            # Split index, most entries live in the shared index
+            return None
+        pos += _EXTENSION.size + length
+    return entries
+
+
+def blob_oid(content, hash_name='sha1'):
+    """Returns the git object id of the blob with the content."""
+    digest = hashlib.new(hash_name)
+    digest.update(b'blob %d\0' % len(content))
+    digest.update(content)
+    return digest.digest()
+
+
+def file_oid(path, hash_name='sha1'):
+    """Returns the git object id the regular file would have."""
+    digest = hashlib.new(hash_name)
+    read = 0
+    with open(path, 'rb') as f:
+        digest.update(b'blob %d\0' % os.fstat(f.fileno()).st_size)
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+            read += len(chunk)
+    if tracing.enabled:
+        tracing.count('compare.git_blob_hashes')
+        tracing.count('read.bytes', read)
+    return digest.digest()
+
+
+def find_repo(path):
+    """Returns (work tree, git dir) of the repo containing the path or None."""
+    path = os.path.abspath(path)
+    while True:
+        git_path = os.path.join(path, '.git')
+        if os.path.isdir(git_path):
+            return path, git_path
+        if os.path.isfile(git_path):
+            # Worktrees and submodules point to the git dir
+            try:
+                with open(git_path) as f:
+                    line = f.readline().strip()
+            except OSError:
+                return None
+            if not line.startswith('gitdir:'):
+                return None
+            return path, os.path.join(path, line[len('gitdir:'):].strip())
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _common_dir(git_dir):
+    """Returns the git dir shared by the worktrees of the repo."""
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            return os.path.join(git_dir, f.readline().strip())
+    except OSError:
+        return git_dir
+
+
+def _config_paths(git_dir):
+    """Returns the config files git reads for the repo, system first."""
+    paths = []
+    if not os.environ.get('GIT_CONFIG_NOSYSTEM'):
+        system = os.environ.get('GIT_CONFIG_SYSTEM')
+        # Homebrew builds have their own system config
+        paths.extend([system] if system else [
+                '/etc/gitconfig', '/usr/local/etc/gitconfig',
+                '/opt/homebrew/etc/gitconfig'])
+    if 'GIT_CONFIG_GLOBAL' in os.environ:
+        paths.append(os.environ['GIT_CONFIG_GLOBAL'])
+    else:
+        config_home = (os.environ.get('XDG_CONFIG_HOME') or
+                       os.path.expanduser('~/.config'))
+        paths.append(os.path.join(config_home, 'git', 'config'))
+        paths.append(os.path.expanduser('~/.gitconfig'))
+    paths.append(os.path.join(_common_dir(git_dir), 'config'))
+    paths.append(os.path.join(git_dir, 'config.worktree'))
+    return paths
+
+
+def _config_value(value):
+    value = value.strip()
+    if value.startswith('"'):
+        return value[1:].partition('"')[0]
+    for comment in '#;':
+        value = value.partition(comment)[0]
+    return value.strip()
+
+
+def _read_config(path, values, depth=0):
+    """Adds {'section.key': value} of the git config file to the values.
+
+    Includes are followed regardless of their conditions. Keys without
+    a value, which mean true, have ''.
+    """
+    try:
+        with open(path, errors='replace') as f:
+            lines = f.readlines()
+    except OSError:
+        return
+    section = ''
+    for line in lines:
+        line = line.strip()
+        if line.startswith('['):
+            # [section "subsection"], subsections don't matter here
+            header = line[1:].partition(']')[0].split()
+            section = header[0].partition('.')[0].lower() if header else ''
+            continue
+        if not line or line[0] in '#;':
+            continue
+        key, _, value = line.partition('=')
+        key = f'{section}.{key.strip().lower()}'
+        value = _config_value(value)
+        values[key] = value
+        if key in ('include.path', 'includeif.path') and depth < 10:
+            include = os.path.join(os.path.dirname(path),
+                                   os.path.expanduser(value))
+            _read_config(include, values, depth + 1)
+
+
+def read_config(git_dir):
+    """Returns {'section.key': value} of the git config of the repo."""
+    values = dict()
+    for path in _config_paths(git_dir):
+        _read_config(path, values)
+    return values
+
+
+def _read_attributes(path, directory, rules, macros):
+    """Adds (directory, pattern, attribute names) of the file to the rules."""
+    try:
+        with open(path, errors='replace') as f:
+            lines = f.readlines()
+    except OSError:
+        return
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        names = {field.lstrip('-!').partition('=')[0]
+                 for field in fields[1:]}
+        if fields[0].startswith('[attr]'):
+            macros[fields[0][len('[attr]'):]] = names
+        else:
+            rules.append((directory, fields[0], names))
+
+
+def converting_rules(work_tree, git_dir, names, config):
+    """Returns [(directory, pattern)] of files git converts when adding.
+
+    names are the paths in the index, their .gitattributes files are read
+    from the work tree as git does.
+    """
+    rules = []
+    macros = dict()
+    if not os.environ.get('GIT_ATTR_NOSYSTEM'):
+        _read_attributes('/etc/gitattributes', '', rules, macros)
+    config_home = (os.environ.get('XDG_CONFIG_HOME') or
+                   os.path.expanduser('~/.config'))
+    attributes_file = config.get('core.attributesfile')
+    _read_attributes(
+            os.path.expanduser(attributes_file) if attributes_file
+            else os.path.join(config_home, 'git', 'attributes'),
+            '', rules, macros)
+    _read_attributes(os.path.join(_common_dir(git_dir), 'info', 'attributes'),
+                     '', rules, macros)
+    for name in names:
+        if name.rpartition('/')[2] == '.gitattributes':
+            _read_attributes(os.path.join(work_tree, name),
+                             name.rpartition('/')[0], rules, macros)
+
+    # Macros can be defined in terms of each other
+    converting = set(_CONVERTING)
+    while True:
+        found = {macro for macro, macro_names in macros.items()
+                 if macro not in converting and macro_names & converting}
+        if not found:
+            break
+        converting |= found
+    return [(directory, pattern) for directory, pattern, rule_names in rules
+            if rule_names & converting]
+
+
+def matches_rule(directory, pattern, name):
+    """Returns True if the pattern of the attributes file matches the path.
+
+    Errs on the side of matching, e.g. wildcards also match slashes.
+    """
+    if directory:
+        if not name.startswith(directory + '/'):
+            return False
+        name = name[len(directory) + 1:]
+    if pattern.startswith('"'):
+        # Quoted pattern, not worth unquoting
+        return True
+    if '/' not in pattern:
+        return fnmatch.fnmatchcase(name.rpartition('/')[2], pattern)
+    pattern = pattern.lstrip('/').replace('/**/', '*')
+    if pattern.startswith('**/'):
+        pattern = '*' + pattern[len('**/'):]
+    return fnmatch.fnmatchcase(name, pattern)
+
+
+def converts_line_endings(config):
+    """Returns True if core.autocrlf converts all text files."""
+    value = config.get('core.autocrlf')
+    return value is not None and value.lower() not in _FALSE
+
+
+class GitIndex:
+    """Clean index entries of the files under the dotfiles layers."""
+
+    def __init__(self, dirs):
+        # Absolute path: IndexEntry
+        self._entries = dict()
+        seen = set()
+        for path in dirs:
+            repo = find_repo(path)
+            if repo is None or repo in seen:
+                continue
+            seen.add(repo)
+            self._load(*repo)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self, work_tree, git_dir):
+        config = read_config(git_dir)
+        if converts_line_endings(config):
+            tracing.count('compare.git_index_converted')
+            return
+        index_path = os.path.join(git_dir, 'index')
+        hash_name = config.get('extensions.objectformat') or 'sha1'
+        try:
+            with open(index_path, 'rb') as f:
+                index_mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                data = f.read()
+            entries = parse_index(data, hash_name.lower())
+        except (OSError, ValueError, struct.error):
+            return
+        if entries is None:
+            return
+        rules = converting_rules(work_tree, git_dir, entries, config)
+
+        index_mtime = divmod(index_mtime_ns, 10**9)
+        for name, entry in entries.items():
+            if entry.mtime_ns:
+                racy = (entry.mtime_s, entry.mtime_ns) >= index_mtime
+            else:
+                racy = entry.mtime_s >= index_mtime[0]
+            if racy:
+                # Racily clean, might have changed after it was hashed
+                continue
+            if stat.S_ISLNK(entry.mode):
+                self._entries[os.path.join(work_tree, name)] = entry
+            elif stat.S_ISREG(entry.mode):
+                if any(matches_rule(directory, pattern, name)
+                       for directory, pattern in rules):
+                    # The object id is of the converted content
+                    continue
+                self._entries[os.path.join(work_tree, name)] = entry
+
+    def clean_entry(self, path, sig):
+        """Returns the IndexEntry if the file still has its content.
+
+        sig is (ino, size, mtime_ns, mode) of the lstat of the file.
+        """
+        entry = self._entries.get(os.path.abspath(path))
+        if entry is not None and entry.matches(sig):
+            return entry
+        return None
+
+
+_lock = threading.Lock()
+_indexes = dict()
+
+
+def get_git_index(dirs):
+    """Returns the GitIndex of the repos of the directories, loaded once."""
+    key = tuple(os.path.abspath(path) for path in dirs)
+    with _lock:
+        git_index = _indexes.get(key)
+        if git_index is None:
+            git_index = _indexes[key] = GitIndex(key)
+    return git_index
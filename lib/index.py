@@ -0,0 +1,342 @@
+"""Persistent record of the previous scan.
+
+Walking the whole home and reading every candidate is what makes `collect`
+slow. The index remembers directory listings keyed on the directory mtime and
+comparison results keyed on the stat of both copies, so that the next run only
+revisits what changed in between.
+
+Repo copies which git knows to be unchanged since they were added aren't read
+at all, the home copy is compared against the object id in the git index, see
+gitindex.py.
+"""
+
+import hashlib
+import os
+import pickle
+import stat
+import time
+
+try:
+    from . import gitindex
+    from . import tracing
+    from .fsutil import RACY_WINDOW_NS, atomic_write
+except ImportError:
+    # Imported as a top-level module by the tests
+    import gitindex
+    import tracing
+    from fsutil import RACY_WINDOW_NS, atomic_write
+
+# Records which weren't used by this many saved scans are dropped.
+_MAX_AGE = 16
+
+_CHUNK_SIZE = 1 << 20
+
+# Early exit comparison reads smaller blocks, most differences are found early
+_BLOCK_SIZE = 1 << 16
+
+
+def stat_signature(st):
+    """Returns the stat tuple of the lstat() result, None stays None."""
+    if st is None:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+
+
+def signature(path):
+    """Returns the stat tuple used to detect changes or None if missing."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return stat_signature(st)
+
+
+def mode_differs(a_mode, b_mode):
+    """Returns True if the executable bit differs.
+
+    That's the only permission git keeps, comparing the rest would report
+    every private file checked out with the default permissions.
+    """
+    return bool(a_mode & stat.S_IXUSR) != bool(b_mode & stat.S_IXUSR)
+
+
+def content_differs(a_path, b_path, hashes=()):
+    """Returns True at the first block which differs.
+
+    Memory use is flat and a modified file is usually read only partly. The
+    blocks read are also fed to the hashes, one for each file, which then hold
+    digests of the whole files if the content is the same.
+    """
+    read = 0
+    try:
+        with open(a_path, 'rb') as a, open(b_path, 'rb') as b:
+            while True:
+                a_block = a.read(_BLOCK_SIZE)
+                b_block = b.read(_BLOCK_SIZE)
+                read += len(a_block) + len(b_block)
+                if a_block != b_block:
+                    return True
+                if not a_block:
+                    return False
+                for digest, block in zip(hashes, (a_block, b_block)):
+                    digest.update(block)
+    finally:
+        if tracing.enabled:
+            tracing.count('compare.contents')
+            tracing.count('read.bytes', read)
+
+
+def new_digest():
+    return hashlib.blake2b(digest_size=20)
+
+
+def file_digest(path):
+    digest = new_digest()
+    read = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            digest.update(chunk)
+            read += len(chunk)
+    if tracing.enabled:
+        tracing.count('compare.digests')
+        tracing.count('read.bytes', read)
+    return digest.digest()
+
+
+class ScanIndex:
+    """On-disk cache of directory listings, digests and is_modified() results.
+
+    There is one index per home directory and set of dotfiles layers. It is
+    thrown away whenever any of the config.yaml files changes.
+    """
+
+    VERSION = 3
+
+    def __init__(self, config):
+        self.config = config
+
+        roots = [config.home_dir] + [
+                os.path.abspath(path) for path in config.dotfiles]
+        key = hashlib.sha1('\0'.join(roots).encode()).hexdigest()[:16]
+        self.path = os.path.join(config.cache_dir, f'index-{key}.pickle')
+
+        self._fingerprint = self._config_fingerprint(roots)
+        self._start_ns = time.time_ns()
+        self._generation = 1
+        self._dirs = dict()
+        self._digests = dict()
+        # Git object ids of home files, path: (sig, hash name, oid, gen)
+        self._oids = dict()
+        self._verdicts = dict()
+        self._git_index = None
+        self._dirty = False
+        self._load()
+
+    def _config_fingerprint(self, roots):
+        fingerprint = [self.VERSION, tuple(roots)]
+        for path in self.config.config_paths:
+            with open(path, 'rb') as f:
+                fingerprint.append(
+                        (path, hashlib.sha1(f.read()).hexdigest()))
+        return tuple(fingerprint)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+
+        if (not isinstance(data, dict) or
+            data.get('fingerprint') != self._fingerprint):
+            # Config changed, start from scratch
+            return
+
+        self._generation = data['generation'] + 1
+        self._dirs = data['dirs']
+        self._digests = data['digests']
+        self._oids = data['oids']
+        self._verdicts = data['verdicts']
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        oldest = self._generation - _MAX_AGE
+        data = {
+            'fingerprint': self._fingerprint,
+            'generation': self._generation,
+            'dirs': {key: value for key, value in self._dirs.items()
+                     if value[-1] >= oldest},
+            'digests': {key: value for key, value in self._digests.items()
+                        if value[-1] >= oldest},
+            'oids': {key: value for key, value in self._oids.items()
+                     if value[-1] >= oldest},
+            'verdicts': {key: value for key, value in self._verdicts.items()
+                         if value[-1] >= oldest},
+        }
+
+        atomic_write(self.path,
+                     pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+        self._dirty = False
+
+    def _is_racy(self, mtime_ns):
+        return mtime_ns >= self._start_ns - RACY_WINDOW_NS
+
+    def cached_listing(self, path, mtime_ns):
+        """Returns [(name, is_dir, is_link)] if the directory didn't change.
+
+        Directory mtime changes only when entries are added, removed or
+        renamed which is exactly what the listing depends on.
+        """
+        cached = self._dirs.get(path)
+        if cached is None or cached[0] != mtime_ns:
+            return None
+        if cached[-1] != self._generation:
+            self._dirs[path] = (mtime_ns, cached[1], self._generation)
+        return cached[1]
+
+    def store_listing(self, path, mtime_ns, listing):
+        if not self._is_racy(mtime_ns):
+            self._dirs[path] = (mtime_ns, listing, self._generation)
+            self._dirty = True
+
+    def _cached_digest(self, path, sig):
+        cached = self._digests.get(path)
+        if cached is not None and cached[0] == sig:
+            if cached[-1] != self._generation:
+                self._digests[path] = (sig, cached[1], self._generation)
+            return cached[1]
+        return None
+
+    def _store_digest(self, path, sig, digest):
+        if not self._is_racy(sig[2]):
+            self._digests[path] = (sig, digest, self._generation)
+            self._dirty = True
+
+    def digest(self, path, sig):
+        """Returns content digest of the regular file with given signature."""
+        digest = self._cached_digest(path, sig)
+        if digest is None:
+            digest = file_digest(path)
+            self._store_digest(path, sig, digest)
+        return digest
+
+    def oid(self, path, sig, hash_name):
+        """Returns git object id of the regular file with given signature."""
+        cached = self._oids.get(path)
+        if (cached is not None and cached[0] == sig and
+            cached[1] == hash_name):
+            oid = cached[2]
+            if cached[-1] != self._generation:
+                self._oids[path] = (sig, hash_name, oid, self._generation)
+            return oid
+
+        oid = gitindex.file_oid(path, hash_name)
+        if not self._is_racy(sig[2]):
+            self._oids[path] = (sig, hash_name, oid, self._generation)
+            self._dirty = True
+        return oid
+
+    @property
+    def git_index(self):
+        if self._git_index is None:
+            self._git_index = gitindex.get_git_index(self.config.dotfiles)
+        return self._git_index
+
+    def lookup(self, dotfile):
+        """Returns (key, verdict) where verdict is None if not known."""
+        # Same lstat() results as DotFile.is_modified() uses
+        key = (stat_signature(dotfile.home_stat()),
+               dotfile.dotfile_path,
+               stat_signature(dotfile.dotfile_stat()))
+
+        cached = self._verdicts.get(dotfile.name)
+        if cached is not None and cached[0] == key:
+            if cached[-1] != self._generation:
+                self._verdicts[dotfile.name] = (
+                        key, cached[1], self._generation)
+            return key, cached[1]
+        return key, None
+
+    def record(self, dotfile, key, modified):
+        """Remember the result of comparison for the key from lookup()."""
+        home_sig, _, dotfile_sig = key
+        if not any(sig is not None and self._is_racy(sig[2])
+                   for sig in (home_sig, dotfile_sig)):
+            self._verdicts[dotfile.name] = (key, modified, self._generation)
+            self._dirty = True
+
+    def compare(self, dotfile, key):
+        """Uncached is_modified() which reads as little as possible.
+
+        When the git index has the repo copy, only the home copy is hashed.
+        Otherwise size and the executable bit are compared first. When the
+        digest of one side is known, only the other one is read, otherwise
+        both are compared block by block until the first difference.
+        """
+        home_sig, _, dotfile_sig = key
+        if (home_sig is not None and dotfile_sig is not None and
+            not dotfile.is_plist):
+            entry = self.git_index.clean_entry(
+                    dotfile.dotfile_path, dotfile_sig)
+            if entry is not None:
+                tracing.count('compare.git_index')
+                return self._compare_oid(dotfile, home_sig, entry)
+
+        if (home_sig is None or dotfile_sig is None or
+            not stat.S_ISREG(home_sig[3]) or
+            not stat.S_ISREG(dotfile_sig[3]) or
+            dotfile.is_plist):
+            return dotfile.is_modified()
+
+        if (home_sig[1] != dotfile_sig[1] or
+            mode_differs(home_sig[3], dotfile_sig[3])):
+            return True
+
+        home_digest = self._cached_digest(dotfile.home_path, home_sig)
+        dotfile_digest = self._cached_digest(dotfile.dotfile_path, dotfile_sig)
+        if home_digest is not None or dotfile_digest is not None:
+            return (self.digest(dotfile.home_path, home_sig) !=
+                    self.digest(dotfile.dotfile_path, dotfile_sig))
+
+        hashes = (new_digest(), new_digest())
+        if content_differs(
+                dotfile.home_path, dotfile.dotfile_path, hashes):
+            return True
+        self._store_digest(dotfile.home_path, home_sig, hashes[0].digest())
+        self._store_digest(
+                dotfile.dotfile_path, dotfile_sig, hashes[1].digest())
+        return False
+
+    def _compare_oid(self, dotfile, home_sig, entry):
+        """is_modified() against the index entry of the repo copy."""
+        home_mode = home_sig[3]
+        if stat.S_ISLNK(entry.mode):
+            if not stat.S_ISLNK(home_mode):
+                return True
+            # Same as DotFile.is_modified(), links which don't resolve are
+            # always listed
+            if (not os.path.exists(dotfile.home_path) or
+                not os.path.exists(dotfile.dotfile_path)):
+                return True
+            target = os.readlink(os.fsencode(dotfile.home_path))
+            return gitindex.blob_oid(target, entry.hash_name) != entry.oid
+
+        if (not stat.S_ISREG(home_mode) or
+            home_sig[1] & 0xffffffff != entry.size or
+            mode_differs(home_mode, entry.mode)):
+            return True
+        return (self.oid(dotfile.home_path, home_sig, entry.hash_name) !=
+                entry.oid)
+
+    def is_modified(self, dotfile):
+        """Cached version of DotFile.is_modified()."""
+        key, modified = self.lookup(dotfile)
+        if modified is None:
+            tracing.count('index.verdict_misses')
+            modified = self.compare(dotfile, key)
+            self.record(dotfile, key, modified)
+        else:
+            tracing.count('index.verdict_hits')
+        return modified
@@ -0,0 +1,74 @@
+import bisect
+
+# Sorts after any character that can appear in a path
+_MAX_CHAR = '\U0010ffff'
+
+
+class ExclusionMatcher:
+    """Frozen set of excluded path prefixes.
+
+    Same semantics as TrieNode: a path is excluded when any rule is its text
+    prefix, i.e. .config/foo- matches .config/foo-A and .config/foo-B.
+
+    Rules which start with a shorter rule are redundant and dropped. In the
+    remaining sorted tuple, the only rule which can be a prefix of a path is
+    the closest one sorted before the path, so a query is a single bisect.
+    """
+
+    __slots__ = ('_rules',)
+
+    def __init__(self, rules=()):
+        minimal = []
+        for rule in sorted(set(rule for rule in rules if rule)):
+            if minimal and rule.startswith(minimal[-1]):
+                continue
+            minimal.append(rule)
+        self._rules = tuple(minimal)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self._rules)} rules)'
+
+    def __len__(self):
+        return len(self._rules)
+
+    @property
+    def rules(self):
+        return self._rules
+
+    def match(self, path):
+        """Returns the rule excluding the path or None."""
+        rules = self._rules
+        i = bisect.bisect_right(rules, path)
+        if i and path.startswith(rules[i - 1]):
+            return rules[i - 1]
+        return None
+
+    def query(self, path):
+        """Returns True if the path is excluded."""
+        return self.match(path) is not None
+
+    def classify(self, prefix, names):
+        """Returns the matching rule or None for prefix + name of every name.
+
+        Meant for whole directory listings: the rules are narrowed down to the
+        directory once, and most directories have no rule inside them at all.
+        """
+        rule = self.match(prefix)
+        if rule is not None:
+            return [rule] * len(names)
+
+        rules = self._rules
+        lo = bisect.bisect_left(rules, prefix)
+        hi = bisect.bisect_left(rules, prefix + _MAX_CHAR, lo)
+        if lo == hi:
+            return [None] * len(names)
+
+        result = []
+        for name in names:
+            path = prefix + name
+            i = bisect.bisect_right(rules, path, lo, hi)
+            if i > lo and path.startswith(rules[i - 1]):
+                result.append(rules[i - 1])
+            else:
+                result.append(None)
+        return result
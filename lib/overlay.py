@@ -0,0 +1,114 @@
+"""Merged view of the dotfiles layers.
+
+The base, work and private layers are walked once per process into one
+mapping of every relative name to the file of the highest layer which has it,
+and to the files of the lower layers it shadows. The discovery and the name
+lookups of the subcommands share it instead of probing every layer for every
+name.
+
+Only the walk is shared, files added to or removed from a layer afterwards
+aren't seen until invalidate(), which the server does before every listing.
+"""
+
+import os
+import sys
+
+from . import walker
+
+# Layer directories: Overlay, configs of other homes share it
+_overlays = dict()
+
+
+class Overlay:
+
+    def __init__(self, config, index=None):
+        self.config = config
+        self._prefixes = [os.path.join(dotfiles_dir, '')
+                          for dotfiles_dir in config.dotfiles]
+        # Name: [layer indexes], the highest layer first. Names are in the
+        # order discovery yields them, highest layer first.
+        self._layers = dict()
+        for layer in reversed(range(len(config.dotfiles))):
+            for entry in walker.walk(config.dotfiles[layer], index=index):
+                # Files and symlinks
+                if entry.is_link or not entry.is_dir:
+                    layers = self._layers.get(entry.name)
+                    if layers is None:
+                        self._layers[sys.intern(entry.name)] = [layer]
+                    else:
+                        layers.append(layer)
+
+    def __contains__(self, name):
+        return name in self._layers
+
+    def __len__(self):
+        return len(self._layers)
+
+    def names(self):
+        return self._layers.keys()
+
+    def layer_items(self):
+        """Yields (name, index of the highest layer)."""
+        for name, layers in self._layers.items():
+            yield name, layers[0]
+
+    def items(self):
+        """Yields (name, path of the highest layer)."""
+        for name, layers in self._layers.items():
+            yield name, self._prefixes[layers[0]] + name
+
+    def layer(self, name):
+        """Returns index of the layer the dotfile is, or would be added to."""
+        layers = self._layers.get(name)
+        return layers[0] if layers is not None else 0
+
+    def resolve(self, name):
+        """Returns path of the dotfile in the highest layer or None."""
+        layers = self._layers.get(name)
+        return self._prefixes[layers[0]] + name if layers is not None else None
+
+    def dotfile_path(self, name):
+        """Returns where the dotfile is, or would be added to the repo."""
+        return self._prefixes[self.layer(name)] + name
+
+    def shadowed(self):
+        """Returns [(name, winning path, [shadowed paths])], sorted."""
+        return [(name, self._prefixes[layers[0]] + name,
+                 [self._prefixes[layer] + name for layer in layers[1:]])
+                for name, layers in sorted(self._layers.items())
+                if len(layers) > 1]
+
+
+def get_overlay(config, index=None):
+    """Returns the overlay of the process, walked on first use."""
+    key = tuple(config.dotfiles)
+    overlay = _overlays.get(key)
+    if overlay is None:
+        overlay = _overlays[key] = Overlay(config, index)
+    return overlay
+
+
+def invalidate(config):
+    """Forgets the overlay, the next get_overlay() walks the layers again."""
+    _overlays.pop(tuple(config.dotfiles), None)
+
+
+def print_shadowed(config):
+    """Prints the dotfiles which a higher layer overrides."""
+    from .index import content_differs
+
+    base_dir = os.path.abspath(config.base_dir)
+    shadowed = get_overlay(config).shadowed()
+    for name, path, lower_paths in shadowed:
+        print(name)
+        print(f'  {os.path.relpath(path, base_dir)}')
+        for lower_path in lower_paths:
+            if os.path.islink(path) or os.path.islink(lower_path):
+                same = (os.path.islink(path) and os.path.islink(lower_path)
+                        and os.readlink(path) == os.readlink(lower_path))
+            else:
+                same = not content_differs(path, lower_path)
+            note = ' (same content, redundant)' if same else ''
+            print(f'    shadows {os.path.relpath(lower_path, base_dir)}{note}')
+    if not shadowed:
+        print('No dotfile is shadowed by a higher layer')
@@ -0,0 +1,171 @@
+"""Filtered and normalized macOS preference plists.
+
+Home plists are binary and have to be parsed and filtered of the excluded
+settings before they can be compared with the XML in the repo. That is slow
+for big ones like the iTerm2 preferences, and used to be repeated by the
+comparison, the diff preview and the move.
+
+The filtered XML and a structural digest of it are cached per plist, keyed on
+its stat and the excluded keys, in memory and in the cache dir so that the
+preview subprocesses share them. The repo side is compared by the digest of
+its parsed content which is cached the same way, so it's parsed only when it
+changes. Comparing the digests ignores formatting differences of the XML.
+"""
+
+import datetime
+import hashlib
+import os
+import pickle
+import plistlib
+import time
+
+from . import tracing
+from .fsutil import RACY_WINDOW_NS, atomic_write
+from .index import signature
+
+VERSION = 1
+
+
+def _encode(value, digest):
+    """Feeds the digest with an unambiguous encoding of the value."""
+    if isinstance(value, dict):
+        digest.update(b'd%d:' % len(value))
+        for key in sorted(value):
+            _encode(key, digest)
+            _encode(value[key], digest)
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'l%d:' % len(value))
+        for item in value:
+            _encode(item, digest)
+    elif isinstance(value, bool):
+        digest.update(b'T' if value else b'F')
+    elif isinstance(value, plistlib.UID):
+        digest.update(b'u%d;' % value.data)
+    elif isinstance(value, int):
+        digest.update(b'i%d;' % value)
+    elif isinstance(value, float):
+        digest.update(b'f' + value.hex().encode() + b';')
+    elif isinstance(value, datetime.datetime):
+        # XML keeps only whole seconds
+        text = value.replace(microsecond=0).isoformat()
+        digest.update(b't' + text.encode() + b';')
+    elif isinstance(value, str):
+        data = value.encode()
+        digest.update(b's%d:' % len(data) + data)
+    elif isinstance(value, bytes):
+        digest.update(b'b%d:' % len(value) + value)
+    else:
+        raise Exception(f'Unsupported plist value {value!r}')
+
+
+def canonical_digest(settings):
+    """Digest of the plist content, independent of its serialization."""
+    digest = hashlib.blake2b(digest_size=20)
+    _encode(settings, digest)
+    return digest.digest()
+
+
+def filter_plist(path, excluded_keys):
+    """Returns (XML, digest) of the plist without the excluded top-level keys.
+    """
+    tracing.count('plist.parsed')
+    with open(path, 'rb') as f:
+        settings = plistlib.load(f)
+
+    for key in list(settings.keys()):
+        if key in excluded_keys:
+            del settings[key]
+
+    xml = plistlib.dumps(settings, fmt=plistlib.FMT_XML).decode()
+    return xml, canonical_digest(settings)
+
+
+def plist_digest(path):
+    """Returns canonical digest of the plist, None if it can't be parsed."""
+    tracing.count('plist.parsed')
+    try:
+        with open(path, 'rb') as f:
+            return canonical_digest(plistlib.load(f))
+    except Exception:
+        # Whatever it is, it's not the same as any valid plist
+        return None
+
+
+class PlistCache:
+    """Memoized filter_plist() and plist_digest() results.
+
+    There is one file per plist and set of excluded keys which is replaced
+    whenever the plist changes.
+    """
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'plists')
+        self._memo = dict()
+
+    def _cached(self, name, sig, compute):
+        """Returns the result of compute() for the file with given stat."""
+        cached = self._memo.get(name)
+        if cached is not None and cached[0] == sig:
+            tracing.count('plist.memo_hits')
+            return cached[1]
+
+        path = os.path.join(
+                self.path, hashlib.sha1(repr(name).encode()).hexdigest())
+        try:
+            with open(path, 'rb') as f:
+                cached = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            cached = None
+        if cached is not None and cached[:2] == (VERSION, sig):
+            tracing.count('plist.cache_hits')
+            self._memo[name] = (sig, cached[2])
+            return cached[2]
+
+        tracing.count('plist.cache_misses')
+        with tracing.span('plist'):
+            result = compute()
+        self._memo[name] = (sig, result)
+        if sig[2] < time.time_ns() - RACY_WINDOW_NS:
+            try:
+                atomic_write(path, pickle.dumps(
+                        (VERSION, sig, result),
+                        protocol=pickle.HIGHEST_PROTOCOL))
+            except OSError:
+                pass
+        return result
+
+    def filtered(self, path, excluded_keys):
+        """Returns (XML, digest) of the filtered plist, None if missing."""
+        sig = signature(path)
+        if sig is None:
+            return None
+        excluded = tuple(sorted(excluded_keys))
+        return self._cached(('filtered', path, excluded), sig,
+                            lambda: filter_plist(path, excluded_keys))
+
+    def digest(self, path):
+        """Returns canonical digest of the plist, None if missing or invalid.
+        """
+        sig = signature(path)
+        if sig is None:
+            return None
+        return self._cached(('digest', path), sig, lambda: plist_digest(path))
+
+    def is_modified(self, home_path, dotfile_path, excluded_keys):
+        """Returns True if the filtered home plist differs from the repo one.
+        """
+        filtered = self.filtered(home_path, excluded_keys)
+        dotfile_digest = self.digest(dotfile_path)
+        return (filtered is None or dotfile_digest is None or
+                filtered[1] != dotfile_digest)
+
+
+_caches = dict()
+
+
+def get_cache(cache_dir):
+    """Returns the PlistCache of the process for the cache dir."""
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        cache = _caches[cache_dir] = PlistCache(cache_dir)
+    return cache
@@ -0,0 +1,276 @@
+"""Concurrent runner of the installation scripts.
+
+Scripts declare their dependencies and whether they need the terminal in the
+leading comment block:
+
+    #!/bin/bash
+    #
+    # depends: brew.sh linux-packages.sh
+    # inputs: dotfiles/.Brewfile
+    # interactive
+
+Dependencies are names relative to a scripts folder. A script starts once the
+selected scripts it depends on succeeded, unselected ones are assumed to be
+done already. When a script fails, only the scripts depending on it are
+skipped, the rest keep running.
+
+Up to `jobs` scripts run at the same time, their output is streamed line by
+line with the script name as a prefix and kept in a log per script in the
+cache dir. Interactive scripts, e.g. the ones asking for the sudo password,
+run alone with the terminal attached and aren't logged.
+
+Scripts with inputs are skipped while they are up to date, see stamps.py.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from . import tracing
+from .stamps import StampDb
+
+# Logs of this many last runs are kept
+MAX_RUNS = 10
+
+_DEPENDS_RE = re.compile(r'#\s*depends:(.*)')
+_INPUTS_RE = re.compile(r'#\s*inputs:(.*)')
+_INTERACTIVE_RE = re.compile(r'#\s*interactive\b')
+
+_COLORS = (33, 34, 35, 36, 32, 94, 95, 96)
+
+PENDING, RUNNING, DONE, UP_TO_DATE, FAILED, SKIPPED = (
+        'pending', 'running', 'done', 'up to date', 'failed', 'skipped')
+
+_SUCCEEDED = (DONE, UP_TO_DATE)
+
+
+class Script:
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.depends = []
+        # None when the script doesn't declare inputs
+        self.inputs = None
+        self.interactive = False
+        self.state = PENDING
+        self.return_code = None
+        self.duration = None
+        self.log_path = None
+        self._read_headers()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name})'
+
+    def _read_headers(self):
+        with open(self.path, errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line.startswith('#'):
+                    break
+                match = _DEPENDS_RE.match(line)
+                if match:
+                    self.depends.extend(match.group(1).split())
+                    continue
+                match = _INPUTS_RE.match(line)
+                if match:
+                    self.inputs = (self.inputs or []) + match.group(1).split()
+                elif _INTERACTIVE_RE.match(line):
+                    self.interactive = True
+
+    @property
+    def argv(self):
+        if os.access(self.path, os.X_OK):
+            return [self.path]
+        return ['bash', self.path]
+
+
+def discover_scripts(config):
+    """Returns [(name, path)] of the scripts of all the layers."""
+    scripts = []
+    for script_folder in config.scripts:
+        for dirpath, _, filenames in os.walk(script_folder):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                scripts.append((os.path.relpath(path, script_folder), path))
+    return scripts
+
+
+class Runner:
+
+    def __init__(self, config, scripts, jobs=None, force=False):
+        """scripts are [(name, path)] in the order they should run in.
+
+        Dependencies on a name of several scripts mean the last one. With
+        force, up to date scripts run too.
+        """
+        self.config = config
+        self.jobs = jobs if jobs is not None else config.jobs
+        self.force = force
+        self.stamps = StampDb(config)
+        self._digests = dict()
+        self.scripts = [Script(name, path) for name, path in scripts]
+        self._by_name = {script.name: script for script in self.scripts}
+        self._condition = threading.Condition()
+        self._print_lock = threading.Lock()
+        self._log_dir = None
+
+    def _prepare_logs(self):
+        runs_dir = os.path.join(self.config.cache_dir, 'runs')
+        self._log_dir = os.path.join(
+                runs_dir, time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}')
+        os.makedirs(self._log_dir, exist_ok=True)
+        runs = sorted(os.listdir(runs_dir))
+        for run in runs[:-MAX_RUNS]:
+            shutil.rmtree(os.path.join(runs_dir, run), ignore_errors=True)
+
+    def _dependencies(self, script):
+        return [self._by_name[name] for name in script.depends
+                if name in self._by_name]
+
+    def _next(self, running):
+        """Returns the script to start next or None.
+
+        Also skips the scripts whose dependencies failed. An interactive
+        script waiting for the terminal doesn't hold back the scripts after
+        it which don't need the terminal.
+        """
+        if running and running[0].interactive:
+            # Has the terminal, nothing else starts meanwhile
+            return None
+        for script in self.scripts:
+            if script.state != PENDING:
+                continue
+            states = [dependency.state
+                      for dependency in self._dependencies(script)]
+            if any(state in (FAILED, SKIPPED) for state in states):
+                script.state = SKIPPED
+                self._print(script, '\033[91mskipped, a dependency failed'
+                            '\033[0m')
+                continue
+            if any(state not in _SUCCEEDED for state in states):
+                continue
+            if self._is_up_to_date(script):
+                script.state = UP_TO_DATE
+                self._print(script, 'up to date')
+                continue
+            if script.interactive:
+                if not running:
+                    return script
+                # Waits for the terminal until the running ones finish
+                continue
+            return script if len(running) < self.jobs else None
+        return None
+
+    def run(self):
+        """Runs the scripts, returns the first non-zero return code or 0."""
+        self._prepare_logs()
+        threads = []
+        with self._condition:
+            running = []
+            while True:
+                script = self._next(running)
+                if script is not None:
+                    script.state = RUNNING
+                    running.append(script)
+                    thread = threading.Thread(
+                            target=self._execute, args=(script, running))
+                    thread.start()
+                    threads.append(thread)
+                    continue
+                if not running:
+                    break
+                self._condition.wait()
+
+        for thread in threads:
+            thread.join()
+        for script in self.scripts:
+            if script.state == PENDING:
+                # Left are dependency cycles only
+                script.state = FAILED
+                self._print(script, '\033[91mdependency cycle\033[0m')
+
+        self.print_summary()
+        failed = [script for script in self.scripts
+                  if script.state not in _SUCCEEDED]
+        if not failed:
+            return 0
+        return next((script.return_code for script in failed
+                     if script.return_code), 1)
+
+    def _is_up_to_date(self, script):
+        if script.inputs is None:
+            return False
+        # Digest from before the run, inputs changed meanwhile run next time.
+        # Computed once, a waiting script is checked again on every wakeup.
+        digest = self._digests.get(script)
+        if digest is None:
+            digest = self._digests[script] = self.stamps.digest(script)
+        return not self.force and self.stamps.is_up_to_date(script, digest)
+
+    def _execute(self, script, running):
+        start = time.monotonic()
+        try:
+            with tracing.span(f'script {script.name}'):
+                if script.interactive:
+                    return_code = self._run_interactive(script)
+                else:
+                    return_code = self._run_logged(script)
+        except OSError as e:
+            self._print(script, f'\033[91m{e}\033[0m')
+            return_code = 127
+        script.duration = time.monotonic() - start
+        script.return_code = return_code
+
+        with self._condition:
+            script.state = DONE if return_code == 0 else FAILED
+            if script.state == DONE and script in self._digests:
+                self.stamps.record(script, self._digests[script])
+            running.remove(script)
+            self._condition.notify()
+
+    def _run_interactive(self, script):
+        print(f'\033[33m=-= Executing \033[33;1m{script.name}\033[0m',
+              flush=True)
+        return subprocess.call(script.argv)
+
+    def _run_logged(self, script):
+        script.log_path = os.path.join(
+                self._log_dir, script.name.replace('/', '_') + '.log')
+        self._print(script, f'started, logging to {script.log_path}')
+        with open(script.log_path, 'wb') as log:
+            process = subprocess.Popen(
+                    script.argv, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in process.stdout:
+                log.write(line)
+                self._print(script, line.decode(errors='replace').rstrip('\n'))
+            return process.wait()
+
+    def _print(self, script, line):
+        color = _COLORS[self.scripts.index(script) % len(_COLORS)]
+        with self._print_lock:
+            sys.stdout.write(f'\033[{color}m[{script.name}]\033[0m {line}\n')
+            sys.stdout.flush()
+
+    def print_summary(self):
+        print('\n\033[33;1m=-= Summary\033[0m')
+        for script in self.scripts:
+            if script.state == DONE:
+                status = '\033[32mok\033[0m'
+            elif script.state == UP_TO_DATE:
+                status = '\033[32mup to date\033[0m'
+            elif script.state == FAILED and script.return_code is not None:
+                status = f'\033[91mfailed ({script.return_code})\033[0m'
+            elif script.state == FAILED:
+                status = '\033[91mfailed\033[0m'
+            else:
+                status = f'\033[33m{script.state}\033[0m'
+            duration = (f'{script.duration:7.1f} s'
+                        if script.duration is not None else ' ' * 9)
+            log = f'  {script.log_path}' if script.log_path else ''
+            print(f'  {duration}  {script.name:<24} {status}{log}')
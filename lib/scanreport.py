@@ -0,0 +1,174 @@
+"""Where the home walk spends its time and what the exclusions save.
+
+`management.py scan-report` walks home the same way as the discovery does,
+with full accounting:
+
+ - entries visited and time spent per top-level subtree
+ - for every exclusion rule, the directories and files it matched and the
+   number of entries under those directories, i.e. the work it saves
+ - rules which matched nothing, and rules made redundant by a shorter one
+ - paths skipped for being over the budgets of config.yaml
+ - the heaviest walked directories without any tracked dotfile in them,
+   candidates for new exclusions
+
+Time is attributed to the subtree of the entry the walker yields next, which
+includes listing the directory it's in.
+"""
+
+import collections
+import os
+import sys
+import time
+
+from . import walker
+from .dotfile import _inclusion_prefixes, is_home_subdir
+from .overlay import get_overlay
+
+
+class _CountingMatcher:
+    """ExclusionMatcher which remembers what every rule matched."""
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.matched = collections.defaultdict(list)
+
+    def classify(self, prefix, names):
+        rules = self.matcher.classify(prefix, names)
+        for name, rule in zip(names, rules):
+            if rule is not None:
+                self.matched[rule].append(prefix + name)
+        return rules
+
+
+def _subtree_size(path):
+    """Returns the number of entries under the directory."""
+    size = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for dir_entry in it:
+                    size += 1
+                    try:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            stack.append(dir_entry.path)
+                    except OSError:
+                        pass
+        except OSError:
+            continue
+    return size
+
+
+class ScanReport:
+
+    def __init__(self, config):
+        self.config = config
+        # Top-level name: [entries, seconds]
+        self.subtrees = collections.defaultdict(lambda: [0, 0.0])
+        # Directory name: entries walked under it
+        self.dir_entries = collections.Counter()
+        self.matcher = _CountingMatcher(config.exclusions)
+        self.tracked = set()
+        self.budget = config.budget()
+        self.elapsed = 0.0
+
+    def run(self):
+        self.tracked.update(get_overlay(self.config).names())
+
+        home_dir = os.path.join(self.config.home_dir, '')
+        start = time.perf_counter()
+        for prefix in _inclusion_prefixes(self.config):
+            self._walk(home_dir + prefix, prefix, None)
+        self._walk(home_dir, '', is_home_subdir)
+        self.elapsed = time.perf_counter() - start
+        return self
+
+    def _walk(self, root, prefix, descend):
+        last = time.perf_counter()
+        for entry in walker.walk(root, prefix=prefix, descend=descend,
+                                 exclude=self.matcher, budget=self.budget):
+            stats = self.subtrees[entry.name.split('/', 1)[0]]
+            stats[0] += 1
+            stats[1] += time.perf_counter() - last
+
+            parent = entry.name
+            while '/' in parent:
+                parent = parent.rpartition('/')[0]
+                self.dir_entries[parent] += 1
+            last = time.perf_counter()
+
+    def rule_stats(self):
+        """Returns [(rule, dirs, files, entries saved)], most saving first."""
+        home_dir = self.config.home_dir
+        stats = []
+        for rule, names in self.matcher.matched.items():
+            dirs = [name for name in names if name.endswith('/')]
+            saved = sum(_subtree_size(os.path.join(home_dir, name))
+                        for name in dirs)
+            stats.append((rule, len(dirs), len(names) - len(dirs), saved))
+        stats.sort(key=lambda item: (-item[3], -item[1] - item[2], item[0]))
+        return stats
+
+    def dead_rules(self):
+        """Returns [(rule, shorter rule covering it or None)]."""
+        matcher = self.config.exclusions
+        dead = []
+        for rule in dict.fromkeys(self.config.exclusion_rules):
+            if rule in self.matcher.matched:
+                continue
+            covering = matcher.match(rule)
+            dead.append((rule, covering if covering != rule else None))
+        return dead
+
+    def heaviest_dirs(self, top):
+        """Returns [(directory, entries)] of directories without dotfiles.
+
+        Subdirectories of a listed directory aren't listed.
+        """
+        tracked_dirs = set()
+        for name in self.tracked:
+            while '/' in name:
+                name = name.rpartition('/')[0]
+                tracked_dirs.add(name)
+
+        result = []
+        for name, entries in self.dir_entries.most_common():
+            if len(result) >= top:
+                break
+            if name in tracked_dirs or name in self.tracked:
+                continue
+            if any(name.startswith(chosen + '/') for chosen, _ in result):
+                continue
+            result.append((name, entries))
+        return result
+
+    def print(self, top=20):
+        total = sum(entries for entries, _ in self.subtrees.values())
+        print(f'Walked {total} entries in {self.elapsed * 1000:.1f} ms')
+
+        print('\n== Top-level subtrees')
+        print(f'{"entries":>9} {"ms":>9}  name')
+        for name, (entries, seconds) in sorted(
+                self.subtrees.items(), key=lambda item: -item[1][1])[:top]:
+            print(f'{entries:9d} {seconds * 1000:9.1f}  {name}')
+
+        print('\n== Exclusion rules by entries saved')
+        print(f'{"saved":>9} {"dirs":>6} {"files":>6}  rule')
+        for rule, dirs, files, saved in self.rule_stats():
+            print(f'{saved:9d} {dirs:6d} {files:6d}  {rule}')
+
+        print('\n== Rules which matched nothing')
+        for rule, covering in self.dead_rules():
+            if covering is None:
+                print(f'  {rule}')
+            else:
+                print(f'  {rule} (redundant, {covering} covers it)')
+
+        if self.budget.skipped:
+            print()
+            self.budget.report(sys.stdout)
+
+        print('\n== Heaviest directories without dotfiles')
+        print(f'{"entries":>9}  directory')
+        for name, entries in self.heaviest_dirs(top):
+            print(f'{entries:9d}  {name}/')
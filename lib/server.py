@@ -0,0 +1,224 @@
+"""Resident server answering the fzf reload and preview callbacks.
+
+Every fzf binding spawns `management.py`, which would otherwise load the
+config and rescan from scratch. `management.py serve` keeps the config, the
+scan index and the discovered dotfiles in memory and answers over a Unix
+domain socket, diffs come from the shared cache of diffcache.py. The
+subcommands try the server first and fall back to doing the work themselves
+when no server is running, see client.py.
+
+Each response is a sequence of frames: a type byte (stdout, stderr or exit),
+payload length and the payload.
+"""
+
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import traceback
+
+from .client import EXIT, FRAME, STDERR, STDOUT, connect, is_private_dir
+from .compare import Comparator
+from .diffcache import DiffCache
+from .dotfile import DotFile, discover_dotfiles, discover_home_dotfiles
+from .index import ScanIndex
+from .overlay import invalidate as invalidate_overlay
+from .watch import Watcher
+
+
+class _Output:
+    """File-like object sending writes to the client as frames."""
+
+    def __init__(self, sock, kind):
+        self._sock = sock
+        self._kind = kind
+
+    def write(self, text):
+        payload = text.encode()
+        self._sock.sendall(FRAME.pack(self._kind, len(payload)) + payload)
+
+    def flush(self):
+        pass
+
+
+class Server:
+    """In-memory state shared by the requests."""
+
+    def __init__(self, config_factory, watch=False):
+        self._config_factory = config_factory
+        self._fingerprint = None
+        self.lock = threading.RLock()
+        self._watch = watch
+        self.watcher = None
+        # Watchers replaced by a reload, stopped once the lock is released
+        self._retired = []
+        self._load()
+        self._close_retired()
+
+    def _config_fingerprint(self, config_paths):
+        fingerprint = []
+        for path in config_paths:
+            try:
+                fingerprint.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                fingerprint.append((path, None))
+        return tuple(fingerprint)
+
+    def _load(self):
+        if self.watcher is not None:
+            # Joining it here would deadlock, its thread needs the lock
+            self.watcher.request_stop()
+            self._retired.append(self.watcher)
+            self.watcher = None
+
+        self.config = self._config_factory()
+        invalidate_overlay(self.config)
+        self.index = ScanIndex(self.config)
+        self._fingerprint = self._config_fingerprint(self.config.config_paths)
+        self._dotfiles = dict()
+        self._diffs = DiffCache(self.config)
+
+        if self._watch:
+            self.watcher = Watcher(self.config, self.index, self.lock)
+            self.watcher.start()
+
+    def _reload_if_needed(self):
+        if (self._config_fingerprint(self.config.config_paths) !=
+            self._fingerprint):
+            self._load()
+
+    def _dotfile(self, name):
+        dotfile = self._dotfiles.get(name)
+        if dotfile is None:
+            dotfile = DotFile.discover(self.config, name)
+            self._dotfiles[name] = dotfile
+        return dotfile
+
+    def _list(self, command, out):
+        if self.watcher is not None:
+            names = self.watcher.modified(command)
+            for name in names:
+                out.write(f'{name}\n')
+            if command == 'install' and not names:
+                out.write('All OK\n')
+            return
+
+        # Dotfiles might have been added to or removed from the layers
+        invalidate_overlay(self.config)
+        if command == 'collect':
+            dotfiles = discover_home_dotfiles(self.config, self.index)
+        else:
+            dotfiles = discover_dotfiles(self.config, self.index)
+
+        found = False
+        with Comparator(self.config, self.index) as comparator:
+            for dotfile in comparator.modified(dotfiles):
+                self._dotfiles[dotfile.name] = dotfile
+                out.write(f'{dotfile.name}\n')
+                found = True
+        self.index.save()
+
+        if command == 'install' and not found:
+            out.write('All OK\n')
+
+    def _diff(self, name, direction, out):
+        dotfile = self._dotfile(name)
+        out.write(self._diffs.render(dotfile, direction).decode())
+
+    def handle(self, argv, out):
+        """Runs the subcommand, returns its exit code."""
+        try:
+            with self.lock:
+                return self._handle(argv, out)
+        finally:
+            self._close_retired()
+
+    def _close_retired(self):
+        while self._retired:
+            self._retired.pop().stop()
+
+    def _handle(self, argv, out):
+        self._reload_if_needed()
+
+        command, args = argv[0], argv[1:]
+        if command in ('collect', 'install') and args[:1] == ['list']:
+            self._list(command, out)
+        elif command == 'diff' and args:
+            self._diff(args[0], args[1] if len(args) > 1 else 'dotfiles', out)
+        elif command == 'move' and args:
+            self._dotfile(args[0]).move(
+                    args[1] if len(args) > 1 else 'dotfiles')
+        else:
+            # Let the client do it on its own
+            return None
+        return 0
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        line = self.rfile.readline()
+        if not line:
+            # Just checking whether the server is alive
+            return
+
+        try:
+            argv = json.loads(line)['argv']
+            return_code = self.server.state.handle(
+                    argv, _Output(sock, STDOUT))
+            if return_code is None:
+                return_code = 'fallback'
+        except BrokenPipeError:
+            return
+        except Exception:
+            _Output(sock, STDERR).write(traceback.format_exc())
+            return_code = 1
+
+        payload = str(return_code).encode()
+        try:
+            sock.sendall(FRAME.pack(EXIT, len(payload)) + payload)
+        except BrokenPipeError:
+            pass
+
+
+def serve(path, config_factory, watch=False):
+    """Serve requests until interrupted.
+
+    With watch, the modified dotfiles are kept up to date from filesystem
+    events and listing them doesn't need any scan.
+    """
+    socket_dir = os.path.dirname(path)
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    if not is_private_dir(socket_dir):
+        # The clients wouldn't trust the socket
+        print(f'{socket_dir} has to be a directory writable only by you',
+              file=sys.stderr)
+        return 1
+
+    if os.path.exists(path):
+        sock = connect(path)
+        if sock is not None:
+            sock.close()
+            print(f'Server is already running at {path}', file=sys.stderr)
+            return 1
+        # Left behind by a crashed server
+        os.unlink(path)
+
+    server = socketserver.UnixStreamServer(path, _Handler)
+    os.chmod(path, 0o600)
+    server.state = Server(config_factory, watch)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f'Serving at {path}, CTRL+C to stop', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        if server.state.watcher is not None:
+            server.state.watcher.stop()
+    return 0
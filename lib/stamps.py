@@ -0,0 +1,98 @@
+"""Stamps of the last successful run of the installation scripts.
+
+A script which lists its inputs in its header is skipped while neither the
+script nor the inputs changed since it last succeeded:
+
+    # inputs: dotfiles/.Brewfile ~/.Brewfile_home
+
+Inputs are paths relative to the checkout, or to home with `~/`, and may be
+glob patterns or directories. The stamp is a digest of the content of the
+script and of all the inputs, so touching a file or checking it out again
+doesn't make the script run.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import time
+
+from .fsutil import atomic_write
+
+VERSION = 1
+
+
+def _feed_file(digest, path):
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+    except OSError as e:
+        digest.update(f'error {e.errno}'.encode())
+
+
+def _input_paths(pattern, base_dir):
+    """Returns the sorted files matching the input pattern."""
+    path = os.path.join(base_dir, os.path.expanduser(pattern))
+    paths = []
+    for match in sorted(glob.glob(path)) or [path]:
+        if os.path.isdir(match):
+            for dirpath, dirnames, filenames in os.walk(match):
+                dirnames.sort()
+                paths.extend(os.path.join(dirpath, filename)
+                             for filename in sorted(filenames))
+        else:
+            paths.append(match)
+    return paths
+
+
+def script_digest(script_path, inputs, base_dir):
+    """Returns digest of the script and the content of its inputs."""
+    digest = hashlib.blake2b(digest_size=20)
+    _feed_file(digest, script_path)
+    for pattern in inputs:
+        digest.update(b'\0input\0' + pattern.encode())
+        for path in _input_paths(pattern, base_dir):
+            digest.update(b'\0file\0' + path.encode() + b'\0')
+            if os.path.exists(path):
+                _feed_file(digest, path)
+            else:
+                digest.update(b'missing')
+    return digest.hexdigest()
+
+
+class StampDb:
+    """Digest of every script at its last successful run."""
+
+    def __init__(self, config):
+        self.config = config
+        self.path = os.path.join(config.cache_dir, 'script-stamps.json')
+        self._stamps = dict()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == VERSION:
+            self._stamps = data['stamps']
+
+    def digest(self, script):
+        return script_digest(script.path, script.inputs, self.config.base_dir)
+
+    def is_up_to_date(self, script, digest):
+        stamp = self._stamps.get(os.path.abspath(script.path))
+        return stamp is not None and stamp['digest'] == digest
+
+    def record(self, script, digest):
+        """Stamps the successful run and saves the database."""
+        self._stamps[os.path.abspath(script.path)] = {
+            'digest': digest,
+            'finished': time.time(),
+            'duration': script.duration,
+        }
+        data = {'version': VERSION, 'stamps': self._stamps}
+        try:
+            atomic_write(self.path, json.dumps(data, indent=1).encode())
+        except OSError:
+            # The script only runs again next time
+            pass
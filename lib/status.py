@@ -0,0 +1,107 @@
+"""Git status of the checkout and of the repos nested in it.
+
+The work/ and private/ layers are separate repos inside the checkout. Finding
+them doesn't go into .git directories nor into the known heavy directories.
+The list isn't cached: checking the cache would stat every directory of the
+walk, which costs about as much as the walk. The statuses are collected
+concurrently and printed in a stable order.
+"""
+
+import concurrent.futures
+import os
+import subprocess
+import sys
+
+from . import tracing
+
+# Never hold a repo of their own worth reporting
+SKIPPED_DIRS = frozenset({
+    '.git', '.venv', 'venv', 'node_modules', '__pycache__', '.mypy_cache',
+    '.pytest_cache', 'keyboard_layout',
+})
+
+
+def find_repos(config):
+    """Returns sorted paths of the repos nested in the checkout."""
+    root = os.path.abspath(config.base_dir)
+    repos = []
+    stack = [root]
+    walked = 0
+    while stack:
+        path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        walked += 1
+        for entry in entries:
+            if entry.name == '.git':
+                # A file for worktrees and submodules
+                if path != root:
+                    repos.append(path)
+                continue
+            if entry.name in SKIPPED_DIRS:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+            except OSError:
+                pass
+    tracing.count('status.dirs_walked', walked)
+    return sorted(repos)
+
+
+def _git_status(repo, color):
+    argv = ['git', '-c', f'color.status={"always" if color else "never"}',
+            'status', '-sb']
+    result = subprocess.run(argv, cwd=repo, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    return result.returncode, result.stdout
+
+
+def _modified_per_layer(config):
+    """Returns {dotfiles dir: number of dotfiles differing from home}."""
+    from .compare import Comparator
+    from .dotfile import discover_dotfiles
+    from .index import ScanIndex
+
+    counts = {os.path.abspath(dotfiles_dir): 0
+              for dotfiles_dir in config.dotfiles}
+    index = ScanIndex(config)
+    with Comparator(config, index) as comparator:
+        for dotfile in comparator.modified(discover_dotfiles(config, index)):
+            path = os.path.abspath(dotfile.dotfile_path)
+            for dotfiles_dir in counts:
+                if path.startswith(os.path.join(dotfiles_dir, '')):
+                    counts[dotfiles_dir] += 1
+                    break
+    index.save()
+    return counts
+
+
+def show_status(config, with_dotfiles=False):
+    """Prints git status of every repo, returns non-zero if any failed."""
+    root = os.path.abspath(config.base_dir)
+    repos = [root] + find_repos(config)
+    color = sys.stdout.isatty()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.jobs) as pool:
+        statuses = [pool.submit(_git_status, repo, color) for repo in repos]
+        counts = _modified_per_layer(config) if with_dotfiles else dict()
+        results = [future.result() for future in statuses]
+
+    failed = 0
+    for repo, (return_code, output) in zip(repos, results):
+        if repo != root:
+            print(f'\n== {os.path.relpath(repo, root)}')
+        sys.stdout.flush()
+        sys.stdout.buffer.write(output)
+        sys.stdout.buffer.flush()
+        failed = failed or return_code
+
+        count = counts.get(os.path.join(repo, 'dotfiles'))
+        if count is not None:
+            print(f'{count} dotfiles differ from home')
+    return failed
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import apply
+from apply import Journal, Operation
+from fakes import FakeConfig, write
+
+
+class ApplyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.config = FakeConfig(self.root)
+        write(self.root, 'repo/.vimrc', 'set nu\n')
+        write(self.root, 'repo/.bin/run', '#!/bin/sh\n')
+        os.chmod(self.path('repo/.bin/run'), 0o755)
+        write(self.root, 'home/.vimrc', 'set ai\n')
+        write(self.root, 'home/.old', 'old\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def operations(self):
+        return [
+            Operation.copy(self.path('repo/.vimrc'), self.path('home/.vimrc')),
+            Operation.copy(self.path('repo/.bin/run'),
+                           self.path('home/.bin/run')),
+            Operation.symlink('.vimrc', self.path('home/.exrc')),
+            Operation.write(b'new\n', self.path('home/.new')),
+            Operation.delete(self.path('home/.old')),
+        ]
+
+    def interrupt(self, operations, committed):
+        """Leaves the state of a batch killed after committing some."""
+        for operation in operations:
+            apply._stage(operation)
+            operation.existed = os.path.lexists(operation.destination)
+        Journal(self.config).write(operations)
+        for operation in operations[:committed]:
+            apply._commit(operation)
+
+    def assert_applied(self):
+        self.assertEqual(self.read('home/.vimrc'), 'set nu\n')
+        self.assertEqual(self.read('home/.bin/run'), '#!/bin/sh\n')
+        self.assertTrue(os.access(self.path('home/.bin/run'), os.X_OK))
+        self.assertEqual(os.readlink(self.path('home/.exrc')), '.vimrc')
+        self.assertEqual(self.read('home/.new'), 'new\n')
+        self.assertFalse(os.path.lexists(self.path('home/.old')))
+        self.assert_clean()
+
+    def assert_untouched(self):
+        self.assertEqual(self.read('home/.vimrc'), 'set ai\n')
+        self.assertEqual(self.read('home/.old'), 'old\n')
+        for name in ('home/.bin/run', 'home/.exrc', 'home/.new'):
+            self.assertFalse(os.path.lexists(self.path(name)), name)
+        self.assert_clean()
+
+    def assert_clean(self):
+        """No journal, staged copies nor backups are left."""
+        self.assertFalse(Journal(self.config).exists())
+        for dirpath, _, filenames in os.walk(self.path('home')):
+            self.assertEqual(
+                    [name for name in filenames if 'dotfiles-' in name], [])
+
+    def test_apply(self):
+        apply.apply(self.config, self.operations())
+        self.assert_applied()
+
+    def test_failed_commit_rolls_back(self):
+        original = apply._commit
+        commits = []
+
+        def failing_commit(operation):
+            commits.append(operation)
+            if len(commits) == 3:
+                raise OSError('disk full')
+            original(operation)
+
+        apply._commit = failing_commit
+        try:
+            with self.assertRaises(OSError):
+                apply.apply(self.config, self.operations())
+        finally:
+            apply._commit = original
+        self.assert_untouched()
+
+    def test_backup_without_hard_links(self):
+        original = os.link
+
+        def link(*args, **kwargs):
+            raise OSError('hard links not supported')
+
+        os.link = link
+        try:
+            operations = self.operations()
+            self.interrupt(operations, 2)
+        finally:
+            os.link = original
+        self.assertEqual(self.read('home/.vimrc'), 'set nu\n')
+        self.assertEqual(apply.recover(self.config, rollback=True), 5)
+        self.assert_untouched()
+
+    def test_recover_finishes(self):
+        self.interrupt(self.operations(), 2)
+        with self.assertRaises(Exception):
+            apply.apply(self.config, self.operations())
+        self.assertEqual(apply.recover(self.config), 5)
+        self.assert_applied()
+        self.assertEqual(apply.recover(self.config), 0)
+
+    def test_recover_rolls_back(self):
+        self.interrupt(self.operations(), 4)
+        self.assertEqual(apply.recover(self.config, rollback=True), 5)
+        self.assert_untouched()
+
+
+if __name__ == '__main__':
+    unittest.main()
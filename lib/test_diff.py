@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import tempfile
+import unittest
+
+from diff import diff
+
+
+def strip_colors(text):
+    return re.sub(r'\033\[[0-9;]*m', '', text)
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_same(self):
+        self.assertEqual(diff('a', 'b', 'x\ny\n', 'x\ny\n'), '')
+
+    def test_unified_format(self):
+        destination = ''.join(f'line {i}\n' for i in range(20))
+        source = destination.replace('line 10\n', 'changed\n')
+        self.assertEqual(strip_colors(diff('a', 'b', source, destination)), (
+            '--- a\n'
+            '+++ b\n'
+            '@@ -8,7 +8,7 @@\n'
+            ' line 7\n'
+            ' line 8\n'
+            ' line 9\n'
+            '-line 10\n'
+            '+changed\n'
+            ' line 11\n'
+            ' line 12\n'
+            ' line 13\n'))
+
+    def test_repeated_lines(self):
+        # No line is unique, runs of lines are
+        block = ['<dict>', '<true/>', '<false/>', '</dict>']
+        destination = [block[i % 4] if i % 7 else '<true/>'
+                       for i in range(2000)]
+        source = list(destination)
+        source[1000] = 'changed'
+        output = strip_colors(diff(
+            'a', 'b', '\n'.join(source), '\n'.join(destination)))
+        self.assertEqual(
+            [line for line in output.splitlines()
+             if line[:1] in '+-' and line[:3] not in ('---', '+++')],
+            [f'-{destination[1000]}', '+changed'])
+
+    def test_max_hunks(self):
+        destination = ''.join(f'line {i}\n' for i in range(100))
+        source = destination
+        for i in range(0, 100, 10):
+            source = source.replace(f'line {i}\n', f'changed {i}\n')
+        output = strip_colors(diff('a', 'b', source, destination, max_hunks=3))
+        self.assertEqual(output.count('@@ '), 3)
+        self.assertTrue(output.endswith('... more hunks\n'))
+
+        output = strip_colors(
+                diff('a', 'b', source, destination, max_hunks=10))
+        self.assertEqual(output.count('@@ '), 10)
+        self.assertNotIn('more hunks', output)
+
+    def test_preview_of_large_files(self):
+        # Larger than the window of the previews, repeated lines included
+        destination = [f'line {i}' if i % 3 else '}' for i in range(20000)]
+        source = list(destination)
+        source[5000:5000] = [f'new {i}' for i in range(3000)]
+        for i in range(100, 20000, 700):
+            source[i] = 'changed'
+        source, destination = '\n'.join(source), '\n'.join(destination)
+
+        full = strip_colors(diff('a', 'b', source, destination))
+        preview = strip_colors(
+                diff('a', 'b', source, destination, max_hunks=12))
+        self.assertTrue(preview.endswith('... more hunks\n'))
+        hunks = full.split('@@ ')
+        self.assertEqual(preview.split('@@ ')[:12], hunks[:12])
+        self.assertIn('+new 2999\n', preview)
+
+    def test_mode_change(self):
+        with tempfile.TemporaryDirectory() as root:
+            source = os.path.join(root, 'source')
+            destination = os.path.join(root, 'destination')
+            for path in (source, destination):
+                with open(path, 'w') as f:
+                    f.write('echo\n')
+            os.chmod(source, 0o755)
+            os.chmod(destination, 0o644)
+            self.assertEqual(diff(source, destination),
+                             'old mode 100644\nnew mode 100755\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
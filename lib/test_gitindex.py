@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import gitindex
+import index
+from fakes import FakeConfig, FakeDotFile, age, write
+from index import ScanIndex
+
+
+class StrictDotFile(FakeDotFile):
+
+    def is_modified(self):
+        raise AssertionError('Compared without the git index')
+
+
+@unittest.skipUnless(shutil.which('git'), 'git is not installed')
+class GitIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.repo = os.path.join(self.root, 'repo')
+        # Neither the tests nor git see the config of this machine
+        self.environ = mock.patch.dict(os.environ, {
+                'GIT_CONFIG_GLOBAL': os.devnull,
+                'GIT_CONFIG_NOSYSTEM': '1',
+                'GIT_ATTR_NOSYSTEM': '1',
+                'XDG_CONFIG_HOME': os.path.join(self.root, 'config')})
+        self.environ.start()
+        self.config = FakeConfig(self.root, 'repo')
+        self.git('init', '-q', self.repo, cwd=self.root)
+
+        write(self.root, 'repo/config.yaml', 'exclusions: []\n')
+        write(self.root, 'repo/dotfiles/.vimrc', 'set nu\n')
+        write(self.root, 'repo/dotfiles/.config/app/config', 'a\n')
+        write(self.root, 'repo/dotfiles/.config/app/long/' + 'x' * 100, 'x\n')
+        write(self.root, 'repo/dotfiles/.bin/run', '#!/bin/sh\n')
+        os.chmod(os.path.join(self.repo, 'dotfiles/.bin/run'), 0o755)
+        os.symlink('.vimrc', os.path.join(self.repo, 'dotfiles/.exrc'))
+        write(self.root, 'home/.vimrc', 'set nu\n')
+        write(self.root, 'home/.config/app/config', 'b\n')
+        write(self.root, 'home/.bin/run', '#!/bin/sh\n')
+        os.symlink('.vimrc', os.path.join(self.config.home_dir, '.exrc'))
+        age(self.root)
+        self.git('add', '.')
+
+    def tearDown(self):
+        self.environ.stop()
+        self.tmp.cleanup()
+
+    def git(self, *args, cwd=None):
+        return subprocess.run(
+                ['git', *args], cwd=cwd or self.repo, check=True,
+                stdout=subprocess.PIPE, text=True).stdout
+
+    def parse(self):
+        with open(os.path.join(self.repo, '.git', 'index'), 'rb') as f:
+            return gitindex.parse_index(f.read())
+
+    def assert_matches_git(self):
+        expected = dict()
+        for line in self.git('ls-files', '-s').splitlines():
+            info, name = line.split('\t')
+            mode, oid, _ = info.split()
+            expected[name] = (int(mode, 8), oid)
+        entries = self.parse()
+        self.assertEqual(
+                {name: (entry.mode, entry.oid.hex())
+                 for name, entry in entries.items()},
+                expected)
+
+    def test_versions(self):
+        for version in ('2', '3', '4'):
+            with self.subTest(version=version):
+                self.git('update-index', '--index-version', version)
+                self.assert_matches_git()
+
+    def test_extended_flags(self):
+        write(self.root, 'repo/dotfiles/.new', 'new\n')
+        # Intent to add entries need the extended flags of version 3
+        self.git('add', '-N', 'dotfiles/.new')
+        self.assert_matches_git()
+
+    def test_blob_oid(self):
+        entries = self.parse()
+        self.assertEqual(
+                gitindex.blob_oid(b'set nu\n'),
+                entries['dotfiles/.vimrc'].oid)
+        self.assertEqual(
+                gitindex.file_oid(os.path.join(self.repo, 'dotfiles/.vimrc')),
+                entries['dotfiles/.vimrc'].oid)
+
+    def test_clean_entry(self):
+        git_index = gitindex.GitIndex(self.config.dotfiles)
+        path = os.path.join(self.repo, 'dotfiles/.vimrc')
+        self.assertIsNotNone(
+                git_index.clean_entry(path, index.signature(path)))
+
+        write(self.root, 'repo/dotfiles/.vimrc', 'set ai\n')
+        self.assertIsNone(git_index.clean_entry(path, index.signature(path)))
+
+    def test_scan_index_uses_oids(self):
+        original = index.content_differs
+        index.content_differs = None
+        try:
+            scan_index = ScanIndex(self.config)
+            for name, modified in [('.vimrc', False),
+                                   ('.config/app/config', True),
+                                   ('.exrc', False),
+                                   ('.bin/run', True)]:
+                with self.subTest(name=name):
+                    self.assertEqual(
+                            scan_index.is_modified(
+                                StrictDotFile(self.config, name)),
+                            modified)
+        finally:
+            index.content_differs = original
+
+    def assert_compared_by_content(self, name):
+        git_index = gitindex.GitIndex(self.config.dotfiles)
+        path = os.path.join(self.repo, 'dotfiles', name)
+        self.assertIsNone(git_index.clean_entry(path, index.signature(path)))
+        vimrc = os.path.join(self.repo, 'dotfiles/.vimrc')
+        self.assertIsNotNone(
+                git_index.clean_entry(vimrc, index.signature(vimrc)))
+        self.assertFalse(ScanIndex(self.config).is_modified(
+                FakeDotFile(self.config, name)))
+
+    def test_autocrlf(self):
+        self.git('config', 'core.autocrlf', 'true')
+        write(self.root, 'repo/dotfiles/.crlf', 'a\r\n')
+        write(self.root, 'home/.crlf', 'a\r\n')
+        age(self.root)
+        self.git('add', '.')
+        git_index = gitindex.GitIndex(self.config.dotfiles)
+        path = os.path.join(self.repo, 'dotfiles/.crlf')
+        self.assertIsNone(git_index.clean_entry(path, index.signature(path)))
+        self.assertFalse(ScanIndex(self.config).is_modified(
+                FakeDotFile(self.config, '.crlf')))
+
+    def test_converting_attributes(self):
+        write(self.root, 'repo/dotfiles/.gitattributes',
+              '*.conf text eol=crlf\n')
+        write(self.root, 'repo/dotfiles/app.conf', 'a\r\n')
+        write(self.root, 'home/app.conf', 'a\r\n')
+        age(self.root)
+        self.git('add', '.')
+        self.assert_compared_by_content('app.conf')
+
+    def test_filter_macro(self):
+        write(self.root, 'repo/.gitattributes',
+              '[attr]secret filter=cat\n/dotfiles/**/*.key secret\n')
+        self.git('config', 'filter.cat.clean', 'tr a b')
+        write(self.root, 'repo/dotfiles/.ssh/id.key', 'a\n')
+        write(self.root, 'home/.ssh/id.key', 'a\n')
+        age(self.root)
+        self.git('add', '.')
+        self.assert_compared_by_content('.ssh/id.key')
+
+
+if __name__ == '__main__':
+    unittest.main()
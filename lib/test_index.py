@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import index
+from fakes import FakeConfig, FakeDotFile, age, write
+from index import ScanIndex
+
+
+class ScanIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.config = FakeConfig(self.root)
+        write(self.root, 'config.yaml', 'exclusions: []\n')
+        write(self.root, 'home/.vimrc', 'set nu\n')
+        write(self.root, 'home/.config/app/config', 'a\n')
+        write(self.root, 'dotfiles/.vimrc', 'set nu\n')
+        age(self.root)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_listing(self):
+        path = self.config.home_dir
+        mtime_ns = os.stat(path).st_mtime_ns
+        listing = [('.config', True, False), ('.vimrc', False, False)]
+
+        scan_index = ScanIndex(self.config)
+        self.assertIsNone(scan_index.cached_listing(path, mtime_ns))
+        scan_index.store_listing(path, mtime_ns, listing)
+        scan_index.save()
+
+        scan_index = ScanIndex(self.config)
+        self.assertEqual(scan_index.cached_listing(path, mtime_ns), listing)
+        self.assertIsNone(scan_index.cached_listing(path, mtime_ns + 1))
+
+    def test_reuses_verdict(self):
+        scan_index = ScanIndex(self.config)
+        self.assertFalse(scan_index.is_modified(
+            FakeDotFile(self.config, '.vimrc')))
+        scan_index.save()
+
+        reads = []
+        original = index.file_digest
+        index.file_digest = lambda path: reads.append(path) or original(path)
+        try:
+            scan_index = ScanIndex(self.config)
+            self.assertFalse(scan_index.is_modified(
+                FakeDotFile(self.config, '.vimrc')))
+            self.assertEqual(reads, [])
+
+            write(self.root, 'home/.vimrc', 'set ai\n')
+            os.utime(os.path.join(self.config.home_dir, '.vimrc'), (2, 2))
+            self.assertTrue(scan_index.is_modified(
+                FakeDotFile(self.config, '.vimrc')))
+            self.assertEqual(reads, [self.config.home_dir + '/.vimrc'])
+        finally:
+            index.file_digest = original
+
+    def test_quick_check(self):
+        dotfile = FakeDotFile(self.config, '.vimrc')
+        os.chmod(dotfile.home_path, 0o755)
+        self.assertTrue(ScanIndex(self.config).is_modified(dotfile))
+
+        os.chmod(dotfile.home_path, 0o600)
+        write(self.root, 'dotfiles/.vimrc', 'set nu\nset ai\n')
+        self.assertTrue(ScanIndex(self.config).is_modified(dotfile))
+        self.assertEqual(dotfile.calls, 0)
+
+    def test_config_change_invalidates(self):
+        dotfile = FakeDotFile(self.config, '.config/app/config')
+        scan_index = ScanIndex(self.config)
+        self.assertTrue(scan_index.is_modified(dotfile))
+        scan_index.save()
+
+        self.assertTrue(ScanIndex(self.config).is_modified(dotfile))
+        self.assertEqual(dotfile.calls, 1)
+
+        write(self.root, 'config.yaml', 'exclusions: [.config/]\n')
+        self.assertTrue(ScanIndex(self.config).is_modified(dotfile))
+        self.assertEqual(dotfile.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
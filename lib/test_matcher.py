@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from matcher import ExclusionMatcher
+
+
+class ExclusionMatcherTest(unittest.TestCase):
+
+    def test_empty(self):
+        matcher = ExclusionMatcher()
+        self.assertFalse(matcher.query('.config'))
+        self.assertFalse(matcher.query(''))
+
+    def test_prefix(self):
+        matcher = ExclusionMatcher(['.config'])
+        self.assertTrue(matcher.query('.config'))
+        self.assertTrue(matcher.query('.configuration'))
+        self.assertFalse(matcher.query('.conf'))
+
+    def test_one_element(self):
+        matcher = ExclusionMatcher(['.config/'])
+        self.assertTrue(matcher.query('.config/tmux'))
+        self.assertFalse(matcher.query('.tmux'))
+
+    def test_splitting(self):
+        matcher = ExclusionMatcher(['.config/alacritty', '.config/broot'])
+        self.assertTrue(matcher.query('.config/alacritty'))
+        self.assertFalse(matcher.query('.config/ala'))
+        self.assertTrue(matcher.query('.config/broot'))
+        self.assertFalse(matcher.query('.config/brz'))
+
+    def test_shorter_path(self):
+        matcher = ExclusionMatcher(['.config/alacritty', '.config/'])
+        self.assertTrue(matcher.query('.config/alacritty'))
+        self.assertTrue(matcher.query('.config/'))
+        self.assertTrue(matcher.query('.config/broot'))
+        self.assertEqual(matcher.rules, ('.config/',))
+
+    def test_multiple_paths(self):
+        matcher = ExclusionMatcher([
+            '.config/htop.conf',
+            '.config/broot/config',
+            '.config/broot/alt-config',
+        ])
+        self.assertTrue(matcher.query('.config/htop.conf'))
+        self.assertTrue(matcher.query('.config/broot/config'))
+        self.assertTrue(matcher.query('.config/broot/alt-config'))
+        self.assertFalse(matcher.query('.config/broot'))
+
+    def test_match_returns_rule(self):
+        matcher = ExclusionMatcher(['.cache/', '.config/foo-'])
+        self.assertEqual(matcher.match('.config/foo-bar/x'), '.config/foo-')
+        self.assertEqual(matcher.match('.cache/pip'), '.cache/')
+        self.assertIsNone(matcher.match('.config/foo'))
+
+    def test_classify(self):
+        matcher = ExclusionMatcher([
+            '.cache/', '.config/foo-', '.config/bar/x', '.local/share/'])
+        names = ['foo-a', 'foo', 'bar/', 'bar/x', 'baz']
+        self.assertEqual(
+            matcher.classify('.config/', names),
+            [matcher.match('.config/' + name) for name in names])
+        self.assertEqual(matcher.classify('.cache/', ['a', 'b']),
+                         ['.cache/', '.cache/'])
+        self.assertEqual(matcher.classify('.vim/', ['a', 'b']), [None, None])
+        self.assertEqual(matcher.classify('', ['.cache/', '.vimrc']),
+                         ['.cache/', None])
+
+
+if __name__ == '__main__':
+    unittest.main()
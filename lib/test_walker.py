@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+import walker
+
+
+class FakeIndex:
+
+    def __init__(self):
+        self.listings = dict()
+
+    def cached_listing(self, path, mtime_ns):
+        cached = self.listings.get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+
+    def store_listing(self, path, mtime_ns, listing):
+        self.listings[path] = (mtime_ns, listing)
+
+
+class WalkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        for name in ['.vimrc', '.config/app/config', '.config/b', 'Docs/x']:
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(name)
+        os.symlink('.config', os.path.join(self.root, '.link'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def names(self, **kwargs):
+        return [entry.name for entry in walker.walk(self.root, **kwargs)]
+
+    def test_walk(self):
+        self.assertEqual(self.names(), [
+            '.config', '.link', '.vimrc', 'Docs',
+            '.config/app', '.config/b', '.config/app/config',
+            'Docs/x'])
+
+    def test_entry_types(self):
+        entries = {entry.name: entry for entry in walker.walk(self.root)}
+        self.assertTrue(entries['.config'].is_dir)
+        self.assertFalse(entries['.config'].is_link)
+        self.assertTrue(entries['.link'].is_dir)
+        self.assertTrue(entries['.link'].is_link)
+        self.assertFalse(entries['.vimrc'].is_dir)
+        self.assertEqual(entries['.vimrc'].stat().st_size, len('.vimrc'))
+
+    def test_descend(self):
+        self.assertEqual(
+            self.names(descend=lambda entry: entry.name.startswith('.')),
+            ['.config', '.link', '.vimrc', 'Docs',
+             '.config/app', '.config/b', '.config/app/config'])
+
+    def test_prefix(self):
+        self.assertEqual(
+            [entry.name for entry in walker.walk(
+                os.path.join(self.root, '.config'), prefix='.config/')],
+            ['.config/app', '.config/b', '.config/app/config'])
+
+    def test_index(self):
+        index = FakeIndex()
+        expected = self.names()
+        self.assertEqual(self.names(index=index), expected)
+        self.assertEqual(len(index.listings), 4)
+        self.assertEqual(self.names(index=index), expected)
+
+        os.remove(os.path.join(self.root, 'Docs/x'))
+        os.utime(os.path.join(self.root, 'Docs'), ns=(1, 1))
+        self.assertEqual(self.names(index=index), expected[:-1])
+
+    def test_staged_leftovers(self):
+        for name in ['.config/.b.dotfiles-42.tmp', '..vimrc.dotfiles-7.bak',
+                     '.vimrc.tmp']:
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write(name)
+        self.assertEqual(self.names(), [
+            '.config', '.link', '.vimrc', '.vimrc.tmp', 'Docs',
+            '.config/app', '.config/b', '.config/app/config',
+            'Docs/x'])
+
+    def test_budget_file_size(self):
+        budget = walker.Budget(max_file_size=8)
+        self.assertEqual(self.names(budget=budget), [
+            '.config', '.link', '.vimrc', 'Docs', '.config/app', 'Docs/x'])
+        self.assertEqual([name for name, _ in budget.skipped],
+                         ['.config/b', '.config/app/config'])
+
+    def test_budget_dir_entries(self):
+        budget = walker.Budget(max_dir_entries=1)
+        self.assertEqual(self.names(budget=budget), [
+            '.config', '.link', '.vimrc', 'Docs', 'Docs/x'])
+        self.assertEqual(budget.skipped, [('.config/', '2 entries > 1')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""Timing of the phases and counters of the work done.
+
+Disabled by default. `DOTFILES_TRACE=1` prints a summary table to stderr when
+the process exits, `DOTFILES_TRACE=<path>` appends the same as one JSON line
+to the file instead, which also collects the fzf previews and reloads since
+they inherit the variable. `management.py --profile` enables it for the one
+command.
+
+Spans measure wall and CPU time of the thread which runs them, counters are
+plain sums. The total times of the process count from when tracing started.
+When disabled, span() returns a shared no-op context manager and count()
+returns right away; hot loops check `enabled` themselves. Work done in the
+process pools isn't counted.
+"""
+
+import atexit
+import os
+import sys
+import threading
+import time
+
+enabled = False
+
+_lock = threading.Lock()
+_spans = dict()
+_counters = dict()
+_path = None
+_start = None
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    __slots__ = ('name', '_wall_ns', '_cpu_ns')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._wall_ns = time.perf_counter_ns()
+        self._cpu_ns = time.thread_time_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_ns = time.perf_counter_ns() - self._wall_ns
+        cpu_ns = time.thread_time_ns() - self._cpu_ns
+        with _lock:
+            stats = _spans.get(self.name)
+            if stats is None:
+                stats = _spans[self.name] = [0, 0, 0]
+            stats[0] += 1
+            stats[1] += wall_ns
+            stats[2] += cpu_ns
+        return False
+
+
+def span(name):
+    """Context manager measuring the time spent in the block."""
+    if not enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def count(name, n=1):
+    """Adds n to the named counter."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def enable(path=None):
+    """Starts tracing, the report goes to the file or stderr at exit."""
+    global enabled, _path, _start
+    if enabled:
+        return
+    enabled = True
+    _path = path
+    _start = (time.time(), time.perf_counter_ns(), time.process_time_ns())
+    atexit.register(report)
+
+
+def snapshot():
+    """Returns the trace so far as a JSON serializable dict."""
+    with _lock:
+        spans = {name: {'calls': calls, 'wall_s': wall_ns / 1e9,
+                        'cpu_s': cpu_ns / 1e9}
+                 for name, (calls, wall_ns, cpu_ns) in _spans.items()}
+        counters = dict(_counters)
+    started, wall_ns, cpu_ns = _start
+    return {
+        'pid': os.getpid(),
+        'argv': sys.argv,
+        'started': started,
+        'wall_s': (time.perf_counter_ns() - wall_ns) / 1e9,
+        'cpu_s': (time.process_time_ns() - cpu_ns) / 1e9,
+        'spans': spans,
+        'counters': counters,
+    }
+
+
+def format_summary(trace):
+    lines = [f'{" ".join(trace["argv"])}: {trace["wall_s"] * 1000:.1f} ms '
+             f'wall, {trace["cpu_s"] * 1000:.1f} ms CPU']
+    if trace['spans']:
+        lines.append(f'  {"span":<28} {"calls":>7} {"wall ms":>10} '
+                     f'{"cpu ms":>10}')
+        for name, stats in sorted(trace['spans'].items(),
+                                  key=lambda item: -item[1]['wall_s']):
+            lines.append(f'  {name:<28} {stats["calls"]:7d} '
+                         f'{stats["wall_s"] * 1000:10.1f} '
+                         f'{stats["cpu_s"] * 1000:10.1f}')
+    if trace['counters']:
+        lines.append(f'  {"counter":<28} {"value":>7}')
+        for name, value in sorted(trace['counters'].items()):
+            lines.append(f'  {name:<28} {value:7d}')
+    return '\n'.join(lines) + '\n'
+
+
+def report():
+    """Writes the trace to the file or stderr."""
+    if not enabled:
+        return
+    trace = snapshot()
+    if _path is None:
+        sys.stderr.write(format_summary(trace))
+        return
+
+    import json
+
+    # One write of one line, concurrent processes don't interleave
+    line = (json.dumps(trace) + '\n').encode()
+    fd = os.open(_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+_setting = os.environ.get('DOTFILES_TRACE')
+if _setting:
+    enable(None if _setting in ('1', 'stderr') else _setting)
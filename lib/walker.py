@@ -0,0 +1,245 @@
+"""Directory walker built directly on os.scandir().
+
+Compared to os.walk() followed by os.path.* calls for every entry, the walker
+keeps the file type reported by readdir() and the stat data cached by DirEntry,
+and carries the relative names down instead of recomputing them with relpath.
+"""
+
+import os
+
+try:
+    from . import tracing
+    from .fsutil import is_staged
+except ImportError:
+    # Imported as a top-level module by the tests
+    import tracing
+    from fsutil import is_staged
+
+
+class Entry:
+    """A walked directory entry.
+
+    `name` is relative to the walked root, `is_dir` follows symlinks (same as
+    os.walk() which lists symlinks to directories among dirnames).
+    """
+
+    __slots__ = ('name', 'path', 'is_dir', 'is_link', '_dir_entry', '_stat')
+
+    def __init__(self, name, path, is_dir, is_link, dir_entry=None):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.is_link = is_link
+        self._dir_entry = dir_entry
+        self._stat = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name})'
+
+    def stat(self):
+        """Returns lstat() of the entry, at most one syscall per entry."""
+        if self._stat is None:
+            if self._dir_entry is not None:
+                self._stat = self._dir_entry.stat(follow_symlinks=False)
+            else:
+                self._stat = os.lstat(self.path)
+        return self._stat
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+
+
+class Budget:
+    """Limits of what a walk goes through, None for no limit.
+
+    Files bigger than max_file_size are left out. Directories with more than
+    max_dir_entries entries, or whose files together are bigger than
+    max_dir_size, are skipped with everything in them. The sizes come from
+    the lstat() the comparison needs anyway. What was left out is kept in
+    `skipped` as (name, reason), directory names end with a slash.
+    """
+
+    def __init__(self, max_file_size=None, max_dir_entries=None,
+                 max_dir_size=None):
+        self.max_file_size = max_file_size
+        self.max_dir_entries = max_dir_entries
+        self.max_dir_size = max_dir_size
+        self.skipped = []
+
+    def __bool__(self):
+        return (self.max_file_size is not None or
+                self.max_dir_entries is not None or
+                self.max_dir_size is not None)
+
+    def _skip(self, name, reason):
+        self.skipped.append((name, reason))
+        if tracing.enabled:
+            tracing.count('walk.over_budget')
+
+    def filter(self, path, prefix, listing, is_root=False):
+        """Returns the listing without over budget files, None to skip it.
+
+        The root of the walk itself is never skipped.
+        """
+        if (not is_root and self.max_dir_entries is not None and
+            len(listing) > self.max_dir_entries):
+            self._skip(prefix, f'{len(listing)} entries > '
+                               f'{self.max_dir_entries}')
+            return None
+        if self.max_file_size is None and self.max_dir_size is None:
+            return listing
+
+        base = os.path.join(path, '')
+        kept = []
+        total = 0
+        for item in listing:
+            name, is_dir, is_link, dir_entry = item
+            if not is_dir and not is_link:
+                try:
+                    if dir_entry is not None:
+                        size = dir_entry.stat(follow_symlinks=False).st_size
+                    else:
+                        size = os.lstat(base + name).st_size
+                except OSError:
+                    size = 0
+                if (self.max_file_size is not None and
+                    size > self.max_file_size):
+                    limit = format_size(self.max_file_size)
+                    self._skip(prefix + name,
+                               f'{format_size(size)} > {limit}')
+                    continue
+                total += size
+            kept.append(item)
+
+        if (not is_root and self.max_dir_size is not None and
+            total > self.max_dir_size):
+            self._skip(prefix, f'{format_size(total)} of files > '
+                               f'{format_size(self.max_dir_size)}')
+            return None
+        return kept
+
+    def report(self, file):
+        """Prints what was skipped with the exclusions to add."""
+        if not self.skipped:
+            return
+        print('Skipped over budget paths, add them to the exclusions in '
+              'config.yaml:', file=file)
+        for name, reason in self.skipped:
+            print(f'  - {name:<50} # {reason}', file=file)
+
+
+def _listdir(path, mtime_ns, index):
+    """Returns sorted [(name, is_dir, is_link, DirEntry or None)]."""
+    if index is not None:
+        listing = index.cached_listing(path, mtime_ns)
+        if listing is not None:
+            if tracing.enabled:
+                tracing.count('walk.listings_cached')
+            return [(name, is_dir, is_link, None)
+                    for name, is_dir, is_link in listing]
+
+    listing = []
+    try:
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                try:
+                    is_dir = dir_entry.is_dir()
+                except OSError:
+                    is_dir = False
+                listing.append(
+                        (dir_entry.name, is_dir, dir_entry.is_symlink(),
+                         dir_entry))
+    except OSError:
+        return None
+    listing.sort(key=lambda item: item[0])
+    if tracing.enabled:
+        tracing.count('walk.listings_read')
+
+    if index is not None:
+        index.store_listing(
+                path, mtime_ns,
+                [(name, is_dir, is_link)
+                 for name, is_dir, is_link, _ in listing])
+    return listing
+
+
+def walk(root, prefix='', descend=None, index=None, exclude=None,
+         budget=None):
+    """Yield an Entry for everything under root.
+
+    Entries of a directory are yielded in alphabetical order before any of its
+    subdirectories is visited. `descend(entry)` decides whether to go into
+    a directory; symlinks to directories are never followed. Names are
+    relative to root with the prefix prepended.
+
+    Entries matched by the `exclude` ExclusionMatcher are skipped altogether,
+    a whole directory listing is classified at once.
+
+    With a ScanIndex, listings of directories whose mtime didn't change are
+    reused. That costs one stat() per directory, without the index there is
+    only one scandir() per directory.
+
+    A Budget limits which files and directories below the root are walked.
+    """
+    mtime_ns = None
+    if index is not None:
+        try:
+            mtime_ns = os.stat(root).st_mtime_ns
+        except OSError:
+            return
+
+    stack = [(root, prefix, mtime_ns)]
+    while stack:
+        path, prefix, mtime_ns = stack.pop()
+        listing = _listdir(path, mtime_ns, index)
+        if listing is None:
+            continue
+
+        if exclude is not None:
+            # Directories are matched with the trailing slash, the same way
+            # as their content would be
+            excluded = exclude.classify(prefix, [
+                name + '/' if is_dir else name
+                for name, is_dir, _, _ in listing])
+            kept = [item for item, rule in zip(listing, excluded)
+                    if rule is None]
+            if tracing.enabled:
+                tracing.count('walk.excluded', len(listing) - len(kept))
+            listing = kept
+
+        if budget:
+            listing = budget.filter(path, prefix, listing, path == root)
+            if listing is None:
+                continue
+
+        if tracing.enabled:
+            tracing.count('walk.dirs')
+            tracing.count('walk.entries', len(listing))
+
+        base = os.path.join(path, '')
+        subdirs = []
+        for name, is_dir, is_link, dir_entry in listing:
+            if not is_dir and is_staged(name):
+                # Left behind by a killed collect or install
+                continue
+            entry = Entry(prefix + name, base + name,
+                          is_dir, is_link, dir_entry)
+            yield entry
+            if is_dir and not is_link:
+                if descend is None or descend(entry):
+                    subdirs.append(entry)
+                elif tracing.enabled:
+                    tracing.count('walk.dirs_pruned')
+
+        for entry in reversed(subdirs):
+            if index is not None:
+                try:
+                    mtime_ns = entry.stat().st_mtime_ns
+                except OSError:
+                    continue
+            stack.append((entry.path, entry.name + '/', mtime_ns))
@@ -0,0 +1,375 @@
+"""Keep the set of modified dotfiles up to date from filesystem events.
+
+On Linux, directories are watched through inotify. Every directory visited by
+the discovery gets a watch, up to a budget: subtrees which don't fit, and
+everything on systems without inotify, are rescanned periodically instead.
+Events are coalesced so that a burst of editor saves results in one check.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+from .compare import Comparator
+from .dotfile import (
+        discover_dotfiles,
+        discover_home_dotfiles,
+        find_dotfile,
+        find_home_dotfile,
+        is_home_subdir)
+from . import overlay
+from . import walker
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+        IN_ONLYDIR | IN_DONT_FOLLOW)
+
+_EVENT = struct.Struct('iIII')
+
+# Wait for this long without events before checking the changed files
+DEBOUNCE = 0.2
+# ... but never delay the check for longer than this
+MAX_DELAY = 2.0
+# Interval for rescanning subtrees without watches
+POLL_INTERVAL = 10.0
+
+
+class Inotify:
+    """Minimal ctypes binding of inotify(7)."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [
+                ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    @classmethod
+    def is_available(cls):
+        if not hasattr(os, 'uname') or os.uname().sysname != 'Linux':
+            return False
+        library = ctypes.util.find_library('c')
+        return library is not None and hasattr(
+                ctypes.CDLL(library), 'inotify_init1')
+
+    def add_watch(self, path, mask=_WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self):
+        """Returns the list of pending (wd, mask, name) events."""
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + size].rstrip(b'\0')
+            offset += size
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def default_budget():
+    """Use a quarter of the inotify watches allowed for the user."""
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as f:
+            return max(1, int(f.read()) // 4)
+    except (OSError, ValueError):
+        return 8192
+
+
+class Watcher:
+    """Maintains the modified dotfiles for collect and install.
+
+    All the work on the shared config and index happens under the lock which
+    is also held by the server while answering requests.
+    """
+
+    def __init__(self, config, index, lock, budget=None):
+        self.config = config
+        self.index = index
+        self.lock = lock
+        self.budget = budget if budget is not None else config.watch_budget
+        if self.budget is None:
+            self.budget = default_budget()
+
+        # Roots are the home and dotfiles layers, (root, prefix) by wd
+        self._inotify = Inotify() if Inotify.is_available() else None
+        self._watches = dict()
+        self._watched = dict()
+        # (root, prefix) of subtrees which are rescanned periodically
+        self._polled = set()
+        self._modified = {'collect': set(), 'install': set()}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def modified(self, command):
+        """Names of modified dotfiles for the collect or install command."""
+        return sorted(self._modified[command])
+
+    def start(self):
+        with self.lock:
+            self._watch_all()
+            self._full_scan()
+        self._thread = threading.Thread(
+                target=self._run, name='dotfiles-watch', daemon=True)
+        self._thread.start()
+
+    def request_stop(self):
+        """Makes the thread exit without waiting for it, see stop()."""
+        self._stop.set()
+
+    def stop(self):
+        """Stops the thread and waits for it, must not hold the lock."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _roots(self):
+        """(root, prefix, descend) of every tree discovery walks."""
+        home_dir = self.config.home_dir
+        roots = [(dotfiles_dir, '', None)
+                 for dotfiles_dir in self.config.dotfiles]
+        for extra_folder in self.config.get_inclusions():
+            prefix = os.path.join(os.path.normpath(extra_folder), '')
+            roots.append((home_dir, prefix, None))
+        roots.append((home_dir, '', is_home_subdir))
+        return roots
+
+    def _watch(self, root, prefix):
+        """Add a watch for the directory, returns False if over budget."""
+        path = os.path.join(root, prefix)
+        if path in self._watched:
+            return True
+        if self._inotify is None or len(self._watches) >= self.budget:
+            return False
+        try:
+            wd = self._inotify.add_watch(path)
+        except OSError:
+            return False
+        self._watches[wd] = (root, prefix)
+        self._watched[path] = wd
+        return True
+
+    def _unwatch_tree(self, root, prefix):
+        for wd, (watch_root, watch_prefix) in list(self._watches.items()):
+            if watch_root == root and watch_prefix.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._watches[wd]
+                del self._watched[os.path.join(root, watch_prefix)]
+
+    def _descend(self, root):
+        return is_home_subdir if root == self.config.home_dir else None
+
+    def _exclude(self, root):
+        if root == self.config.home_dir:
+            return self.config.exclusions
+        return None
+
+    def _is_walked(self, root, name):
+        """Returns True if discovery goes into the new directory."""
+        if root != self.config.home_dir:
+            return True
+        if self.config.is_excluded(name + '/'):
+            return False
+        return is_home_subdir(
+                walker.Entry(name, os.path.join(root, name), True, False))
+
+    def _watch_tree(self, root, prefix, descend=None):
+        """Watch directory and its subdirectories which discovery visits."""
+        exclude = self._exclude(root)
+        if not self._watch(root, prefix):
+            self._polled.add((root, prefix))
+            return
+
+        polled = []
+        for entry in walker.walk(os.path.join(root, prefix), prefix=prefix,
+                                 descend=descend, exclude=exclude):
+            if (not entry.is_dir or entry.is_link or
+                (descend is not None and not descend(entry))):
+                continue
+            subdir = entry.name + '/'
+            if any(subdir.startswith(polled_prefix)
+                   for polled_prefix in polled):
+                # Covered by the rescan of the parent
+                continue
+            if not self._watch(root, subdir):
+                polled.append(subdir)
+                self._polled.add((root, subdir))
+
+    def _watch_all(self):
+        for root, prefix, descend in self._roots():
+            self._watch_tree(root, prefix, descend)
+
+    def _full_scan(self):
+        overlay.invalidate(self.config)
+        dotfiles = {
+            'collect': discover_home_dotfiles(self.config, self.index),
+            'install': discover_dotfiles(self.config, self.index),
+        }
+        with Comparator(self.config, self.index) as comparator:
+            for command, candidates in dotfiles.items():
+                self._modified[command] = {
+                        dotfile.name
+                        for dotfile in comparator.modified(candidates)}
+        self.index.save()
+
+    def _refresh(self, names):
+        """Recheck the given dotfile names."""
+        # The single name lookups below don't use the overlay, the rest do
+        overlay.invalidate(self.config)
+        for name in names:
+            for command, find in (('collect', find_home_dotfile),
+                                  ('install', find_dotfile)):
+                dotfile = find(self.config, name)
+                if dotfile is not None and self.index.is_modified(dotfile):
+                    self._modified[command].add(name)
+                else:
+                    self._modified[command].discard(name)
+
+    def _names_under(self, root, prefix):
+        """Every file name under the directory, as far as discovery goes."""
+        names = {entry.name for entry in walker.walk(
+            os.path.join(root, prefix), prefix=prefix,
+            descend=self._descend(root), index=self.index,
+            exclude=self._exclude(root))
+                 if not entry.is_dir or entry.is_link}
+        # Also those which disappeared
+        for modified in self._modified.values():
+            names.update(name for name in modified if name.startswith(prefix))
+        return names
+
+    def _handle_events(self, events):
+        """Returns names to recheck for the inotify events."""
+        names = set()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # Lost events, start over
+                return None
+
+            if wd not in self._watches:
+                continue
+            root, prefix = self._watches[wd]
+
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                # Watches of the subdirectories would have stale names
+                self._unwatch_tree(root, prefix)
+                names.update(self._names_under(root, prefix))
+                continue
+
+            name = prefix + name
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                if self._is_walked(root, name):
+                    self._watch_tree(root, name + '/', self._descend(root))
+                    names.update(self._names_under(root, name + '/'))
+            elif mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+                names.update(self._names_under(root, name + '/'))
+            names.add(name)
+        return names
+
+    def _poll(self):
+        names = set()
+        for root, prefix in list(self._polled):
+            names.update(self._names_under(root, prefix))
+        return names
+
+    def _run(self):
+        pending = set()
+        first_event = last_event = None
+        next_poll = time.monotonic() + POLL_INTERVAL
+
+        while not self._stop.is_set():
+            now = time.monotonic()
+            timeout = next_poll - now
+            if last_event is not None:
+                timeout = min(timeout, last_event + DEBOUNCE - now,
+                              first_event + MAX_DELAY - now)
+            timeout = max(0, min(timeout, 1.0))
+
+            if self._inotify is not None:
+                readable, _, _ = select.select(
+                        [self._inotify.fd], [], [], timeout)
+                events = self._inotify.read() if readable else []
+            else:
+                self._stop.wait(timeout)
+                events = []
+
+            now = time.monotonic()
+            if events:
+                with self.lock:
+                    if self._stop.is_set():
+                        # Replaced while waiting for the lock
+                        break
+                    names = self._handle_events(events)
+                    if names is None:
+                        self._full_scan()
+                        pending.clear()
+                        first_event = last_event = None
+                        continue
+                pending.update(names)
+                last_event = now
+                if first_event is None:
+                    first_event = now
+
+            if pending and (now >= last_event + DEBOUNCE or
+                            now >= first_event + MAX_DELAY):
+                with self.lock:
+                    if self._stop.is_set():
+                        break
+                    self._refresh(pending)
+                    self.index.save()
+                pending.clear()
+                first_event = last_event = None
+
+            if now >= next_poll:
+                if self._polled:
+                    with self.lock:
+                        if self._stop.is_set():
+                            break
+                        self._refresh(self._poll())
+                        self.index.save()
+                next_poll = now + POLL_INTERVAL
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 """ Tool for dotfiles management. """
 
+import itertools
 import os
-import subprocess
 import sys
+import threading
 
+# Everything else is imported where needed: fzf runs this script for every
+# preview and reload, those have to start fast
 import lib
 
 
@@ -14,29 +17,103 @@ def usage(message=None):
     print(f'''Usage: {sys.argv[0]} <command>
 Command can be:
   collect      - move files from home into dotfiles repo (default)
-  run [script] - run an installation script
+  run [--force] [script] - run installation scripts, independent ones
+                 concurrently, --force runs the up to date ones too
   install      - interactively select files to be put into home
+  recover [rollback] - finish or roll back an interrupted collect/install
+  status [--dotfiles] - git status of the repo and of the nested layer
+                    repos, with the number of dotfiles differing from home
+  audit [--untracked] HOME... - print drift of every home against the repo
+                    as JSON lines, exits with 1 if any home drifted
+  shadowed     - list dotfiles which a higher layer overrides
+  scan-report [N] - show what the home walk costs, what the exclusions save
+                    and the N heaviest directories to consider excluding
+  serve        - keep the state in memory to answer fzf callbacks faster
+  watch        - serve and keep the modified files up to date continuously
   help         - print this help
+
+Options:
+  --profile[=FILE] - print timings, counters and cProfile stats of the
+                     command to stderr, or save the profile to the file
     ''')
 
 
-def collect(config, just_list=False):
-    dotfiles = lib.discover_home_dotfiles(config)
+def fzf_stream(args, lines, stop):
+    """Run fzf while feeding it lines as they are produced.
+
+    The user can start picking before all lines are produced. Returns the
+    selected lines.
+    """
+    import subprocess
+
+    fzf = subprocess.Popen(
+            ['fzf'] + args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr)
+
+    # Error of the scan, raised once fzf exits
+    errors = []
+
+    def feed():
+        try:
+            with lib.tracing.span('scan'):
+                for line in lines:
+                    fzf.stdin.write(f'{line}\n'.encode())
+                    fzf.stdin.flush()
+        except BrokenPipeError:
+            # fzf has finished before the scan
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # Otherwise fzf keeps waiting for more lines
+            try:
+                fzf.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    with lib.tracing.span('fzf'):
+        selected = fzf.stdout.read()
+        return_code = fzf.wait()
+
+    stop.set()
+    feeder.join()
+
+    if errors:
+        raise errors[0]
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, 'fzf')
+    return selected.decode().splitlines()
+
+
+def print_stream(lines):
+    with lib.tracing.span('scan'):
+        for line in lines:
+            print(line, flush=True)
+
 
-    file_list = '\n'.join(
-            dotfile.name
-            for dotfile in sorted(dotfiles, key=lambda d: d.name)
-            if dotfile.is_modified())
+def collect(config, just_list=False):
+    index = lib.ScanIndex(config)
+    comparator = lib.Comparator(config, index)
+    stop = threading.Event()
+    budget = config.budget()
+    names = (dotfile.name for dotfile in comparator.modified(
+        lib.discover_home_dotfiles(config, index, budget), stop))
 
     if just_list:
-        print(file_list)
+        print_stream(names)
+        comparator.close()
+        index.save()
         return
 
+    import subprocess
+
     self_cmd = f'/usr/bin/env python3 {sys.argv[0]}'
     reload_cmd = f'{self_cmd} collect list {{}}'
+    prerenderer = lib.Prerenderer(config, 'dotfiles')
     try:
-        selected = subprocess.check_output([
-            'fzf',
+        selected = fzf_stream([
             '--multi',
             '--layout=reverse',
             '--border=top',
@@ -49,40 +126,52 @@ def collect(config, just_list=False):
             f'--bind=ctrl-x:execute({self_cmd} move {{}} home)+reload({reload_cmd})',
             f'--preview={self_cmd} diff {{}} dotfiles',
             '--preview-label=Diff',
-        ], input=file_list.encode(), stderr=sys.stderr)
+        ], prerenderer.prerendered(names), stop)
     except subprocess.CalledProcessError as e:
         if e.returncode == 130:
             # 130 means no selection from the user
             return
         raise
+    finally:
+        prerenderer.close()
+        comparator.close()
+        index.save()
+        budget.report(sys.stderr)
 
-    for line in selected.decode().splitlines():
+    for line in selected:
         print(line)
-        dotfile = lib.DotFile.discover(config, line)
-        dotfile.move('dotfiles')
+    lib.move_all(config, selected, 'dotfiles')
 
 
 def install(config, just_list=False):
-    dotfiles = lib.discover_dotfiles(config)
-
-    file_list = '\n'.join(
-            dotfile.name
-            for dotfile in sorted(dotfiles, key=lambda d: d.name)
-            if dotfile.is_modified())
-
-    if not file_list:
+    index = lib.ScanIndex(config)
+    comparator = lib.Comparator(config, index)
+    stop = threading.Event()
+    names = (dotfile.name for dotfile in comparator.modified(
+        lib.discover_dotfiles(config, index), stop))
+
+    # Wait only for the first modified file to know whether to start fzf
+    first = next(names, None)
+    if first is None:
+        comparator.close()
+        index.save()
         print('All OK')
         return
+    names = itertools.chain([first], names)
 
     if just_list:
-        print(file_list)
+        print_stream(names)
+        comparator.close()
+        index.save()
         return
 
+    import subprocess
+
     self_cmd = f'/usr/bin/env python3 {sys.argv[0]}'
     reload_cmd = f'{self_cmd} install list {{}}'
+    prerenderer = lib.Prerenderer(config, 'home')
     try:
-        selected = subprocess.check_output([
-            'fzf',
+        selected = fzf_stream([
             '--multi',
             '--layout=reverse',
             '--border=top',
@@ -95,27 +184,27 @@ def install(config, just_list=False):
             f'--bind=ctrl-x:execute({self_cmd} move {{}} home)+reload({reload_cmd})',
             f'--preview={self_cmd} diff {{}} home',
             '--preview-label=Diff',
-        ], input=file_list.encode(), stderr=sys.stderr)
+        ], prerenderer.prerendered(names), stop)
     except subprocess.CalledProcessError as e:
         if e.returncode == 130:
             # 130 means no selection from the user
             return
         raise
+    finally:
+        prerenderer.close()
+        comparator.close()
+        index.save()
 
-    for line in selected.decode().splitlines():
+    for line in selected:
         print(line)
-        dotfile = lib.DotFile.discover(config, line)
-        dotfile.move('home')
-
-def run_script(config, initial_query):
-    scripts = []
-    for script_folder in config.scripts:
-        for dirpath, _, filenames in os.walk(script_folder):
-            for filename in filenames:
-                path = os.path.join(dirpath, filename)
-                scripts.append(os.path.relpath(path, config.base_dir))
-    scripts.sort()
-    script_list = '\n'.join(scripts)
+    lib.move_all(config, selected, 'home')
+
+def run_script(config, initial_query, force=False):
+    import subprocess
+
+    scripts = {os.path.relpath(path, config.base_dir): (name, path)
+               for name, path in lib.runner.discover_scripts(config)}
+    script_list = '\n'.join(sorted(scripts))
 
     try:
         selected = subprocess.check_output([
@@ -137,30 +226,12 @@ def run_script(config, initial_query):
             return
         raise
 
-    for script in selected.decode().splitlines():
-        print(f'\033[33m=-= Executing \033[33;1m{script}\033[0m')
-        if os.access(script, os.X_OK):
-            return_code = subprocess.call(script, shell=True)
-        else:
-            return_code = subprocess.call(['bash', script])
-        if return_code != 0:
-            print(f'\033[91m{script} failed with return code \033[1m{return_code}\033[0m')
-            sys.exit(return_code)
-
-
-def show_status(config):
-    root = os.path.abspath(config.base_dir)
-    git_repos = []
-    for path, folders, _ in os.walk(root):
-        if path != root and '.git' in folders:
-            git_repos.append(path)
-
-    subprocess.check_call(['git', 'status', '-sb'])
-
-    for repo in  git_repos:
-        name = os.path.relpath(repo, root)
-        print(f'\n== {name}')
-        subprocess.check_call(['git', 'status', '-sb'], cwd=repo)
+    runner = lib.runner.Runner(config, [
+        scripts[script] for script in selected.decode().splitlines()],
+        force=force)
+    return_code = runner.run()
+    if return_code != 0:
+        sys.exit(return_code)
 
 
 class Args:
@@ -175,11 +246,72 @@ class Args:
         self.args = self.args[1:]
         return value
 
+    def consume_option(self, name):
+        """Removes the leading `--name` or `--name=value` option.
 
-def main():
-    config = lib.Config()
+        Returns None if not given, True without a value, the value otherwise.
+        """
+        if not self.args or not self.args[0].startswith(f'--{name}'):
+            return None
+        option, equals, value = self.args[0].partition('=')
+        if option != f'--{name}':
+            return None
+        self.args = self.args[1:]
+        return value if equals else True
 
+
+def server_socket():
+    return lib.client.socket_path(
+            os.path.dirname(sys.argv[0]), os.path.expanduser('~'))
+
+
+def is_served(argv):
+    """Returns True for commands which the server can answer."""
+    if not argv:
+        return False
+    if argv[0] in ('collect', 'install'):
+        return argv[1:2] == ['list']
+    return argv[0] in ('diff', 'move')
+
+
+def profiled(function, output):
+    """Runs the function with tracing and cProfile enabled.
+
+    The profile is saved to the output file, or its heaviest functions are
+    printed to stderr when output is True. The trace is reported at exit.
+    """
+    import cProfile
+    import pstats
+
+    lib.tracing.enable()
+    profile = cProfile.Profile()
+    try:
+        profile.runcall(function)
+    finally:
+        if output is True:
+            stats = pstats.Stats(profile, stream=sys.stderr)
+            stats.sort_stats('cumulative').print_stats(30)
+        else:
+            profile.dump_stats(output)
+
+
+def main():
     args = Args(sys.argv[1:])
+    profile = args.consume_option('profile')
+    if profile is not None:
+        # Not asking the server, it would answer instead of this process
+        profiled(lambda: run(args), profile)
+        return
+
+    if is_served(args.args):
+        return_code = lib.client.request(server_socket(), args.args)
+        if return_code is not None:
+            sys.exit(return_code)
+    run(args)
+
+
+def run(args):
+    config = lib.Config()
 
     command = args.consume('collect')
     if command == 'collect':
@@ -195,7 +327,8 @@ def main():
             usage('Missing diff argument')
             return
         dotfile = lib.DotFile.discover(config, name)
-        print(dotfile.diff(direction))
+        sys.stdout.buffer.write(
+                lib.DiffCache(config).render(dotfile, direction))
     elif command == 'move':
         path = args.consume()
         direction = args.consume('dotfiles')
@@ -203,11 +336,44 @@ def main():
             usage('Missing path argument')
             return
         lib.DotFile.discover(config, path).move(direction)
+    elif command == 'recover':
+        rollback = args.consume('') == 'rollback'
+        count = lib.recover(config, rollback)
+        if not count:
+            print('Nothing to recover')
+        else:
+            action = 'Rolled back' if rollback else 'Finished'
+            print(f'{action} {count} interrupted moves')
     elif command == 'run':
+        force = args.consume_option('force') is not None
         query = args.consume('')
-        run_script(config, query)
+        run_script(config, query, force)
     elif command == 'status':
-        show_status(config)
+        with_dotfiles = args.consume_option('dotfiles') is not None
+        return_code = lib.status.show_status(config, with_dotfiles)
+        if return_code:
+            sys.exit(return_code)
+    elif command == 'audit':
+        untracked = args.consume_option('untracked') is not None
+        homes = args.args
+        if not homes:
+            usage('Missing home directories')
+            return
+        if lib.audit.audit(config, homes, untracked):
+            sys.exit(1)
+    elif command == 'shadowed':
+        lib.overlay.print_shadowed(config)
+    elif command == 'scan-report':
+        top = args.consume('20')
+        if not top.isdecimal():
+            usage(f'Invalid number of directories {top}')
+            return
+        lib.ScanReport(config).run().print(int(top))
+    elif command in ('serve', 'watch'):
+        base_dir = os.path.abspath(config.base_dir)
+        sys.exit(lib.server.serve(
+            server_socket(), lambda: lib.Config(base_dir=base_dir),
+            watch=command == 'watch'))
     elif command == 'help':
         usage()
     else:
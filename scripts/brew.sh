@@ -1,4 +1,7 @@
 #!/bin/bash
+#
+# interactive: waits for the Xcode tools and asks for the sudo password
+# inputs: ~/.Brewfile
 
 set -eu
 
@@ -1,6 +1,8 @@
 #!/bin/bash
 #
 # Set keyring credentials for telegram to power alert manager
+#
+# interactive: pass asks for the GPG passphrase
 
 set -eu
 
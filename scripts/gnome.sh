@@ -2,6 +2,9 @@
 #
 # Configure GNOME environment
 #
+# No inputs header on purpose: it runs every time, so settings changed in the
+# GNOME settings since the last run are written back.
+#
 # Difference between gsettings and dconf:
 # https://www.reddit.com/r/gnome/comments/waqpvc/gsettings_vs_dconf/
 #
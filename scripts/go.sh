@@ -1,4 +1,6 @@
 #!/bin/bash
+#
+# depends: brew.sh
 
 set -eu
 
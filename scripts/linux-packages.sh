@@ -1,4 +1,10 @@
 #!/bin/bash
+#
+# interactive: asks for the sudo password
+#
+# No inputs header on purpose: it runs every time, so packages removed or
+# upgraded by hand since the last run are installed again. apt skips what's
+# already there.
 
 set -eu
 
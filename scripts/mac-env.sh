@@ -1,4 +1,9 @@
 #!/bin/bash
+#
+# interactive: asks for the sudo password
+#
+# No inputs header on purpose: it runs every time, so settings changed in
+# System Settings since the last run are written back.
 
 set -eu
 
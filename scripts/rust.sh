@@ -1,4 +1,9 @@
 #!/bin/bash
+#
+# depends: brew.sh linux-packages.sh
+#
+# rustup comes from brew.sh on macOS and from linux-packages.sh on Linux, the
+# other one does nothing there
 
 set -eu
 